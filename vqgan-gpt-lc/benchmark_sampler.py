@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.sampler import Sampler
+
+####Latency of one sampling step over the vision vocabulary:
+####reference top-k filtering (topk + clone + full-vocab mask) + softmax + multinomial vs models.sampler.
+
+
+def reference_sample(logits, temperature=1.0, top_k=100):
+    logits = logits / temperature
+    if top_k is not None:
+        v, ix = torch.topk(logits, top_k)
+        out = logits.clone()
+        out[out < v[..., [-1]]] = -float("inf")
+        logits = out
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+
+def timeit(fn, logits, warmup, steps, device):
+    for _ in range(warmup):
+        fn(logits)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(steps):
+        fn(logits)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return 1000.0 * (time.time() - start_time) / steps
+
+
+def check_determinism(logits, top_k, top_p, device):
+    outs = []
+    for _ in range(2):
+        generator = torch.Generator(device=device).manual_seed(0)
+        outs.append(Sampler(top_k=top_k, top_p=top_p, generator=generator)(logits))
+    return torch.equal(outs[0], outs[1])
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    for batch_size in [int(b) for b in args.bench_batch_sizes.split(",")]:
+        logits = torch.randn(batch_size, args.vocab_size, device=device, dtype=getattr(torch, args.dtype))
+        for top_k in [int(k) for k in args.bench_top_k.split(",")]:
+            ref_ms = timeit(lambda l: reference_sample(l, args.temperature, top_k), logits, args.warmup_steps, args.bench_steps, device)
+            sampler = Sampler(temperature=args.temperature, top_k=top_k, top_p=args.top_p)
+            new_ms = timeit(sampler, logits, args.warmup_steps, args.bench_steps, device)
+            # per-sample top-k, every row with a different k
+            per_sample = Sampler(temperature=args.temperature, top_k=[max(1, top_k - i) for i in range(batch_size)], top_p=args.top_p)
+            per_sample_ms = timeit(per_sample, logits, args.warmup_steps, args.bench_steps, device)
+            print("batch %4d  top_k %7d  reference %7.3f ms  sampler %7.3f ms (x%.2f)  per-sample k %7.3f ms  deterministic %s" % (
+                batch_size, top_k, ref_ms, new_ms, ref_ms / max(new_ms, 1e-8), per_sample_ms,
+                check_determinism(logits, top_k, args.top_p, device)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Token sampler benchmark")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--vocab_size", default=100000, type=int)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--bench_batch_sizes", type=str, default="1,8,32,64")
+    parser.add_argument("--bench_top_k", type=str, default="100,1000,100000")
+    parser.add_argument("--top_p", default=1.0, type=float)
+    parser.add_argument("--temperature", default=1.0, type=float)
+    parser.add_argument("--warmup_steps", type=int, default=10)
+    parser.add_argument("--bench_steps", type=int, default=100)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,117 @@
+import argparse
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+from models.models_vq import VQModel
+from training_vqgan import get_args_parser, load_config
+
+####Memory / throughput report of one VQGAN training step (generator + discriminator update)
+####for several activation checkpointing settings and per-GPU batch sizes.
+
+
+def parse_variant(variant):
+    # "none" | "all" | comma separated resolutions, optionally with "mid"
+    if variant == "none":
+        return [], False
+    if variant == "all":
+        return None, True
+    items = [v for v in variant.split(",") if v != ""]
+    return [int(v) for v in items if v != "mid"], "mid" in items
+
+
+def all_resolutions(ddconfig):
+    return [ddconfig.resolution // 2 ** i for i in range(len(ddconfig.ch_mult))]
+
+
+def benchmark(args, config, variant, batch_size, device):
+    resolutions, ckpt_mid = parse_variant(variant)
+    config = copy.deepcopy(config)
+    ddconfig = config.model.params.ddconfig
+    ddconfig.ckpt_resolutions = all_resolutions(ddconfig) if resolutions is None else resolutions
+    ddconfig.ckpt_mid = ckpt_mid
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    model = VQModel(args=args, **config.model.params).to(device)
+    if args.channels_last:
+        model.to_channels_last()
+    model.train(True)
+    opt_ae = torch.optim.Adam([p for n, p in model.named_parameters() if p.requires_grad and not n.startswith("discriminator")], lr=1e-4, betas=(0.5, 0.9))
+    opt_disc = torch.optim.Adam(model.discriminator.parameters(), lr=1e-4, betas=(0.5, 0.9))
+    x = torch.randn(batch_size, ddconfig.in_channels, args.latent_size, args.latent_size, device=device)
+    if args.channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+
+    def train_step(cur_iter):
+        loss = model(x, cur_iter, step=0)[0]
+        opt_ae.zero_grad()
+        loss.backward()
+        opt_ae.step()
+        d_loss = model(x, cur_iter, step=1)[0]
+        opt_disc.zero_grad()
+        d_loss.backward()
+        opt_disc.step()
+
+    try:
+        for i in range(args.warmup_steps):
+            train_step(args.disc_start + 1)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        start_time = time.time()
+        for i in range(args.bench_steps):
+            train_step(args.disc_start + 1)
+        torch.cuda.synchronize()
+        elapsed = time.time() - start_time
+        result = {
+            "peak_mem_gb": torch.cuda.max_memory_allocated(device) / 1024 ** 3,
+            "img_per_s": batch_size * args.bench_steps / elapsed,
+            "oom": False,
+        }
+    except torch.cuda.OutOfMemoryError:
+        result = {"peak_mem_gb": float("nan"), "img_per_s": 0.0, "oom": True}
+    del model, opt_ae, opt_disc, x
+    torch.cuda.empty_cache()
+    result.update({"variant": variant, "batch_size": batch_size})
+    return result
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    cudnn.benchmark = True
+    config = load_config(args.vq_config_path, display=False)
+
+    results = []
+    for variant in args.ckpt_variants.split(";"):
+        for batch_size in [int(b) for b in args.bench_batch_sizes.split(",")]:
+            result = benchmark(args, config, variant, batch_size, device)
+            results.append(result)
+            if result["oom"]:
+                print("ckpt %-12s  batch %4d  OOM" % (variant, batch_size))
+                break
+            print("ckpt %-12s  batch %4d  peak mem %6.2f GB  %8.1f img/s" % (
+                variant, batch_size, result["peak_mem_gb"], result["img_per_s"]))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "vqgan_benchmark.json"), "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("VQGAN memory/throughput benchmark", parents=[get_args_parser()])
+    parser.add_argument("--ckpt_variants", type=str, default="none;mid;128,mid;all",
+                        help="';' separated checkpointing settings: none, all, or resolutions (+mid)")
+    parser.add_argument("--bench_batch_sizes", type=str, default="32,64,128,256")
+    parser.add_argument("--latent_size", type=int, default=32, help="Spatial size of the SD3 latents")
+    parser.add_argument("--warmup_steps", type=int, default=3)
+    parser.add_argument("--bench_steps", type=int, default=10)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+import argparse
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+
+from models.models_vq import VQModel
+from models.sd3.sd3_impls import SD3LatentFormat
+from training_vqgan import get_args_parser, load_config, CustomLatentDataset
+
+####Compare reconstruction loss curves of fp32 and mixed precision VQGAN training
+####on the same initialization and the same batches (single GPU, generator step only).
+
+
+def run_steps(model, batches, args, device):
+    opt_ae = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=args.lr, betas=(0.5, 0.9), eps=1e-7)
+    scaler = torch.cuda.amp.GradScaler(enabled=model.amp_dtype == torch.float16)
+    model.train(True)
+    rec_losses = []
+    torch.cuda.synchronize()
+    start_time = time.time()
+    for cur_iter, images in enumerate(batches):
+        x = SD3LatentFormat().process_in(images.to(device).squeeze(dim=1))
+        if model.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        loss, rec_loss, qloss, g_loss, tk_labels, xrec = model(x, cur_iter, step=0)
+        opt_ae.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(opt_ae)
+        scaler.update()
+        rec_losses.append(rec_loss.detach())
+    torch.cuda.synchronize()
+    elapsed = time.time() - start_time
+    return torch.stack(rec_losses).cpu().numpy(), elapsed
+
+
+def smooth(values, window):
+    kernel = np.ones(window) / window
+    return np.convolve(values, kernel, mode="valid")
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    cudnn.benchmark = True
+
+    dataset = CustomLatentDataset(args.features_dir)
+    indices = np.random.permutation(len(dataset))[: args.check_steps * args.batch_size]
+    batches = [torch.stack([dataset[int(i)] for i in indices[s: s + args.batch_size]]) for s in range(0, len(indices), args.batch_size)]
+
+    config = load_config(args.vq_config_path, display=False)
+    ref_args = copy.deepcopy(args)
+    ref_args.amp_dtype = "none"
+    ref_args.amp_exclude = ""
+    ref_model = VQModel(args=ref_args, **config.model.params).to(device)
+    amp_model = VQModel(args=args, **config.model.params).to(device)
+    amp_model.load_state_dict(ref_model.state_dict())
+    if args.channels_last:
+        amp_model.to_channels_last()
+
+    print("Running fp32 reference for %d steps" % len(batches))
+    ref_curve, ref_time = run_steps(ref_model, batches, ref_args, device)
+    print("Running %s (channels_last=%d) for %d steps" % (args.amp_dtype, args.channels_last, len(batches)))
+    amp_curve, amp_time = run_steps(amp_model, batches, args, device)
+
+    window = min(args.check_window, len(ref_curve))
+    ref_smooth, amp_smooth = smooth(ref_curve, window), smooth(amp_curve, window)
+    rel_diff = np.abs(amp_smooth - ref_smooth) / np.maximum(np.abs(ref_smooth), 1e-8)
+
+    for i in range(0, len(ref_curve), max(1, len(ref_curve) // 20)):
+        print("step %5d  fp32 rec %.5f  %s rec %.5f" % (i, ref_curve[i], args.amp_dtype, amp_curve[i]))
+    print("final smoothed rec loss: fp32 %.5f  %s %.5f" % (ref_smooth[-1], args.amp_dtype, amp_smooth[-1]))
+    print("max relative deviation of smoothed curves: %.4f (tolerance %.4f)" % (rel_diff.max(), args.check_tolerance))
+    print("throughput: fp32 %.1f img/s  %s %.1f img/s  speedup %.2fx" % (
+        len(indices) / ref_time, args.amp_dtype, len(indices) / amp_time, ref_time / amp_time))
+
+    passed = bool(rel_diff.max() <= args.check_tolerance)
+    print("Numerics check %s" % ("PASSED" if passed else "FAILED"))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "amp_numerics_%s.json" % args.amp_dtype), "w") as f:
+            json.dump({
+                "fp32_rec_loss": ref_curve.tolist(),
+                "amp_rec_loss": amp_curve.tolist(),
+                "max_rel_diff": float(rel_diff.max()),
+                "fp32_time": ref_time,
+                "amp_time": amp_time,
+                "passed": passed,
+            }, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("AMP numerics check", parents=[get_args_parser()])
+    parser.add_argument("--features_dir", type=str, default="/cache/data/imagenet/sd3-features/train/imagenet256_features/sd3-features-256")
+    parser.add_argument("--check_steps", type=int, default=200, help="Training steps per run")
+    parser.add_argument("--check_window", type=int, default=20, help="Moving average window for the loss curves")
+    parser.add_argument("--check_tolerance", type=float, default=0.05, help="Max relative deviation of smoothed rec loss")
+    args = parser.parse_args()
+    if args.lr is None:
+        args.lr = 1e-4
+    main(args)
@@ -1,10 +1,13 @@
 import math
 import sys
+import time
 from typing import Iterable
 
 import torch
 import util.lr_sched as lr_sched
 import util.misc as misc
+from util.profiler import StepProfiler
+from util.data_monitor import LoaderMonitor
 import copy
 import numpy as np
 import mlflow
@@ -74,6 +77,19 @@ def train_one_epoch(
 
     if log_writer is not None:
         print("log_dir: {}".format(log_writer.log_dir))
+
+    profiler = StepProfiler(
+        enabled=getattr(args, "profile", 0) == 1,
+        log_freq=getattr(args, "profile_freq", 100),
+        trace_steps=getattr(args, "profile_trace_steps", ""),
+        trace_dir=os.path.join(args.log_dir, "profile_rank%d" % misc.get_rank()),
+    )
+    if profiler.enabled:
+        model.module.profiler = profiler
+
+    if getattr(args, "data_monitor", 0):
+        data_loader = LoaderMonitor(data_loader, log_writer=log_writer, log_freq=args.data_monitor_freq, start_iter=len(data_loader) * epoch)
+
     for data_iter_step, images in enumerate(
         metric_logger.log_every(data_loader, print_freq, header)
     ):
@@ -83,9 +99,13 @@ def train_one_epoch(
 
         ####Tokenizer with VQ-GAN
         b = images.shape[0]
-        x = images.to(device)
-        x = x.squeeze(dim=1)
-        x = SD3LatentFormat().process_in(x)
+        profiler.start_step(cur_iter)
+        with profiler.stage("process_in"):
+            x = images.to(device)
+            x = x.squeeze(dim=1)
+            x = SD3LatentFormat().process_in(x)
+            if getattr(args, "channels_last", 0):
+                x = x.contiguous(memory_format=torch.channels_last)
         # # x_0 = SD3LatentFormat().process_out(x)
         # vae = set_sd3_vae('/cache/data/sd3_medium.ckpt')
         # # print(x_0.shape)
@@ -104,14 +124,16 @@ def train_one_epoch(
         #     count = count + 1
 
         
-        #with  torch.cuda.amp.autocast():
-        loss, rec_loss, qloss, g_loss, tk_labels, xrec = model(x, cur_iter, step=0)
+        # autocast is opened per module inside VQModel (see --amp_dtype / --amp_exclude)
+        with profiler.stage("forward_g"):
+            loss, rec_loss, qloss, g_loss, tk_labels, xrec = model(x, cur_iter, step=0)
         
 
         
-        tk_index_one_hot = torch.nn.functional.one_hot(tk_labels.view(-1), num_classes=args.n_vision_words)
-        tk_index_num = torch.sum(tk_index_one_hot, dim=0)
-        token_freq += tk_index_num
+        with profiler.stage("token_freq"):
+            tk_index_one_hot = torch.nn.functional.one_hot(tk_labels.view(-1), num_classes=args.n_vision_words)
+            tk_index_num = torch.sum(tk_index_one_hot, dim=0)
+            token_freq += tk_index_num
         
         opt_ae.zero_grad()
         lr_sched.adjust_learning_rate(opt_ae, data_iter_step / len(data_loader) + epoch, args)
@@ -120,27 +142,31 @@ def train_one_epoch(
         #     if param.grad is None:
         #         print(name)
 
-        if args.use_cblinear != 0:
-            loss_scaler_ae(loss, opt_ae, parameters=list(model.module.encoder.parameters())+
-                                    list(model.module.decoder.parameters())+
-                                    list(model.module.quant_conv.parameters())+
-                                    list(model.module.tok_embeddings.parameters())+
-                                    list(model.module.codebook_projection.parameters()) + 
-                                    list(model.module.post_quant_conv.parameters()), update_grad=(data_iter_step + 1) % accum_iter == 0)
-        else:
-            loss_scaler_ae(loss, opt_ae, parameters=list(model.module.encoder.parameters())+
-                                    list(model.module.decoder.parameters())+
-                                    list(model.module.quant_conv.parameters())+
-                                    list(model.module.tok_embeddings.parameters())+
-                                    list(model.module.post_quant_conv.parameters()), update_grad=(data_iter_step + 1) % accum_iter == 0)
+        with profiler.stage("backward_g"):
+            if args.use_cblinear != 0:
+                loss_scaler_ae(loss, opt_ae, parameters=list(model.module.encoder.parameters())+
+                                        list(model.module.decoder.parameters())+
+                                        list(model.module.quant_conv.parameters())+
+                                        list(model.module.tok_embeddings.parameters())+
+                                        list(model.module.codebook_projection.parameters()) + 
+                                        list(model.module.post_quant_conv.parameters()), update_grad=(data_iter_step + 1) % accum_iter == 0)
+            else:
+                loss_scaler_ae(loss, opt_ae, parameters=list(model.module.encoder.parameters())+
+                                        list(model.module.decoder.parameters())+
+                                        list(model.module.quant_conv.parameters())+
+                                        list(model.module.tok_embeddings.parameters())+
+                                        list(model.module.post_quant_conv.parameters()), update_grad=(data_iter_step + 1) % accum_iter == 0)
         
         if cur_iter > args.disc_start and args.rate_d != 0:
             #with  torch.cuda.amp.autocast():
-            d_loss, _, _, _, _, _, = model(x, cur_iter, step=1)
+            with profiler.stage("forward_d"):
+                d_loss, _, _, _, _, _, = model(x, cur_iter, step=1)
             opt_disc.zero_grad()
             lr_sched.adjust_learning_rate(opt_disc, data_iter_step / len(data_loader) + epoch, args)
-            loss_scaler_disc(d_loss, opt_disc, parameters=model.module.discriminator.parameters(), update_grad=(data_iter_step + 1) % accum_iter == 0)
+            with profiler.stage("backward_d"):
+                loss_scaler_disc(d_loss, opt_disc, parameters=model.module.discriminator.parameters(), update_grad=(data_iter_step + 1) % accum_iter == 0)
 
+        log_start = time.time()
         torch.cuda.synchronize()
         
         lr = opt_ae.param_groups[0]["lr"]
@@ -192,6 +218,8 @@ def train_one_epoch(
             log_writer.add_scalar("Iter/GAN Loss", gloss_value_reduce, epoch_1000x)
             if cur_iter > args.disc_start and args.rate_d != 0:
                 log_writer.add_scalar("Iter/Discriminator Loss", dloss_value_reduce, epoch_1000x)
+        profiler.record_host("logging", time.time() - log_start)
+        profiler.end_step(log_writer)
     
     efficient_token = np.sum(np.array(token_freq.cpu().data) != 0)
     #metric_logger.update(efficient_token=efficient_token.float())
@@ -1,4 +1,9 @@
 import os
+import copy
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
 import argparse
@@ -7,7 +12,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import util.lr_sched as lr_sched
 from torchvision import utils as vutils
-from models.models_vq import VQModel 
+from models.models_gpt import VQGANTransformer
+from models.maskgit import VQGANBidTransformer
+from models.speculative import SpeculativeStats
 #from util.utils import load_data, plot_images
 import util.misc as misc
 import torch.backends.cudnn as cudnn
@@ -115,8 +122,80 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
             np.trace(sigma2) - 2 * tr_covmean)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="VQGAN")
+def image_name(cls, idx):
+    # the wnid keeps the names unique (some ImageNet class names appear twice, e.g. crane)
+    wnid, class_name = imagenet_dict[str(cls)]
+    return "%s_%s_%s.png" % (wnid, class_name, idx)
+
+
+def build_work_items(num_classes, images_per_class, rank, world_size):
+    # strided over all (class, sample index) pairs: every rank gets the same number of items +-1
+    items = [(cls, idx) for cls in range(num_classes) for idx in range(images_per_class)]
+    return items[rank::world_size]
+
+
+def load_completed(output_dir, save_dir):
+    # images are renamed into place only once fully written, so every PNG in save_dir is complete;
+    # the per-rank manifests record which run wrote them
+    completed = set(f for f in os.listdir(save_dir) if f.endswith(".png"))
+    num_manifest = 0
+    for f in os.listdir(output_dir):
+        if f.startswith("generation_manifest") and f.endswith(".txt"):
+            with open(os.path.join(output_dir, f)) as manifest:
+                num_manifest += sum(1 for line in manifest if line.strip() in completed)
+    return completed, num_manifest
+
+
+class ImageWriter:
+    """
+    Saves generated images from a thread pool so sampling of the next batch
+    never waits on PNG encoding. Each image is written to a temporary file,
+    renamed into place and then appended to the rank's manifest.
+    """
+    def __init__(self, save_dir, manifest_path, num_workers=8, max_pending=4):
+        self.save_dir = save_dir
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.manifest = open(manifest_path, "a")
+        self.lock = threading.Lock()
+
+    def _save(self, images, done_event, names):
+        # images: pinned uint8 (N, H, W, 3), filled by an async device-to-host copy
+        if done_event is not None:
+            done_event.synchronize()
+        images = images.numpy()
+        for image, name in zip(images, names):
+            path = os.path.join(self.save_dir, name)
+            Image.fromarray(image).save(path + ".tmp", format="PNG")
+            os.replace(path + ".tmp", path)
+        with self.lock:
+            self.manifest.write("".join(name + "\n" for name in names))
+            self.manifest.flush()
+
+    def submit(self, images, names):
+        # images: (N, 3, H, W) in [-1, 1] on any device
+        images = ((images.clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8).permute(0, 2, 3, 1)
+        done_event = None
+        if images.is_cuda:
+            host = torch.empty(images.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(images, non_blocking=True)
+            done_event = torch.cuda.Event()
+            done_event.record()
+            images = host
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(self._save, images, done_event, names))
+
+    def close(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+        self.manifest.close()
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description="VQGAN", add_help=False)
 
     parser.add_argument(
         "--batch_size",
@@ -168,8 +247,28 @@ if __name__ == '__main__':
     parser.add_argument("--dataset", type=str, default="ffhq", help="")
 
     parser.add_argument("--top_k", default=113465, type=int)
+    parser.add_argument("--images_per_class", default=50, type=int)
+    parser.add_argument("--save_workers", default=8, type=int, help="Threads encoding and writing PNGs")
+    parser.add_argument("--imagenet_path", type=str, default="./data", help="ImageNet root, FID reference is <imagenet_path>/train")
+    parser.add_argument("--top_p", default=1.0, type=float, help="Nucleus sampling threshold, 1.0 disables it")
+    parser.add_argument("--temperature", default=1.0, type=float)
     parser.add_argument("--gpt_type", type=str, default="small", help="")
+    parser.add_argument("--null_class", default=0, type=int, help="The model was trained with a null class token (--null_class 1)")
+    parser.add_argument("--cfg_scale", default=1.0, type=float, help="Classifier-free guidance scale, 1.0 disables guidance")
+    parser.add_argument("--cfg_schedule", type=str, default="constant", choices=["constant", "linear", "cosine"], help="Guidance scale over the decoding steps")
+    parser.add_argument("--spec_k", default=0, type=int, help="Speculative decoding: tokens proposed by the draft model per round, 0 disables it")
+    parser.add_argument("--draft_ckpt", type=str, default="", help="Checkpoint of the draft model (trained with training_gpt.py)")
+    parser.add_argument("--draft_gpt_type", type=str, default="tiny", help="gpt_type of the draft model")
+    parser.add_argument("--spec_baseline_batches", default=3, type=int, help="Warm plain autoregressive batches timed for the speculative speedup")
+    parser.add_argument("--maskgit_steps", default=12, type=int, help="Parallel decoding steps for --gpt_type maskgit")
+    parser.add_argument("--maskgit_choice_temperature", default=4.5, type=float, help="Gumbel noise scale when choosing the tokens to re-mask")
+    parser.add_argument("--compile", type=str, default="none", choices=["none", "default", "reduce-overhead", "max-autotune"], help="torch.compile mode for VQ decode")
+    parser.add_argument("--cuda_graph", type=int, default=0, help="Capture the token-to-image decode in static-shape CUDA graphs")
+    return parser
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="VQGAN", parents=[get_args_parser()])
     args = parser.parse_args()
 
     misc.init_distributed_mode(args)
@@ -185,7 +284,10 @@ if __name__ == '__main__':
     generation_save_dir = os.path.join(args.output_dir, "generation")
     os.makedirs(generation_save_dir, exist_ok=True)
 
-    model = VQModel(args).to(device=args.device)
+    if "maskgit" in args.gpt_type:
+        model = VQGANBidTransformer(args).to(device=args.device)
+    else:
+        model = VQGANTransformer(args).to(device=args.device)
     state_dict = torch.load(args.stage_2_ckpt, map_location="cpu")
     if "gpt_checkpoint_last" in args.stage_2_ckpt: #deepspeed save
         state_dict = state_dict["module"]
@@ -195,55 +297,92 @@ if __name__ == '__main__':
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])#, find_unused_parameters=True)
         print(model)
-    model = model.module
+        model = model.module
     model.eval()
-    count=0
-    num_gpus = torch.cuda.device_count()
-    token_freq = torch.zeros(args.n_vision_words).to(device)
-    for generate_cls in range(0, np.int64(1000 / num_gpus)):
-        cur_cls = generate_cls * num_gpus + global_rank
-        if cur_cls > 1000:
-            break
-        class_name = imagenet_dict[str(cur_cls)][1]
-        if os.path.exists(os.path.join(generation_save_dir, "%s_%s.png"%(class_name, 49))):
-            continue
-        if global_rank == 0:
-            print(generate_cls, "/", np.int64(1000 / num_gpus), ":", imagenet_dict[str(cur_cls)][1])
-        generate_times = np.int64(np.floor(50 / args.batch_size))
-        for i in range(0, generate_times):
-            num = args.batch_size
-
-            sos_tokens = torch.ones(num, 1) * model.sos_token
-            sos_tokens = sos_tokens.long().to("cuda")
-
-            label_cls = torch.ones(num, 1) * (cur_cls + args.n_vision_words)
-            label_cls = label_cls.long().to("cuda")
-
-            if args.class_condition == 1:
-                sample_indices = model.sample(None, label_cls, steps=256, top_k=args.top_k)
-            else:
-                sample_indices = model.sample(None, sos_tokens, steps=256, top_k=args.top_k)
-
-            tk_index_one_hot = torch.nn.functional.one_hot(sample_indices.contiguous().view(-1), num_classes=args.n_vision_words)
-            tk_index_num = torch.sum(tk_index_one_hot, dim=0)
-            token_freq += tk_index_num
-
-            x_generation = model.z_to_image(sample_indices)
-
-            x_generation[x_generation > 1] = 1
-            x_generation[x_generation < -1] = -1
-            x_generation = (x_generation + 1) * 127.5
-
-            x_generation = x_generation / 255.0
-
-            for b in range(0, x_generation.shape[0]):
-                plt.imsave(os.path.join(generation_save_dir, "%s_%s.png"%(class_name, i*args.batch_size+b)), np.uint8(x_generation[b].detach().cpu().numpy().transpose(1, 2, 0) * 255))
-    np.save(os.path.join(args.output_dir, "token_freq.npy"), np.array(token_freq.cpu().data))
-
-    from cleanfid import fid
-    fid_value = fid.compute_fid(generation_save_dir, imagenet_path + "/train", mode="clean")
-
-    efficient_token = np.sum(np.array(token_freq.cpu().data) != 0)
-    with open(os.path.join(args.output_dir, "recons.csv"), 'a') as f:
-        f.write("FID, Effective_Tokens \n")
-        f.write("%.4f, %d \n"%(fid_value, efficient_token))
+    if args.compile != "none" or args.cuda_graph:
+        model.enable_compile(args.compile, cuda_graph=args.cuda_graph == 1)
+
+    draft = None
+    if args.spec_k > 0:
+        assert args.cfg_scale == 1.0, "speculative decoding does not support classifier-free guidance"
+        draft_args = copy.copy(args)
+        draft_args.gpt_type = args.draft_gpt_type
+        draft = model.build_transformer(draft_args).to(device)
+        state_dict = torch.load(args.draft_ckpt, map_location="cpu")
+        if "gpt_checkpoint_last" in args.draft_ckpt: #deepspeed save
+            state_dict = state_dict["module"]
+        state_dict = {k.replace('module.', ''): v for k, v in state_dict.items()}
+        draft.load_state_dict({k[len("transformer."):]: v for k, v in state_dict.items() if k.startswith("transformer.")}, strict=True)
+        draft.eval()
+        spec_stats = SpeculativeStats()
+        baseline_batches, baseline_seconds, baseline_tokens = 0, 0.0, 0
+    work_items = build_work_items(args.n_class, args.images_per_class, global_rank, num_tasks)
+    completed, num_manifest = load_completed(args.output_dir, generation_save_dir)
+    todo = [(cls, idx) for cls, idx in work_items if image_name(cls, idx) not in completed]
+    print("Rank %d: %d work items, %d already done (%d in manifests), %d to generate" % (
+        global_rank, len(work_items), len(work_items) - len(todo), num_manifest, len(todo)))
+
+    writer = ImageWriter(generation_save_dir, os.path.join(args.output_dir, "generation_manifest_rank%d.txt" % global_rank),
+                         num_workers=args.save_workers)
+    token_freq = torch.zeros(args.n_vision_words, dtype=torch.long, device=device)
+    for start in tqdm(range(0, len(todo), args.batch_size), disable=global_rank != 0):
+        batch_items = todo[start:start + args.batch_size]
+        num = len(batch_items)
+
+        if args.class_condition == 1:
+            c_tokens = torch.tensor([[cls + args.n_vision_words] for cls, _ in batch_items], dtype=torch.long, device=device)
+        else:
+            c_tokens = torch.full((num, 1), model.sos_token, dtype=torch.long, device=device)
+
+        if draft is not None:
+            if baseline_batches == 0:
+                # untimed warm-up of both samplers (CUDA context, allocator growth, autotune)
+                model.sample(None, c_tokens, steps=256, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+                model.sample_speculative(None, c_tokens, steps=256, draft=draft, k=args.spec_k,
+                                         temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+            if baseline_batches < args.spec_baseline_batches:
+                # warm plain autoregressive batches for the speedup estimate
+                torch.cuda.synchronize()
+                start_time = time.time()
+                model.sample(None, c_tokens, steps=256, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+                torch.cuda.synchronize()
+                baseline_seconds += time.time() - start_time
+                baseline_tokens += num * 256
+                baseline_batches += 1
+            sample_indices, stats = model.sample_speculative(None, c_tokens, steps=256, draft=draft, k=args.spec_k,
+                                                             temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+            spec_stats.update(stats)
+        else:
+            sample_indices = model.sample(None, c_tokens, steps=256, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                                          cfg_scale=args.cfg_scale, cfg_schedule=args.cfg_schedule)
+
+        token_freq += torch.bincount(sample_indices.reshape(-1), minlength=args.n_vision_words)
+
+        x_generation = model.z_to_image(sample_indices)
+        # PNG encoding runs in the writer threads while the next batch is sampled
+        writer.submit(x_generation, [image_name(cls, idx) for cls, idx in batch_items])
+    writer.close()
+
+    if args.distributed:
+        torch.distributed.all_reduce(token_freq)
+    if global_rank == 0:
+        np.save(os.path.join(args.output_dir, "token_freq.npy"), token_freq.cpu().numpy())
+    if draft is not None and baseline_tokens > 0:
+        baseline_ms = 1000.0 * baseline_seconds / baseline_tokens
+        summary = spec_stats.summary()
+        summary["speedup"] = baseline_ms / max(summary["ms_per_token"], 1e-8)
+        print("Speculative decoding (rank %d): acceptance %.3f, %.2f tokens per target call, %.3f ms/token, speedup x%.2f" % (
+            global_rank, summary["acceptance_rate"], summary["tokens_per_target_call"], summary["ms_per_token"], summary["speedup"]))
+        with open(os.path.join(args.output_dir, "speculative_rank%d.json" % global_rank), "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.distributed:
+        torch.distributed.barrier()
+    if global_rank == 0:
+        from cleanfid import fid
+        fid_value = fid.compute_fid(generation_save_dir, args.imagenet_path + "/train", mode="clean")
+
+        efficient_token = np.sum(np.array(token_freq.cpu().data) != 0)
+        with open(os.path.join(args.output_dir, "recons.csv"), 'a') as f:
+            f.write("FID, Effective_Tokens \n")
+            f.write("%.4f, %d \n"%(fid_value, efficient_token))
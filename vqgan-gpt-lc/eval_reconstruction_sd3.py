@@ -413,6 +413,9 @@ def get_args_parser():
     
     parser.add_argument("--dataset", type=str, default="ffhq", help="")
 
+    parser.add_argument("--compile", type=str, default="none", choices=["none", "default", "reduce-overhead", "max-autotune"], help="torch.compile mode for encode/decode")
+    parser.add_argument("--cuda_graph", type=int, default=0, help="Capture encode/decode in static-shape CUDA graphs")
+
     return parser
 
 
@@ -512,6 +515,8 @@ def main(args):
     else:
         sd = torch.load(os.path.join(args.stage_1_ckpt), map_location="cpu")["state_dict"]
     missing, unexpected = model.load_state_dict(sd, strict=False)
+    if args.compile != "none" or args.cuda_graph:
+        model.enable_compile(args.compile, cuda_graph=args.cuda_graph == 1)
     print(missing, unexpected)
 
     eff_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import time
+
+import albumentations
+import numpy as np
+import pyiqa
+import torch
+import yaml
+from diffusers.models import AutoencoderKL
+from PIL import Image
+from torch.utils.data import Dataset
+
+from models.selftok.image_tokenizer import ImageTokenizer
+
+####Quality / latency curves of the selftok tokenizer reconstruction for several samplers.
+####--solvers is a comma separated list of solver:steps (solvers of RectifiedFlow.sample_ode,
+####adaptive:steps sets the initial step size), e.g. euler:100,euler:20,heun:8,dpm++2m:10,adaptive:10;
+####student:steps decodes with the consistency-distilled student (tokenizers trained with w_cm != 0)
+####Every setting decodes the same images from the same noise.
+####--from_tokens 1 decodes from the token indices (ImageTokenizer.encode / decode) instead of ImageTokenizer.rec.
+
+
+class ImageDirDataset(Dataset):
+    def __init__(self, data_root, image_size, num_images):
+        self.paths = []
+        for root, _, files in sorted(os.walk(data_root)):
+            for name in sorted(files):
+                if name.lower().endswith((".jpeg", ".jpg", ".png")):
+                    self.paths.append(os.path.join(root, name))
+        self.paths = self.paths[:num_images]
+        self.preprocessor = albumentations.Compose([
+            albumentations.SmallestMaxSize(max_size=image_size),
+            albumentations.CenterCrop(height=image_size, width=image_size),
+        ])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        image = np.array(Image.open(self.paths[index]).convert("RGB")).astype(np.uint8)
+        image = self.preprocessor(image=image)["image"]
+        image = (image / 127.5 - 1.0).astype(np.float32)
+        return image.transpose(2, 0, 1)
+
+
+def parse_solvers(spec):
+    settings = []
+    for item in spec.split(","):
+        solver, steps = item.split(":")
+        settings.append((solver, int(steps)))
+    return settings
+
+
+def main(args):
+    device = torch.device(args.device)
+    with open(args.tokenizer_config) as f:
+        tokenizer_cfg = yaml.safe_load(f)
+    tokenizer = ImageTokenizer(**tokenizer_cfg)
+    state_dict = torch.load(args.tokenizer_ckpt, map_location="cpu")
+    state_dict = state_dict.get("state_dict", state_dict)
+    missing, unexpected = tokenizer.load_state_dict(state_dict, strict=False)
+    print(missing, unexpected)
+    tokenizer.vae = AutoencoderKL.from_pretrained(args.vae_path)
+    tokenizer.to(device)
+    tokenizer.set_eval()
+    tokenizer.vae.eval()
+
+    dataset = ImageDirDataset(args.imagenet_path, args.image_size, args.num_images)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False)
+    psnr_computer = pyiqa.create_metric('psnr', test_y_channel=True, color_space='ycbcr', device=device)
+    lpips_computer = pyiqa.create_metric('lpips', device=device)
+
+    settings = parse_solvers(args.solvers)
+    for solver, _ in settings:
+        # the gaussian diffusion models only have the respaced DDPM sampler (reported as euler)
+        assert solver in ("euler", "student") or tokenizer.model_name == 'MMDiT_XL', \
+            "solver %s needs a rectified flow tokenizer (MMDiT_XL), got %s" % (solver, tokenizer.model_name)
+
+    results = []
+    for solver, steps in settings:
+        psnr_total, lpips_total, nfe_total, seconds, num_images = 0.0, 0.0, 0, 0.0, 0
+        for batch_idx, images in enumerate(data_loader):
+            images = images.to(device)
+            with torch.no_grad():
+                x_0 = tokenizer.get_vae_latent(images)
+            if args.from_tokens:
+                _, indices = tokenizer.encode(x_0)
+            torch.manual_seed(args.seed + batch_idx)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.time()
+            use_student = solver == "student"
+            solver_name = None if use_student else solver
+            if args.from_tokens:
+                xrec = tokenizer.decode(indices, x_0.shape, num_steps=steps, solver=solver_name, use_student=use_student)
+            else:
+                xrec = tokenizer.rec(x_0, num_steps=steps, solver=solver_name, use_student=use_student)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            seconds += time.time() - start_time
+            nfe_total += getattr(tokenizer.diffusion, "nfe", steps)
+
+            x, xrec = (images + 1) / 2, (xrec.clamp(-1, 1) + 1) / 2
+            psnr_total += psnr_computer(x, xrec).sum().item()
+            lpips_total += lpips_computer(x, xrec).sum().item()
+            num_images += images.shape[0]
+
+        result = {
+            "solver": solver,
+            "steps": steps,
+            "nfe": nfe_total / max(len(data_loader), 1),
+            "psnr": psnr_total / num_images,
+            "lpips": lpips_total / num_images,
+            "ms_per_image": 1000.0 * seconds / num_images,
+        }
+        print("%s:%d  nfe %.1f  psnr %.3f  lpips %.4f  %.1f ms/image" % (
+            solver, steps, result["nfe"], result["psnr"], result["lpips"], result["ms_per_image"]))
+        results.append(result)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "selftok_solvers.json"), "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Selftok reconstruction solver curves")
+    parser.add_argument("--tokenizer_config", type=str, required=True, help="yaml with the ImageTokenizer arguments")
+    parser.add_argument("--tokenizer_ckpt", type=str, required=True)
+    parser.add_argument("--vae_path", type=str, required=True, help="diffusers AutoencoderKL")
+    parser.add_argument("--imagenet_path", type=str, required=True, help="directory of validation images")
+    parser.add_argument("--solvers", type=str, default="euler:100,euler:20,heun:8,heun:10,dpm++2m:10,dpm++2m:20,adaptive:10")
+    parser.add_argument("--num_images", type=int, default=1000)
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=25)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--from_tokens", type=int, default=0, help="decode from the token indices instead of the encoder features")
+    parser.add_argument("--output_dir", type=str, default="")
+    args = parser.parse_args()
+    main(args)
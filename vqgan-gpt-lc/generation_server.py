@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import json
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from eval_generation import get_args_parser
+from models.generation_engine import GenerationEngine, AsyncGenerationEngine
+from models.llama import LLaMA
+from models.mingpt import GPT
+from models.models_gpt import VQGANTransformer, transformer_size
+
+####Local class-conditional generation engine with continuous batching.
+####Replays --num_requests requests (Poisson arrivals at --arrival_rate, 0 = all at once)
+####through the asyncio API and reports throughput / latency.
+####--tiny runs a randomly initialized transformer of size --gpt_type without the VQ decoder (CPU friendly).
+
+
+def build_engine(args, device):
+    if args.tiny:
+        transformer_config = {
+            "vocab_size": args.n_vision_words + args.n_class,
+            "block_size": args.num_tokens + 1,
+            **transformer_size(args.gpt_type),
+        }
+        transformer = LLaMA(**transformer_config) if "llama" in args.gpt_type else GPT(**transformer_config)
+        transformer = transformer.to(device)
+        decode_fn = None
+    else:
+        model = VQGANTransformer(args).to(device)
+        state_dict = torch.load(args.stage_2_ckpt, map_location="cpu")
+        if "gpt_checkpoint_last" in args.stage_2_ckpt: #deepspeed save
+            state_dict = state_dict["module"]
+        model.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()}, strict=True)
+        model.eval()
+        if args.compile != "none" or args.cuda_graph:
+            model.enable_compile(args.compile, cuda_graph=args.cuda_graph == 1)
+        transformer = model.transformer
+        decode_fn = model.z_to_image
+    return GenerationEngine(transformer, args.n_vision_words, max_batch_size=args.max_batch_size,
+                            max_seq_len=args.num_tokens + 1, decode_fn=decode_fn,
+                            decode_batch_size=args.decode_batch_size, device=device)
+
+
+async def replay(engine, args):
+    async_engine = AsyncGenerationEngine(engine)
+    tasks = []
+    for i in range(args.num_requests):
+        cls = np.random.randint(args.n_class)
+        cond_token = cls + args.n_vision_words if args.class_condition == 1 else args.sos_token
+        tasks.append(asyncio.ensure_future(async_engine.generate(
+            cond_token, args.num_tokens, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)))
+        if args.arrival_rate > 0:
+            await asyncio.sleep(np.random.exponential(1.0 / args.arrival_rate))
+    return await asyncio.gather(*tasks)
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    engine = build_engine(args, device)
+
+    requests = asyncio.run(replay(engine, args))
+    metrics = engine.metrics()
+    print("Generated %d images: %.1f tokens/s, %.2f images/s, latency p50 %.2fs p95 %.2fs, batch occupancy %.2f" % (
+        len(requests), metrics["tokens_per_s"], metrics["images_per_s"], metrics["latency_p50_s"],
+        metrics["latency_p95_s"], metrics["mean_batch_occupancy"]))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "generation_server_metrics.json"), "w") as f:
+            json.dump(metrics, f, indent=2)
+        if args.save_images:
+            for r in requests:
+                if r.image is not None:
+                    Image.fromarray(r.image).save(os.path.join(args.output_dir, "request_%d.png" % r.request_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Continuous-batching generation engine", parents=[get_args_parser()])
+    parser.add_argument("--tiny", action="store_true", help="Random transformer, no VQ decoder (CPU test)")
+    parser.add_argument("--num_requests", type=int, default=256)
+    parser.add_argument("--arrival_rate", type=float, default=0.0, help="Requests per second, 0 submits everything at once")
+    parser.add_argument("--num_tokens", type=int, default=256)
+    parser.add_argument("--max_batch_size", type=int, default=64, help="K/V cache slots (sequences in flight)")
+    parser.add_argument("--decode_batch_size", type=int, default=16, help="Images per VQ decode call")
+    parser.add_argument("--save_images", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
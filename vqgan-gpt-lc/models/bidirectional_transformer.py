@@ -42,7 +42,7 @@ class Attention(nn.Module):
 
     def forward(self, x):
         q, k, v = self.q(x), self.k(x), self.v(x)
-        qk = torch.softmax(q @ torch.transpose(k, 1, 2) / self.norm, dim=1)
+        qk = torch.softmax(q @ torch.transpose(k, 1, 2) / self.norm, dim=-1)
         qk = self.dropout(qk)
         attn = torch.matmul(qk, v)
         return attn
@@ -178,6 +178,9 @@ class BidirectionalTransformer(nn.Module):
     def get_block_size(self):
         return self.block_size
 
+    def get_output_head(self):
+        return self.head
+
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
@@ -187,7 +190,7 @@ class BidirectionalTransformer(nn.Module):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
-    def forward(self, idx, embeddings=None):
+    def forward(self, idx, embeddings=None, return_hidden=False):
         token_embeddings = self.tok_emb(idx)  # each index maps to a (learnable) vector
 
         if embeddings is not None:  # prepend explicit embeddings
@@ -199,6 +202,8 @@ class BidirectionalTransformer(nn.Module):
         x = self.drop(token_embeddings + position_embeddings)
         x = self.blocks(x)
         x = self.ln_f(x)
+        if return_hidden:
+            return x
         logits = self.head(x)
 
         return logits
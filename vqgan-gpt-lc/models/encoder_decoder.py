@@ -5,6 +5,7 @@ import torch.nn as nn
 import numpy as np
 from einops import rearrange, repeat
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class CrossAttention(nn.Module):
@@ -47,6 +48,13 @@ def nonlinearity(x):
     return x*torch.sigmoid(x)
 
 
+def checkpoint_forward(module, use_checkpoint, *args):
+    # recompute the activations of `module` in backward instead of keeping them
+    if use_checkpoint and module.training and torch.is_grad_enabled():
+        return checkpoint(module, *args, use_reentrant=False)
+    return module(*args)
+
+
 def Normalize(in_channels):
     return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
@@ -249,7 +257,7 @@ class InterpolateUpsample(nn.Module):
 class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, z_channels, double_z=True, **ignore_kwargs):
+                 resolution, z_channels, double_z=True, ckpt_resolutions=(), ckpt_mid=False, **ignore_kwargs):
         super().__init__()
         self.ch = ch
         self.temb_ch = 0
@@ -268,7 +276,11 @@ class Encoder(nn.Module):
         curr_res = resolution
         in_ch_mult = (1,)+tuple(ch_mult)
         self.down = nn.ModuleList()
+        # activation checkpointing per resolution (same convention as attn_resolutions)
+        self.ckpt_levels = []
+        self.ckpt_mid = ckpt_mid
         for i_level in range(self.num_resolutions):
+            self.ckpt_levels.append(curr_res in ckpt_resolutions)
             block = nn.ModuleList()
             attn = nn.ModuleList()
             block_in = ch*in_ch_mult[i_level]
@@ -318,13 +330,14 @@ class Encoder(nn.Module):
         # downsampling
         hs = [self.conv_in(x)]
         for i_level in range(self.num_resolutions):
+            use_ckpt = self.ckpt_levels[i_level]
             for i_block in range(self.num_res_blocks):
-                h = self.down[i_level].block[i_block](hs[-1], temb)
+                h = checkpoint_forward(self.down[i_level].block[i_block], use_ckpt, hs[-1], temb)
                 if len(self.down[i_level].attn) > 0:
-                    h = self.down[i_level].attn[i_block](h)
+                    h = checkpoint_forward(self.down[i_level].attn[i_block], use_ckpt, h)
                 hs.append(h)
             if i_level != self.num_resolutions-1:
-                hs.append(self.down[i_level].downsample(hs[-1]))
+                hs.append(checkpoint_forward(self.down[i_level].downsample, use_ckpt, hs[-1]))
 
         #for i, a in enumerate(hs):
         #    print(i, np.unique(a.cpu().data))
@@ -332,9 +345,9 @@ class Encoder(nn.Module):
         h = hs[-1]
         #print(len(hs))
         #print("2", np.unique(h.cpu().data))
-        h = self.mid.block_1(h, temb)
-        h = self.mid.attn_1(h)
-        h = self.mid.block_2(h, temb)
+        h = checkpoint_forward(self.mid.block_1, self.ckpt_mid, h, temb)
+        h = checkpoint_forward(self.mid.attn_1, self.ckpt_mid, h)
+        h = checkpoint_forward(self.mid.block_2, self.ckpt_mid, h, temb)
 
         # end
         h = self.norm_out(h)
@@ -347,7 +360,7 @@ class Encoder(nn.Module):
 class Decoder_Cross(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, z_channels, give_pre_end=False, **ignorekwargs):
+                 resolution, z_channels, give_pre_end=False, ckpt_resolutions=(), ckpt_mid=False, **ignorekwargs):
         super().__init__()
         self.ch = ch
         self.temb_ch = 0
@@ -388,7 +401,11 @@ class Decoder_Cross(nn.Module):
 
         # upsampling
         self.up = nn.ModuleList()
+        # activation checkpointing per resolution (same convention as attn_resolutions)
+        self.ckpt_levels = [False] * self.num_resolutions
+        self.ckpt_mid = ckpt_mid
         for i_level in reversed(range(self.num_resolutions)):
+            self.ckpt_levels[i_level] = curr_res in ckpt_resolutions
             block = nn.ModuleList()
             attn = nn.ModuleList()
             block_out = ch*ch_mult[i_level]
@@ -428,27 +445,28 @@ class Decoder_Cross(nn.Module):
         h = self.conv_in(z)
 
         # middle
-        h = self.mid.block_1(h, temb)
-        h = self.mid.attn_1(h)
+        h = checkpoint_forward(self.mid.block_1, self.ckpt_mid, h, temb)
+        h = checkpoint_forward(self.mid.attn_1, self.ckpt_mid, h)
 
         ##CrossAtt
         b, c, height, width = h.shape
         h = h.view(b, c, -1).permute(0, 2, 1).contiguous()
-        h = self.mid.cross_attn_1(h, g)
+        h = checkpoint_forward(self.mid.cross_attn_1, self.ckpt_mid, h, g)
 
         h = h.permute(0, 2, 1).view(b, c, height, width)
-        h = self.mid.block_2(h, temb)
+        h = checkpoint_forward(self.mid.block_2, self.ckpt_mid, h, temb)
         ###
 
         # upsampling
         for i_level in reversed(range(self.num_resolutions)):
+            use_ckpt = self.ckpt_levels[i_level]
             for i_block in range(self.num_res_blocks+1):
-                h = self.up[i_level].block[i_block](h, temb)
+                h = checkpoint_forward(self.up[i_level].block[i_block], use_ckpt, h, temb)
                 if len(self.up[i_level].attn) > 0:
-                    h = self.up[i_level].attn[i_block](h)
+                    h = checkpoint_forward(self.up[i_level].attn[i_block], use_ckpt, h)
 
             if i_level != 0:
-                h = self.up[i_level].upsample(h)
+                h = checkpoint_forward(self.up[i_level].upsample, use_ckpt, h)
             
         # end
         if self.give_pre_end:
@@ -463,7 +481,7 @@ class Decoder_Cross(nn.Module):
 class Decoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, z_channels, give_pre_end=False, **ignorekwargs):
+                 resolution, z_channels, give_pre_end=False, ckpt_resolutions=(), ckpt_mid=False, **ignorekwargs):
         super().__init__()
         self.ch = ch
         self.temb_ch = 0
@@ -502,7 +520,11 @@ class Decoder(nn.Module):
 
         # upsampling
         self.up = nn.ModuleList()
+        # activation checkpointing per resolution (same convention as attn_resolutions)
+        self.ckpt_levels = [False] * self.num_resolutions
+        self.ckpt_mid = ckpt_mid
         for i_level in reversed(range(self.num_resolutions)):
+            self.ckpt_levels[i_level] = curr_res in ckpt_resolutions
             block = nn.ModuleList()
             attn = nn.ModuleList()
             block_out = ch*ch_mult[i_level]
@@ -541,18 +563,19 @@ class Decoder(nn.Module):
         h = self.conv_in(z)
 
         # middle
-        h = self.mid.block_1(h, temb)
-        h = self.mid.attn_1(h)
-        h = self.mid.block_2(h, temb)
+        h = checkpoint_forward(self.mid.block_1, self.ckpt_mid, h, temb)
+        h = checkpoint_forward(self.mid.attn_1, self.ckpt_mid, h)
+        h = checkpoint_forward(self.mid.block_2, self.ckpt_mid, h, temb)
 
         # upsampling
         for i_level in reversed(range(self.num_resolutions)):
+            use_ckpt = self.ckpt_levels[i_level]
             for i_block in range(self.num_res_blocks+1):
-                h = self.up[i_level].block[i_block](h, temb)
+                h = checkpoint_forward(self.up[i_level].block[i_block], use_ckpt, h, temb)
                 if len(self.up[i_level].attn) > 0:
-                    h = self.up[i_level].attn[i_block](h)
+                    h = checkpoint_forward(self.up[i_level].attn[i_block], use_ckpt, h)
             if i_level != 0:
-                h = self.up[i_level].upsample(h)
+                h = checkpoint_forward(self.up[i_level].upsample, use_ckpt, h)
         # end
         if self.give_pre_end:
             return h
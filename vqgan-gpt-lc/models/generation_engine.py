@@ -0,0 +1,224 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from models.sampler import Sampler
+
+
+class GenerationRequest:
+    """One image: a condition token (class or sos) and its sampling parameters."""
+    def __init__(self, request_id, cond_token, num_tokens=256, temperature=1.0, top_k=None, top_p=None):
+        self.request_id = request_id
+        self.cond_token = cond_token
+        self.num_tokens = num_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+        self.slot = None
+        self.position = 0  # tokens already in the K/V cache
+        self.tokens = None  # (num_tokens,) generated image tokens
+        self.image = None  # (H, W, 3) uint8 when a decode_fn is set
+        self.arrival_time = time.time()
+        self.start_time = None
+        self.tokens_time = None
+        self.finish_time = None
+
+    @property
+    def done(self):
+        return self.finish_time is not None
+
+
+class GenerationEngine:
+    """
+    Continuous-batching token generation over a fixed pool of K/V cache slots.
+    Requests wait in a FIFO queue and join the running batch as soon as a slot
+    is free; every step decodes one token for all running sequences, each at
+    its own position (transformer.forward_decode). Finished token sequences are
+    decoded to images by decode_fn (e.g. VQGANTransformer.z_to_image) in
+    batches of decode_batch_size. Works on CPU with a small transformer.
+    """
+    def __init__(self, transformer, n_vision_words, max_batch_size=32, max_seq_len=257, decode_fn=None,
+                 decode_batch_size=16, device="cuda"):
+        self.transformer = transformer.eval()
+        self.n_vision_words = n_vision_words
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.decode_fn = decode_fn
+        self.decode_batch_size = decode_batch_size
+        self.device = torch.device(device)
+
+        self.transformer.setup_caches(max_batch_size, max_seq_len, device=self.device)
+        # device-side state of every slot: last token and its position
+        self.last_tokens = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self.out = torch.zeros(max_batch_size, max_seq_len, dtype=torch.long, device=self.device)
+
+        self.lock = threading.Lock()
+        self.waiting = deque()
+        self.running = {}  # slot -> request
+        self.free_slots = list(range(max_batch_size))
+        self.to_decode = []
+        self.batch = None  # (slots, positions, sampler) of the current running set
+        self.next_id = 0
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.num_steps = 0
+        self.num_tokens = 0
+        self.occupancy = 0
+        self.finished = []
+        self.metrics_start = time.time()
+
+    def submit(self, cond_token, num_tokens=256, temperature=1.0, top_k=None, top_p=None):
+        assert num_tokens + 1 <= self.max_seq_len, "request longer than the cache slots"
+        with self.lock:
+            request = GenerationRequest(self.next_id, cond_token, num_tokens, temperature, top_k, top_p)
+            self.next_id += 1
+            self.waiting.append(request)
+        return request
+
+    def has_work(self):
+        return len(self.waiting) > 0 or len(self.running) > 0 or len(self.to_decode) > 0
+
+    def _admit(self):
+        admitted = []
+        with self.lock:
+            while len(self.waiting) > 0 and len(self.free_slots) > 0:
+                request = self.waiting.popleft()
+                request.slot = self.free_slots.pop(0)
+                request.position = 0
+                request.start_time = time.time()
+                self.running[request.slot] = request
+                admitted.append(request)
+        if len(admitted) > 0:
+            slots = torch.tensor([r.slot for r in admitted], device=self.device)
+            self.last_tokens[slots] = torch.tensor([r.cond_token for r in admitted], device=self.device)
+            self.batch = None
+        return admitted
+
+    def _build_batch(self):
+        requests = [self.running[s] for s in sorted(self.running.keys())]
+        slots = torch.tensor([r.slot for r in requests], device=self.device)
+        positions = torch.tensor([r.position for r in requests], device=self.device)
+        top_k = [r.top_k if r.top_k is not None else self.n_vision_words for r in requests]
+        top_p = [r.top_p if r.top_p is not None else 1.0 for r in requests]
+        sampler = Sampler(
+            temperature=[r.temperature for r in requests],
+            top_k=top_k,
+            top_p=None if min(top_p) >= 1.0 else top_p,
+        )
+        self.batch = (requests, slots, positions, sampler)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        if self.batch is None:
+            self._build_batch()
+        requests, slots, positions, sampler = self.batch
+        hidden, _ = self.transformer.forward_decode(self.last_tokens[slots].unsqueeze(1), slots, positions, return_hidden=True)
+        logits = F.linear(hidden[:, -1], self.transformer.get_output_head().weight[:self.n_vision_words])
+        ix = sampler(logits)[:, 0]
+        self.last_tokens[slots] = ix
+        self.out[slots, positions] = ix
+        positions += 1
+
+        self.num_steps += 1
+        self.num_tokens += len(requests)
+        self.occupancy += len(requests)
+        finished = []
+        for r in requests:
+            r.position += 1
+            if r.position == r.num_tokens:
+                finished.append(r)
+        for r in finished:
+            r.tokens = self.out[r.slot, :r.num_tokens].clone()
+            r.tokens_time = time.time()
+            with self.lock:
+                del self.running[r.slot]
+                self.free_slots.append(r.slot)
+            self.to_decode.append(r)
+        if len(finished) > 0:
+            self.batch = None
+
+    @torch.no_grad()
+    def _decode_images(self, force=False):
+        completed = []
+        while len(self.to_decode) >= self.decode_batch_size or (force and len(self.to_decode) > 0):
+            batch, self.to_decode = self.to_decode[:self.decode_batch_size], self.to_decode[self.decode_batch_size:]
+            if self.decode_fn is not None:
+                # group by length, z_to_image needs one token grid per call
+                for num_tokens in sorted(set(r.num_tokens for r in batch)):
+                    group = [r for r in batch if r.num_tokens == num_tokens]
+                    images = self.decode_fn(torch.stack([r.tokens for r in group]))
+                    images = ((images.clamp(-1, 1) + 1) * 127.5).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+                    for r, image in zip(group, images):
+                        r.image = image
+            for r in batch:
+                r.tokens = r.tokens.cpu()
+                r.finish_time = time.time()
+            completed.extend(batch)
+        self.finished.extend(completed)
+        return completed
+
+    def step(self):
+        """Admit waiting requests, decode one token for the running batch, decode finished images.
+        Returns the requests completed in this step."""
+        self._admit()
+        if len(self.running) > 0:
+            self._decode_step()
+        # decode partial image batches when nothing else is left to overlap with
+        return self._decode_images(force=len(self.running) == 0 and len(self.waiting) == 0)
+
+    def run_until_idle(self):
+        completed = []
+        while self.has_work():
+            completed.extend(self.step())
+        return completed
+
+    def metrics(self):
+        elapsed = max(time.time() - self.metrics_start, 1e-8)
+        latency = np.array([r.finish_time - r.arrival_time for r in self.finished]) if len(self.finished) > 0 else np.zeros(1)
+        queue_wait = np.array([r.start_time - r.arrival_time for r in self.finished]) if len(self.finished) > 0 else np.zeros(1)
+        return {
+            "tokens_per_s": self.num_tokens / elapsed,
+            "images_per_s": len(self.finished) / elapsed,
+            "mean_batch_occupancy": self.occupancy / max(self.num_steps, 1) / self.max_batch_size,
+            "latency_p50_s": float(np.percentile(latency, 50)),
+            "latency_p95_s": float(np.percentile(latency, 95)),
+            "queue_wait_p50_s": float(np.percentile(queue_wait, 50)),
+            "waiting": len(self.waiting),
+            "running": len(self.running),
+        }
+
+
+class AsyncGenerationEngine:
+    """
+    asyncio front end: generate() awaits the result of one request while a
+    background task steps the engine in a worker thread, so the event loop
+    stays responsive during the GPU work.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.futures = {}
+        self.task = None
+
+    async def generate(self, cond_token, num_tokens=256, temperature=1.0, top_k=None, top_p=None):
+        loop = asyncio.get_running_loop()
+        request = self.engine.submit(cond_token, num_tokens, temperature, top_k, top_p)
+        future = loop.create_future()
+        self.futures[request.request_id] = future
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.engine.has_work():
+            completed = await loop.run_in_executor(None, self.engine.step)
+            for request in completed:
+                future = self.futures.pop(request.request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(request)
@@ -48,6 +48,8 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
 
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
+    if freqs_cis.ndim == ndim:  # per-row positions, already (bsz, 1, 1, head_dim // 2)
+        return freqs_cis
     assert 0 <= 1 < ndim
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
@@ -79,8 +81,21 @@ class Attention(nn.Module):
         self.wv = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
         self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
 
+        self.cache_k = None
+        self.cache_v = None
+
+    def setup_cache(self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype, device: torch.device):
+        shape = (max_batch_size, max_seq_len, self.n_local_heads, self.head_dim)
+        self.cache_k = torch.zeros(shape, dtype=dtype, device=device)
+        self.cache_v = torch.zeros(shape, dtype=dtype, device=device)
+
+    def clear_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+
     def forward(
-        self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], adapter=None
+        self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], adapter=None,
+        use_cache: bool = False, slots: Optional[torch.Tensor] = None, is_causal: bool = False,
     ):
 
         bsz, seqlen, _ = x.shape
@@ -91,18 +106,27 @@ class Attention(nn.Module):
         xv = xv.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
 
-        keys = xk
-        values = xv
+        if use_cache and slots is not None:
+            # one token per row, each at its own position (start_pos tensor) of its own cache slot
+            self.cache_k[slots, start_pos] = xk[:, 0]
+            self.cache_v[slots, start_pos] = xv[:, 0]
+            keys = self.cache_k[slots]
+            values = self.cache_v[slots]
+        elif use_cache:
+            # write the new positions, attend over everything cached so far
+            self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
+            self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
+            keys = self.cache_k[:bsz, : start_pos + seqlen]
+            values = self.cache_v[:bsz, : start_pos + seqlen]
+        else:
+            keys = xk
+            values = xv
 
         xq = xq.transpose(1, 2)
         keys = keys.transpose(1, 2)
         values = values.transpose(1, 2)
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        if mask is not None:
-            scores = scores + mask  # (bs, n_local_heads, slen, cache_len + slen)
-
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, slen, head_dim)
+        # mask: additive (bs or 1, 1, slen, cache_len + slen); is_causal: plain causal attention without a mask tensor
+        output = F.scaled_dot_product_attention(xq, keys, values, attn_mask=mask, is_causal=is_causal and mask is None)
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
 
         return self.wo(output)
@@ -139,10 +163,12 @@ class TransformerBlock(nn.Module):
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
 
     def forward(
-        self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], adapter=None
+        self, x: torch.Tensor, start_pos: int, freqs_cis: torch.Tensor, mask: Optional[torch.Tensor], adapter=None,
+        use_cache: bool = False, slots: Optional[torch.Tensor] = None, is_causal: bool = False,
     ):
 
-        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, adapter)
+        h = x + self.attention.forward(self.attention_norm(x), start_pos, freqs_cis, mask, adapter, use_cache=use_cache, slots=slots,
+                                       is_causal=is_causal)
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
 
@@ -178,26 +204,100 @@ class LLaMA(nn.Module):
 
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
 
-        self.freqs_cis = precompute_freqs_cis(self.params.dim // self.params.n_heads, self.params.max_seq_len * 2)  
+        # device-resident rotary table, moved with the module but not saved in checkpoints
+        self.register_buffer("freqs_cis", precompute_freqs_cis(self.params.dim // self.params.n_heads, self.params.max_seq_len * 2), persistent=False)
+        self.mask_cache = {}
         self.output = nn.Linear(params.dim, params.vocab_size, bias=False) #Vision Output  
     
 
-    def forward(self, labels, embeddings=None):
+    def get_output_head(self):
+        return self.output
+
+    def causal_mask(self, seqlen: int, start_pos: int, dtype: torch.dtype, device: torch.device):
+        # additive mask of seqlen new tokens over start_pos cached ones, built once per (shape, dtype, device)
+        key = (seqlen, start_pos, dtype, device)
+        if key not in self.mask_cache:
+            mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=device)
+            mask = torch.triu(mask, diagonal=0 + 1)
+            # cached positions are all visible to the new tokens
+            mask = torch.cat([torch.zeros((1, 1, seqlen, start_pos), device=device), mask], dim=-1).to(dtype)
+            self.mask_cache[key] = mask
+        return self.mask_cache[key]
+
+    def forward(self, labels, embeddings=None, return_hidden=False, position_ids=None, attn_mask=None):
         
         _bsz, seqlen = labels.shape
         h = self.tok_embeddings(labels)
         if embeddings is not None:  # prepend explicit embeddings
             token_embeddings = torch.cat((embeddings, token_embeddings), dim=1)
         ###LLaMA Layers w/o Adapter
-        freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = freqs_cis[:seqlen]
-        mask = None
-        mask = torch.full((1, 1, seqlen, seqlen), float("-inf"), device=h.device)
-        mask = torch.triu(mask, diagonal=0 + 1).type_as(h)
         start_pos = 0
+        if attn_mask is not None:
+            # packed sequences: (bsz, 1, seqlen, seqlen) bool per-document causal mask, positions restart per document
+            freqs_cis = self.freqs_cis[position_ids].unsqueeze(2)
+            for layer in self.layers:
+                h = layer(h, start_pos, freqs_cis, attn_mask)
+        else:
+            freqs_cis = self.freqs_cis[:seqlen]
+            for layer in self.layers:
+                h = layer(h, start_pos, freqs_cis, None, is_causal=True)
+        h = self.norm(h)
+        if return_hidden:  # final hidden states, the caller applies (part of) the head
+            return h, None
+        output = self.output(h)
+        return output, None
+    
+
+    def setup_caches(self, max_batch_size: int, max_seq_len: int, dtype: Optional[torch.dtype] = None, device=None):
+        """Allocate the per-layer K/V caches used by forward_inference."""
+        dtype = dtype if dtype is not None else self.output.weight.dtype
+        device = device if device is not None else self.output.weight.device
+        assert max_seq_len <= self.freqs_cis.shape[0]
+        for layer in self.layers:
+            layer.attention.setup_cache(max_batch_size, max_seq_len, dtype, device)
+
+    def clear_caches(self):
+        for layer in self.layers:
+            layer.attention.clear_cache()
+
+    @torch.no_grad()
+    def forward_inference(self, tokens: torch.Tensor, start_pos: int, return_hidden: bool = False):
+        """
+        Incremental forward over the K/V caches: call once with the prompt at
+        start_pos=0 (prefill), then with the newly sampled token(s) at
+        start_pos=number of tokens already cached (decode).
+        """
+        _bsz, seqlen = tokens.shape
+        h = self.tok_embeddings(tokens)
+        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
+        # single token: no mask; prefill: plain causal; several tokens after a cached prefix: cached mask
+        mask = None
+        if seqlen > 1 and start_pos > 0:
+            mask = self.causal_mask(seqlen, start_pos, h.dtype, h.device)
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, freqs_cis, mask, use_cache=True, is_causal=seqlen > 1 and start_pos == 0)
         h = self.norm(h)
+        if return_hidden:
+            return h, None
         output = self.output(h)
         return output, None
-    
\ No newline at end of file
+
+    @torch.no_grad()
+    def forward_decode(self, tokens: torch.Tensor, slots: torch.Tensor, positions: torch.Tensor, return_hidden: bool = False):
+        """
+        One decode step for independent sequences sharing the cache pool:
+        row i feeds tokens[i] (bsz, 1) at positions[i] of cache slot slots[i].
+        """
+        bsz = tokens.shape[0]
+        h = self.tok_embeddings(tokens)
+        freqs_cis = self.freqs_cis[positions].view(bsz, 1, 1, -1)
+        cache_len = self.layers[0].attention.cache_k.shape[1]
+        mask = torch.zeros((bsz, 1, 1, cache_len), device=h.device)
+        mask.masked_fill_(torch.arange(cache_len, device=h.device).view(1, 1, 1, -1) > positions.view(-1, 1, 1, 1), float("-inf"))
+        mask = mask.type_as(h)
+        for layer in self.layers:
+            h = layer(h, positions, freqs_cis, mask, use_cache=True, slots=slots)
+        h = self.norm(h)
+        if return_hidden:
+            return h, None
+        return self.output(h), None
@@ -0,0 +1,115 @@
+import math
+import torch
+import torch.nn.functional as F
+from models.models_gpt import VQGANTransformer
+from models.bidirectional_transformer import BidirectionalTransformer
+from models.sampler import Sampler
+
+
+def mask_schedule(r):
+    # fraction of tokens that stay masked at decoding progress r in [0, 1] (cosine schedule)
+    return torch.cos(r * math.pi / 2) if isinstance(r, torch.Tensor) else math.cos(r * math.pi / 2)
+
+
+class VQGANBidTransformer(VQGANTransformer):
+    """
+    MaskGIT-style masked token model on top of the VQ tokenizer.
+    Training masks a cosine-scheduled fraction of the image tokens and predicts
+    them bidirectionally; sampling decodes all tokens in a few parallel steps,
+    keeping the most confident predictions and re-masking the rest.
+    Sequence layout: [class (or sos) token, image tokens], vocabulary:
+    vision words, class tokens, one mask token.
+    """
+    def __init__(self, args):
+        self.mask_token_id = args.n_vision_words + args.n_class
+        super(VQGANBidTransformer, self).__init__(args)
+        self.null_token = None
+        self.num_iter = getattr(args, "maskgit_steps", 12)
+        self.choice_temperature = getattr(args, "maskgit_choice_temperature", 4.5)
+
+    def build_transformer(self, args):
+        transformer_config = {
+            "vocab_size": args.n_vision_words + args.n_class + 1,
+            "block_size": 257,
+            "n_layer": 24,
+            "n_head": 16,
+            "n_embd": 1024
+        }
+        return BidirectionalTransformer(**transformer_config)
+
+    def random_mask(self, indices):
+        bsz, seq_len = indices.shape
+        ratio = mask_schedule(torch.rand(bsz, device=indices.device))
+        num_mask = (ratio * seq_len).floor().clamp(min=1).long()
+        scores = torch.rand(bsz, seq_len, device=indices.device)
+        threshold = scores.sort(dim=-1).values.gather(-1, num_mask.unsqueeze(-1) - 1)
+        return scores <= threshold
+
+    def forward(self, x, c_indices=None):
+
+        with torch.no_grad():
+            _, indices = self.encode_to_z(x)
+
+        if c_indices is None:
+            c_indices = torch.ones(x.shape[0], 1, dtype=torch.long, device=indices.device) * self.sos_token
+
+        mask = self.random_mask(indices)
+        masked_indices = torch.where(mask, torch.full_like(indices, self.mask_token_id), indices)
+        hidden = self.transformer(torch.cat((c_indices, masked_indices), dim=1), return_hidden=True)[:, c_indices.shape[1]:]
+
+        # loss on the masked positions only, over the vision vocabulary
+        logits = self.vision_logits(hidden[mask])
+        target = indices[mask]
+        if self.args.label_smooth == 1:
+            loss = self.loss_computer(logits, target)
+        else:
+            loss = F.cross_entropy(logits, target)
+        return loss
+
+    def _sample_tokens(self, hidden, sampler, chunk_size):
+        # hidden (M, C) -> sampled ids (M,) and their log-probability (M,); chunked over the M positions
+        ids, log_probs = [], []
+        for start in range(0, hidden.shape[0], chunk_size):
+            logits = self.vision_logits(hidden[start:start + chunk_size]).float()
+            ix = sampler(logits)
+            log_probs.append((logits.gather(-1, ix) - logits.logsumexp(dim=-1, keepdim=True))[:, 0])
+            ids.append(ix[:, 0])
+        return torch.cat(ids), torch.cat(log_probs)
+
+    @torch.no_grad()
+    def sample(self, x, c, steps, temperature=1.0, top_k=100, top_p=None, generator=None, cfg_scale=1.0, cfg_schedule="constant",
+               num_iter=None, chunk_size=4096):
+        # x: known prefix tokens (or None), steps: number of tokens to generate, num_iter: parallel decoding steps
+        assert cfg_scale == 1.0, "classifier-free guidance is not supported for maskgit"
+        self.transformer.eval()
+        num_iter = self.num_iter if num_iter is None else num_iter
+        sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p, generator=generator)
+        bsz = c.shape[0]
+        prefix_len = 0 if x is None else x.shape[1]
+        ids = torch.full((bsz, prefix_len + steps), self.mask_token_id, dtype=torch.long, device=c.device)
+        if prefix_len > 0:
+            ids[:, :prefix_len] = x
+        # positions that are still masked, the same count for every sample
+        unknown = torch.arange(prefix_len, prefix_len + steps, device=c.device).unsqueeze(0).repeat(bsz, 1)
+
+        for t in range(num_iter):
+            hidden = self.transformer(torch.cat((c, ids), dim=1), return_hidden=True)[:, c.shape[1]:]
+            hidden = hidden.gather(1, unknown.unsqueeze(-1).expand(-1, -1, hidden.shape[-1]))
+            num_unknown = unknown.shape[1]
+            sampled, confidence = self._sample_tokens(hidden.reshape(bsz * num_unknown, -1), sampler, chunk_size)
+            sampled, confidence = sampled.view(bsz, num_unknown), confidence.view(bsz, num_unknown)
+            ids.scatter_(1, unknown, sampled)
+
+            num_mask = int(math.floor(mask_schedule((t + 1) / num_iter) * steps))
+            num_mask = min(max(num_mask, 0), num_unknown - 1)
+            if t == num_iter - 1 or num_mask == 0:
+                break
+            # re-mask the least confident predictions, gumbel noise annealed to zero over the steps
+            noise = torch.rand(confidence.shape, device=confidence.device, generator=generator)
+            gumbel = -torch.log(-torch.log(noise.clamp(min=1e-20)).clamp(min=1e-20))
+            confidence = confidence + self.choice_temperature * (1.0 - (t + 1) / num_iter) * gumbel
+            remask = confidence.argsort(dim=-1)[:, :num_mask]
+            unknown = unknown.gather(1, remask)
+            ids.scatter_(1, unknown, self.mask_token_id)
+
+        return ids
@@ -53,8 +53,19 @@ class CausalSelfAttention(nn.Module):
             mask[:config.n_unmasked, :config.n_unmasked] = 1
         self.register_buffer("mask", mask.view(1, 1, config.block_size, config.block_size))
         self.n_head = config.n_head
+        self.cache_k = None
+        self.cache_v = None
 
-    def forward(self, x, layer_past=None):
+    def setup_cache(self, max_batch_size, max_seq_len, dtype, device):
+        shape = (max_batch_size, self.n_head, max_seq_len, self.key.out_features // self.n_head)
+        self.cache_k = torch.zeros(shape, dtype=dtype, device=device)
+        self.cache_v = torch.zeros(shape, dtype=dtype, device=device)
+
+    def clear_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+
+    def forward(self, x, layer_past=None, start_pos=None, slots=None, attn_mask=None):
         B, T, C = x.size()
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -62,6 +73,30 @@ class CausalSelfAttention(nn.Module):
         q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
         v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)  # (B, nh, T, hs)
 
+        if slots is not None:
+            # one token per row, each at its own position (start_pos tensor) of its own cache slot
+            self.cache_k[slots, :, start_pos] = k[:, :, 0]
+            self.cache_v[slots, :, start_pos] = v[:, :, 0]
+            k, v = self.cache_k[slots], self.cache_v[slots]
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            future = torch.arange(k.shape[2], device=x.device).view(1, 1, 1, -1) > start_pos.view(-1, 1, 1, 1)
+            y = F.softmax(att.masked_fill(future, float('-inf')), dim=-1) @ v
+            y = y.transpose(1, 2).contiguous().view(B, T, C)
+            return self.resid_drop(self.proj(y)), None
+
+        if start_pos is not None:
+            # K/V cache: write the new positions, attend over everything cached so far
+            self.cache_k[:B, :, start_pos:start_pos + T] = k
+            self.cache_v[:B, :, start_pos:start_pos + T] = v
+            k = self.cache_k[:B, :, :start_pos + T]
+            v = self.cache_v[:B, :, :start_pos + T]
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            if T > 1:
+                att = att.masked_fill(self.mask[:, :, start_pos:start_pos + T, :start_pos + T] == 0, float('-inf'))
+            y = F.softmax(att, dim=-1) @ v
+            y = y.transpose(1, 2).contiguous().view(B, T, C)
+            return self.resid_drop(self.proj(y)), None
+
         present = torch.stack((k, v))
         if layer_past is not None:
             past_key, past_value = layer_past
@@ -70,7 +105,10 @@ class CausalSelfAttention(nn.Module):
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        if layer_past is None:
+        if attn_mask is not None:
+            # (B, 1, T, T) bool, e.g. per-document causal masks of packed sequences
+            att = att.masked_fill(~attn_mask, float('-inf'))
+        elif layer_past is None:
             att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float('-inf'))
 
         att = F.softmax(att, dim=-1)
@@ -98,12 +136,12 @@ class Block(nn.Module):
             nn.Dropout(config.resid_pdrop),
         )
 
-    def forward(self, x, layer_past=None, return_present=False):
+    def forward(self, x, layer_past=None, return_present=False, start_pos=None, slots=None, attn_mask=None):
         # TODO: check that training still works
         if return_present:
             assert not self.training
         # layer past: tuple of length two with B, nh, T, hs
-        attn, present = self.attn(self.ln1(x), layer_past=layer_past)
+        attn, present = self.attn(self.ln1(x), layer_past=layer_past, start_pos=start_pos, slots=slots, attn_mask=attn_mask)
 
         x = x + attn
         x = x + self.mlp(self.ln2(x))
@@ -139,6 +177,9 @@ class GPT(nn.Module):
     def get_block_size(self):
         return self.block_size
 
+    def get_output_head(self):
+        return self.head
+
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
@@ -148,7 +189,7 @@ class GPT(nn.Module):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
-    def forward(self, idx, embeddings=None):
+    def forward(self, idx, embeddings=None, return_hidden=False, position_ids=None, attn_mask=None):
         token_embeddings = self.tok_emb(idx)  # each index maps to a (learnable) vector
 
         if embeddings is not None:  # prepend explicit embeddings
@@ -156,14 +197,67 @@ class GPT(nn.Module):
 
         t = token_embeddings.shape[1]
         assert t <= self.block_size, "Cannot forward, model block size is exhausted."
-        position_embeddings = self.pos_emb[:, :t, :]  # each position maps to a (learnable) vector
+        if position_ids is not None:  # packed sequences, positions restart for every document
+            position_embeddings = self.pos_emb[0, position_ids]
+        else:
+            position_embeddings = self.pos_emb[:, :t, :]  # each position maps to a (learnable) vector
         x = self.drop(token_embeddings + position_embeddings)
-        x = self.blocks(x)
+        if attn_mask is not None:
+            for block in self.blocks:
+                x = block(x, attn_mask=attn_mask)
+        else:
+            x = self.blocks(x)
         x = self.ln_f(x)
+        if return_hidden:  # final hidden states, the caller applies (part of) the head
+            return x, None
         logits = self.head(x)
 
         return logits, None
 
+    def setup_caches(self, max_batch_size, max_seq_len, dtype=None, device=None):
+        """Allocate the per-layer K/V caches used by forward_inference."""
+        dtype = dtype if dtype is not None else self.head.weight.dtype
+        device = device if device is not None else self.head.weight.device
+        assert max_seq_len <= self.block_size
+        for block in self.blocks:
+            block.attn.setup_cache(max_batch_size, max_seq_len, dtype, device)
+
+    def clear_caches(self):
+        for block in self.blocks:
+            block.attn.clear_cache()
+
+    @torch.no_grad()
+    def forward_inference(self, idx, start_pos, return_hidden=False):
+        """
+        Incremental forward over the K/V caches, same protocol as LLaMA.forward_inference:
+        prefill at start_pos=0, then feed the new token(s) at start_pos=number of cached tokens.
+        Tokens cached beyond start_pos are ignored and overwritten, so rolling back is just
+        calling with a smaller start_pos.
+        """
+        t = idx.shape[1]
+        assert start_pos + t <= self.block_size, "Cannot forward, model block size is exhausted."
+        x = self.tok_emb(idx) + self.pos_emb[:, start_pos:start_pos + t, :]
+        for block in self.blocks:
+            x = block(x, start_pos=start_pos)
+        x = self.ln_f(x)
+        if return_hidden:
+            return x, None
+        return self.head(x), None
+
+    @torch.no_grad()
+    def forward_decode(self, idx, slots, positions, return_hidden=False):
+        """
+        One decode step for independent sequences sharing the cache pool:
+        row i feeds idx[i] (B, 1) at positions[i] of cache slot slots[i].
+        """
+        x = self.tok_emb(idx) + self.pos_emb[0, positions].unsqueeze(1)
+        for block in self.blocks:
+            x = block(x, start_pos=positions, slots=slots)
+        x = self.ln_f(x)
+        if return_hidden:
+            return x, None
+        return self.head(x), None
+
 
 
 
@@ -1,12 +1,18 @@
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from models.mingpt import GPT
 from models.models_vq import VQModel 
 from omegaconf import OmegaConf
 import yaml
 import os
 from models.llama import LLaMA
+from util.compile import build_compiled_function
+from util.packing import IGNORE_INDEX, build_document, pack_documents, document_causal_mask
+from models.sampler import Sampler
+from models.speculative import speculative_sample
 
 def load_config(config_path, display=False):
   config = OmegaConf.load(config_path)
@@ -37,6 +43,45 @@ class LabelSmoothing(nn.Module):
         loss = self.confidence * nll_loss + self.smoothing * smooth_loss
         return loss.mean()
 
+
+def _chunk_loss_sum(hidden, weight, target, smoothing):
+    logits = F.linear(hidden, weight).float()
+    lse = torch.logsumexp(logits, dim=-1)
+    nll_loss = lse - logits.gather(dim=-1, index=target.unsqueeze(1)).squeeze(1)
+    if smoothing > 0:
+        smooth_loss = lse - logits.mean(dim=-1)
+        return ((1.0 - smoothing) * nll_loss + smoothing * smooth_loss).sum()
+    return nll_loss.sum()
+
+
+def chunked_cross_entropy(hidden, weight, target, smoothing=0.0, chunk_size=4096):
+    """
+    Cross-entropy (optionally with label smoothing, same as LabelSmoothing) of
+    F.linear(hidden, weight) computed over chunks of positions. The logits of a
+    chunk are recomputed in backward, so at most one chunk of logits is alive.
+    """
+    hidden = hidden.reshape(-1, hidden.shape[-1])
+    target = target.reshape(-1)
+    loss = 0.0
+    for start in range(0, hidden.shape[0], chunk_size):
+        end = start + chunk_size
+        loss = loss + checkpoint(_chunk_loss_sum, hidden[start:end], weight, target[start:end], smoothing, use_reentrant=False)
+    return loss / hidden.shape[0]
+
+# transformer sizes selectable through --gpt_type (e.g. "tiny", "llama_base"), the default is the 24-layer model
+TRANSFORMER_SIZES = {
+    "tiny": {"n_layer": 6, "n_head": 8, "n_embd": 512},
+    "base": {"n_layer": 12, "n_head": 12, "n_embd": 768},
+    "small": {"n_layer": 24, "n_head": 16, "n_embd": 1024},
+}
+
+
+def transformer_size(gpt_type):
+    for name in gpt_type.split("_"):
+        if name in TRANSFORMER_SIZES:
+            return TRANSFORMER_SIZES[name]
+    return TRANSFORMER_SIZES["small"]
+
 class VQGANTransformer(nn.Module):
     def __init__(self, args):
         super(VQGANTransformer, self).__init__()
@@ -48,16 +93,28 @@ class VQGANTransformer(nn.Module):
 
         self.loss_computer = LabelSmoothing(smoothing=0.1)
 
+        # extra "no class" token for classifier-free guidance, right after the class tokens
+        self.null_token = args.n_vision_words + args.n_class if getattr(args, "null_class", 0) == 1 else None
+        self.class_dropout_prob = getattr(args, "class_dropout_prob", 0.0)
+        # packed multi-resolution training: one resolution token per grid size after the class (and null) tokens
+        self.pack_block_size = getattr(args, "pack_block_size", 0)
+        self.pack_resolutions = [int(r) for r in str(getattr(args, "pack_resolutions", "")).split(",") if r != ""] if self.pack_block_size > 0 else []
+        self.resolution_token_offset = args.n_vision_words + args.n_class + (1 if self.null_token is not None else 0)
+
+        self.transformer = self.build_transformer(args)
+        self.pkeep = args.pkeep
+        self.compiled_z_to_image = None
+
+    def build_transformer(self, args):
         ####GPT-small
         transformer_config = {
-            "vocab_size": args.n_vision_words + args.n_class,
-            "block_size": 257,
-            "n_layer": 24,
-            "n_head": 16,
-            "n_embd": 1024
+            "vocab_size": self.resolution_token_offset + len(self.pack_resolutions),
+            "block_size": max(257, self.pack_block_size),
+            **transformer_size(args.gpt_type),
         }
-        self.transformer = GPT(**transformer_config)
-        self.pkeep = args.pkeep
+        if "llama" in args.gpt_type:
+            return LLaMA(**transformer_config)
+        return GPT(**transformer_config)
 
     @staticmethod
     def load_vqgan(args):
@@ -81,8 +138,19 @@ class VQGANTransformer(nn.Module):
         indices = indices.view(quant_z.shape[0], -1)
         return quant_z, indices
     
+    def enable_compile(self, mode="default", cuda_graph=False):
+        # compiled VQ encode for training; compiled (and CUDA graph captured) token decode for sampling
+        self.vqgan.enable_compile(mode, cuda_graph)
+        self.compiled_z_to_image = build_compiled_function(self._z_to_image, mode, cuda_graph, name="VQGANTransformer.z_to_image")
+        return self
+
     @torch.no_grad()
     def z_to_image(self, indices, p1=16, p2=16):
+        if self.compiled_z_to_image is not None:
+            return self.compiled_z_to_image(indices, p1, p2)
+        return self._z_to_image(indices, p1, p2)
+
+    def _z_to_image(self, indices, p1=16, p2=16):
 
         ###
         if self.args.use_cblinear == 1:
@@ -91,11 +159,66 @@ class VQGANTransformer(nn.Module):
             vision_tok_embeddings_weight = self.vqgan.tok_embeddings.weight
         ix_to_vectors = F.embedding(indices, vision_tok_embeddings_weight).reshape(indices.shape[0], p1, p2, self.args.embed_dim)
         ix_to_vectors = ix_to_vectors.permute(0, 3, 1, 2)
-        image = self.vqgan.decode(ix_to_vectors)
+        # eager VQ decode here, the whole token-to-image path is compiled/captured as one function
+        image = self.vqgan._decode(ix_to_vectors)
 
         return image
 
+    def drop_class(self, c_indices):
+        if c_indices is not None and self.training and self.null_token is not None and self.class_dropout_prob > 0:
+            drop = torch.rand(c_indices.shape[0], 1, device=c_indices.device) < self.class_dropout_prob
+            c_indices = torch.where(drop, torch.full_like(c_indices, self.null_token), c_indices)
+        return c_indices
+
+    def resolution_token(self, resolution):
+        return self.resolution_token_offset + self.pack_resolutions.index(resolution)
+
+    def token_loss(self, hidden, target):
+        # hidden (N, C) and target (N,) of the predicted positions only
+        loss_chunk_size = getattr(self.args, "loss_chunk_size", 0)
+        smoothing = self.loss_computer.smoothing if self.args.label_smooth == 1 else 0.0
+        if loss_chunk_size > 0:
+            return chunked_cross_entropy(hidden, self.transformer.get_output_head().weight, target, smoothing=smoothing, chunk_size=loss_chunk_size)
+        logits = self.transformer.get_output_head()(hidden)
+        if self.args.label_smooth == 1:
+            return self.loss_computer(logits, target)
+        return F.cross_entropy(logits, target)
+
+    def corrupt_tokens(self, indices):
+        # pkeep augmentation: in training every input token is replaced by a random one with probability 1 - pkeep
+        if self.training and self.pkeep < 1.0:
+            mask = torch.bernoulli(self.pkeep * torch.ones(indices.shape, device=indices.device))
+            mask = mask.round().to(dtype=torch.int64)
+            random_indices = torch.randint_like(indices, self.transformer.config.vocab_size)
+            return mask * indices + (1 - mask) * random_indices
+        return indices
+
+    def forward_packed(self, x, c_indices=None):
+        # x: images at the largest resolution, split evenly over pack_resolutions. Every image becomes one
+        # [resolution token, class token, image tokens] document and the documents are packed into rows of
+        # pack_block_size tokens with per-document causal attention and positions.
+        if c_indices is None:
+            c_indices = torch.full((x.shape[0], 1), self.sos_token, dtype=torch.long, device=x.device)
+        c_indices = self.drop_class(c_indices)
+        documents = []
+        for resolution, images, cond in zip(self.pack_resolutions, x.chunk(len(self.pack_resolutions)), c_indices.chunk(len(self.pack_resolutions))):
+            if images.shape[-1] != resolution:
+                images = F.interpolate(images, size=(resolution, resolution), mode="bicubic", align_corners=False, antialias=True)
+            with torch.no_grad():
+                _, indices = self.encode_to_z(images)
+            prefix = torch.cat((torch.full_like(cond, self.resolution_token(resolution)), cond), dim=1)
+            new_indices = self.corrupt_tokens(indices)
+            documents.extend(build_document(prefix[i], indices[i], new_indices[i]) for i in range(indices.shape[0]))
+
+        packed = pack_documents(documents, self.pack_block_size)
+        hidden, _ = self.transformer(packed["input_ids"], return_hidden=True, position_ids=packed["position_ids"],
+                                     attn_mask=document_causal_mask(packed["doc_ids"]))
+        valid = packed["targets"] != IGNORE_INDEX
+        return self.token_loss(hidden[valid], packed["targets"][valid])
+
     def forward(self, x, c_indices=None):
+        if self.training and self.pack_block_size > 0:
+            return self.forward_packed(x, c_indices)
 
         with torch.no_grad():
             _, indices = self.encode_to_z(x)
@@ -103,22 +226,24 @@ class VQGANTransformer(nn.Module):
         sos_tokens = torch.ones(x.shape[0], 1) * self.sos_token
         sos_tokens = sos_tokens.long().to("cuda")
 
-        if self.training and self.pkeep < 1.0:
-            mask = torch.bernoulli(self.pkeep * torch.ones(indices.shape, device=indices.device))
-            mask = mask.round().to(dtype=torch.int64)
-            random_indices = torch.randint_like(indices, self.transformer.config.vocab_size)
-            new_indices = mask * indices + (1 - mask) * random_indices
-        else:
-            new_indices = indices
+        new_indices = self.corrupt_tokens(indices)
+
+        c_indices = self.drop_class(c_indices)
 
         if not c_indices is None:
             new_indices = torch.cat((c_indices, new_indices), dim=1)
-            logits, _ = self.transformer(new_indices[:, :-1])
         else:
             new_indices = torch.cat((sos_tokens, new_indices), dim=1)
-            logits, _ = self.transformer(new_indices[:, :-1])
         target = indices
 
+        loss_chunk_size = getattr(self.args, "loss_chunk_size", 0)
+        if loss_chunk_size > 0:
+            hidden, _ = self.transformer(new_indices[:, :-1], return_hidden=True)
+            smoothing = self.loss_computer.smoothing if self.args.label_smooth == 1 else 0.0
+            return chunked_cross_entropy(hidden, self.transformer.get_output_head().weight, target, smoothing=smoothing, chunk_size=loss_chunk_size)
+
+        logits, _ = self.transformer(new_indices[:, :-1])
+
         if self.args.label_smooth == 1:
             loss = self.loss_computer(logits.reshape(-1, logits.size(-1)), target.reshape(-1))
         else:
@@ -126,37 +251,90 @@ class VQGANTransformer(nn.Module):
         
         return loss
 
-    def top_k_logits(self, logits, k):
-        v, ix = torch.topk(logits, k)
-        out = logits.clone()
-        out[out < v[..., [-1]]] = -float("inf")
-        return out
+    def vision_logits(self, hidden):
+        # only the vision rows of the output head, class tokens are never sampled
+        weight = self.transformer.get_output_head().weight[:self.args.n_vision_words]
+        return F.linear(hidden, weight)
+
+    @staticmethod
+    def cfg_scales(cfg_scale, cfg_schedule, steps):
+        # guidance scale per decoding step: constant, or growing from 1 to cfg_scale
+        progress = [k / max(steps - 1, 1) for k in range(steps)]
+        if cfg_schedule == "linear":
+            return [1.0 + (cfg_scale - 1.0) * p for p in progress]
+        if cfg_schedule == "cosine":
+            return [1.0 + (cfg_scale - 1.0) * (1 - math.cos(math.pi * p)) / 2 for p in progress]
+        return [cfg_scale] * steps
+
+    def guided_logits(self, hidden, cfg_scale=None):
+        # hidden of the doubled batch [cond; uncond] -> uncond + s * (cond - uncond)
+        logits = self.vision_logits(hidden)
+        if cfg_scale is None:
+            return logits
+        cond, uncond = logits.chunk(2, dim=0)
+        return uncond + cfg_scale * (cond - uncond)
 
     #cleanFID
     @torch.no_grad()
-    def sample(self, x, c, steps, temperature=1.0, top_k=100):
+    def sample(self, x, c, steps, temperature=1.0, top_k=100, top_p=None, generator=None, cfg_scale=1.0, cfg_schedule="constant"):
+        # temperature / top_k / top_p may be per-sample lists or tensors
         self.transformer.eval()
+        sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p, generator=generator)
+        scales = [None] * steps
+        if cfg_scale != 1.0:
+            # cond and uncond (null class) streams run as one doubled batch
+            assert self.null_token is not None, "classifier-free guidance needs a model trained with --null_class 1"
+            scales = self.cfg_scales(cfg_scale, cfg_schedule, steps)
+            c = torch.cat((c, torch.full_like(c, self.null_token)), dim=0)
+            x = torch.cat((x, x), dim=0) if x is not None else None
+        bsz = c.shape[0] if cfg_scale == 1.0 else c.shape[0] // 2
         if x is not None:
             x = torch.cat((c, x), dim=1)
         else:
             x = c
+        if hasattr(self.transformer, "forward_inference"):
+            x = self.sample_cached(x, steps, sampler, scales)
+            return x[:bsz, c.shape[1]:]
         for k in range(steps):
-            logits, _ = self.transformer(x)
-            logits = logits[:, -1, :self.args.n_vision_words] / temperature
-
-            if top_k is not None:
-                logits = self.top_k_logits(logits, top_k)
-
-            probs = F.softmax(logits, dim=-1)
-
-            ix = torch.multinomial(probs, num_samples=1)
+            hidden, _ = self.transformer(x, return_hidden=True)
+            logits = self.guided_logits(hidden[:, -1], scales[k])
+            ix = sampler(logits)
+            if scales[k] is not None:
+                ix = torch.cat((ix, ix), dim=0)
 
             x = torch.cat((x, ix), dim=1)
 
-        x = x[:, c.shape[1]:]
+        x = x[:bsz, c.shape[1]:]
         #self.transformer.train()
         return x
     
+    @torch.no_grad()
+    def sample_cached(self, x, steps, sampler, scales=None):
+        # prefill the prompt once, then decode one token per step over the K/V caches
+        bsz, prefix_len = x.shape
+        scales = [None] * steps if scales is None else scales
+        self.transformer.setup_caches(bsz, prefix_len + steps)
+        out = torch.empty(bsz, prefix_len + steps, dtype=x.dtype, device=x.device)
+        out[:, :prefix_len] = x
+        hidden, _ = self.transformer.forward_inference(x, 0, return_hidden=True)
+        for k in range(steps):
+            ix = sampler(self.guided_logits(hidden[:, -1], scales[k]))
+            if scales[k] is not None:
+                ix = torch.cat((ix, ix), dim=0)
+            out[:, prefix_len + k] = ix[:, 0]
+            if k < steps - 1:
+                hidden, _ = self.transformer.forward_inference(ix, prefix_len + k, return_hidden=True)
+        self.transformer.clear_caches()
+        return out
+
+    @torch.no_grad()
+    def sample_speculative(self, x, c, steps, draft, k=4, temperature=1.0, top_k=100, top_p=None, generator=None):
+        # draft: a smaller token transformer (see build_transformer) proposing k tokens per target forward
+        self.transformer.eval()
+        draft.eval()
+        return speculative_sample(self.transformer, draft, x, c, steps, self.args.n_vision_words, k=k,
+                                  temperature=temperature, top_k=top_k, top_p=top_p, generator=generator)
+
     @torch.no_grad()
     def log_images(self, x, c_indices=None, num=None):
         log = dict()
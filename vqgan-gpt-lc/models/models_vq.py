@@ -7,11 +7,15 @@ from models.discriminator import NLayerDiscriminator, weights_init
 #from models.lpips import LPIPS
 from models.encoder_decoder import Encoder, Decoder, Decoder_Cross, MaxPoolConvDownsample, InterpolateUpsample
 from models.sd3.sd3_impls import SDVAE, SD3LatentFormat
+from util.compile import build_compiled_function
 import copy
 import os
+from contextlib import nullcontext
 import matplotlib.pyplot as plt
 import numpy as np
 
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
 def load_state(model, prefix, state_dict, excludes=[]):
     model_dict = model.state_dict()  # 当前网络结构
     pretrained_dict = {k.replace(prefix,''): v for k, v in state_dict.items() if k.replace(prefix,'') in model_dict}  # 预训练模型中可用的weight
@@ -176,6 +180,55 @@ class VQModel(torch.nn.Module):
             self.tok_embeddings.weight.requires_grad = False
             self.num_tokens = args.n_vision_words
 
+        ###Mixed precision: conv stacks run under autocast, codebook/distance/argmin stay fp32
+        self.amp_dtype = AMP_DTYPES.get(getattr(args, "amp_dtype", "none"), None)
+        self.amp_exclude = [m for m in getattr(args, "amp_exclude", "").split(",") if m != ""]
+        if self.amp_dtype is not None:
+            print("****Using Mixed Precision: %s (fp32 modules: %s)****"%(args.amp_dtype, ",".join(["quantize"] + self.amp_exclude)))
+        self.channels_last = False
+        self.compiled_fns = None
+        self.profiler = None
+
+    def autocast(self, name):
+        # name is one of encoder/quant_conv/post_quant_conv/decoder/discriminator
+        enabled = self.amp_dtype is not None and name not in self.amp_exclude
+        return torch.autocast(device_type="cuda", dtype=self.amp_dtype if enabled else torch.float16, enabled=enabled)
+
+    def to_channels_last(self):
+        for module in [self.encoder, self.decoder, self.quant_conv, self.post_quant_conv, self.discriminator]:
+            module.to(memory_format=torch.channels_last)
+        self.channels_last = True
+        return self
+
+    def profile_stage(self, name):
+        # named profiler stage (util.profiler.StepProfiler), skipped inside compiled/captured functions
+        if self.profiler is None or self.compiled_fns is not None:
+            return nullcontext()
+        return self.profiler.stage(name)
+
+    def enable_compile(self, mode="default", cuda_graph=False):
+        # compiled encode/decode/discriminator for training; static-shape CUDA graphs for no-grad eval
+        print("****Using Compiled VQModel: mode=%s cuda_graph=%s****"%(mode, cuda_graph))
+        self.compiled_fns = {
+            # callers only read quant, the loss and the indices: the (N, n_e) distances stay in the graph pool
+            "encode": build_compiled_function(self._encode, mode, cuda_graph, name="VQModel.encode",
+                                              select_outputs=lambda out: (out[0], out[1], (None, None, out[2][2]))),
+            "decode": build_compiled_function(self._decode, mode, cuda_graph, name="VQModel.decode"),
+            "discriminate": build_compiled_function(self._discriminate, mode, cuda_graph, name="VQModel.discriminate"),
+        }
+        return self
+
+    def discriminate(self, x):
+        if self.compiled_fns is not None:
+            return self.compiled_fns["discriminate"](x)
+        with self.profile_stage("discriminator"):
+            return self._discriminate(x)
+
+    def _discriminate(self, x):
+        with self.autocast("discriminator"):
+            logits = self.discriminator(x)
+        return logits.float()
+
     def hinge_d_loss(self, logits_real, logits_fake):
         loss_real = torch.mean(F.relu(1. - logits_real))
         loss_fake = torch.mean(F.relu(1. + logits_fake))
@@ -184,8 +237,8 @@ class VQModel(torch.nn.Module):
 
     def calculate_adaptive_weight(self, nll_loss, g_loss, discriminator_weight, last_layer=None):
 
-        nll_grads = torch.autograd.grad(nll_loss, last_layer, retain_graph=True)[0]
-        g_grads = torch.autograd.grad(g_loss, last_layer, retain_graph=True)[0]
+        nll_grads = torch.autograd.grad(nll_loss, last_layer, retain_graph=True)[0].float()
+        g_grads = torch.autograd.grad(g_loss, last_layer, retain_graph=True)[0].float()
 
         d_weight = torch.norm(nll_grads) / (torch.norm(g_grads) + 1e-4)
         d_weight = torch.clamp(d_weight, 0.0, 1e4).detach()
@@ -209,6 +262,11 @@ class VQModel(torch.nn.Module):
 
 
     def quantize(self, z, temp=None, rescale_logits=False, return_logits=False):
+        # distance/argmin and the codebook always run in fp32, even inside an autocast region
+        with torch.autocast(device_type="cuda", enabled=False):
+            return self._quantize(z.float(), temp=temp, rescale_logits=rescale_logits, return_logits=return_logits)
+
+    def _quantize(self, z, temp=None, rescale_logits=False, return_logits=False):
 
         # reshape z -> (batch, height, width, channel) and flatten
         z = rearrange(z, 'b c h w -> b h w c').contiguous()
@@ -221,12 +279,14 @@ class VQModel(torch.nn.Module):
             tok_embeddings_weight = self.tok_embeddings.weight
         
 
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(tok_embeddings_weight**2, dim=1) - 2 * \
-            torch.einsum('bd,dn->bn', z_flattened, rearrange(tok_embeddings_weight, 'n d -> d n'))
+        with self.profile_stage("distance"):
+            d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
+                torch.sum(tok_embeddings_weight**2, dim=1) - 2 * \
+                torch.einsum('bd,dn->bn', z_flattened, rearrange(tok_embeddings_weight, 'n d -> d n'))
         
 
-        min_encoding_indices = torch.argmin(d, dim=1)
+        with self.profile_stage("argmin"):
+            min_encoding_indices = torch.argmin(d, dim=1)
         #print(min_encoding_indices.shape)
         if self.quantize_type == "ema":
             
@@ -284,7 +344,7 @@ class VQModel(torch.nn.Module):
 
 
         ###Loss
-        rec_loss = torch.mean(torch.abs(input.contiguous() - dec.contiguous()))
+        rec_loss = torch.mean(torch.abs(input.float().contiguous() - dec.contiguous()))
 
         #print(rec_loss)
         
@@ -317,14 +377,15 @@ class VQModel(torch.nn.Module):
         #p_loss = 0
         
         if step == 0: #Upadte Generator
-            logits_fake = self.discriminator(dec)
+            logits_fake = self.discriminate(dec)
             g_loss = -torch.mean(logits_fake)
 
             if is_val:
                 loss = rec_loss + self.args.rate_q * qloss  + 0 * g_loss
                 return loss, rec_loss, qloss, g_loss, tk_labels.view(input.shape[0], -1), dec
             
-            d_weight = self.calculate_adaptive_weight(rec_loss, g_loss, self.args.rate_d, last_layer=self.decoder.conv_out.weight)
+            with self.profile_stage("adaptive_weight"):
+                d_weight = self.calculate_adaptive_weight(rec_loss, g_loss, self.args.rate_d, last_layer=self.decoder.conv_out.weight)
             
             if data_iter_step > self.args.disc_start:
                 loss = rec_loss + self.args.rate_q * qloss  + d_weight * g_loss
@@ -333,8 +394,8 @@ class VQModel(torch.nn.Module):
 
             return loss, rec_loss, qloss, g_loss, tk_labels, dec
         else: #Upadte Discriminator
-            logits_real =  self.discriminator(input.contiguous().detach().clone())
-            logits_fake = self.discriminator(dec.detach().clone())
+            logits_real =  self.discriminate(input.detach().clone())
+            logits_fake = self.discriminate(dec.detach().clone())
             d_loss = self.hinge_d_loss(logits_real, logits_fake)
             loss = d_loss + 0 * (rec_loss + qloss)
 
@@ -342,19 +403,36 @@ class VQModel(torch.nn.Module):
 
 
     def encode(self, input):
+        if self.compiled_fns is not None:
+            return self.compiled_fns["encode"](input)
+        return self._encode(input)
+
+    def _encode(self, input):
         #print(self.encoder(input))
-        h = self.quant_conv(self.encoder(input))
+        with self.profile_stage("encoder"), self.autocast("encoder"):
+            h = self.encoder(input)
+        with self.autocast("quant_conv"):
+            h = self.quant_conv(h)
+        h = h.float()
         if self.e_dim == 768 and self.args.tuning_codebook != -1:
             h = h / h.norm(dim=1, keepdim=True)
         quant, emb_loss, info = self.quantize(h)
         return quant, emb_loss, info
 
     def decode(self, quant, global_c_features=None):
-        quant = self.post_quant_conv(quant)
-
-        dec = self.decoder(quant)
-
-        return dec
+        if self.compiled_fns is not None:
+            return self.compiled_fns["decode"](quant)
+        return self._decode(quant)
+
+    def _decode(self, quant):
+        if self.channels_last:
+            quant = quant.contiguous(memory_format=torch.channels_last)
+        with self.autocast("post_quant_conv"):
+            quant = self.post_quant_conv(quant)
+        with self.profile_stage("decoder"), self.autocast("decoder"):
+            dec = self.decoder(quant)
+
+        return dec.float()
     
     def get_last_layer(self):
         return self.decoder.conv_out.weight
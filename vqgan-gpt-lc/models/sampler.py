@@ -0,0 +1,103 @@
+import torch
+import torch.nn.functional as F
+
+
+def _as_column(value, batch_size, device, dtype):
+    # python scalar -> scalar, list/tensor of per-sample values -> (B, 1) tensor
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = torch.as_tensor(value, device=device, dtype=dtype)
+    assert value.numel() == batch_size, "per-sample sampling params need one value per sample"
+    return value.view(batch_size, 1)
+
+
+class Sampler:
+    """
+    Temperature / top-k / top-p sampling over the last-position logits (B, V).
+    The top-k subset is selected once with torch.topk and all filtering and the
+    multinomial draw happen inside it, so the full vocabulary is never cloned
+    or masked. temperature, top_k and top_p can be scalars or per-sample lists
+    or tensors. generator is a torch.Generator (or one per sample) for
+    deterministic sampling.
+    """
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, generator=None):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generator = generator
+        self.params = None
+
+    def _prepare(self, logits):
+        batch_size, vocab_size = logits.shape
+        top_k = self.top_k
+        if top_k is None:
+            k_max, per_sample_k = vocab_size, None
+        elif isinstance(top_k, int):
+            k_max, per_sample_k = min(top_k, vocab_size), None
+        else:
+            top_k = [min(int(k), vocab_size) for k in top_k]
+            k_max = max(top_k)
+            per_sample_k = None if min(top_k) == k_max else _as_column(top_k, batch_size, logits.device, torch.long)
+        top_p = self.top_p if not isinstance(self.top_p, (int, float)) or self.top_p < 1.0 else None
+        self.params = {
+            "shape": (batch_size, vocab_size),
+            "k_max": k_max,
+            "per_sample_k": per_sample_k,
+            "temperature": _as_column(self.temperature, batch_size, logits.device, torch.float32),
+            "top_p": _as_column(top_p, batch_size, logits.device, torch.float32),
+            "rank": torch.arange(k_max, device=logits.device).view(1, -1) if per_sample_k is not None else None,
+        }
+
+    def filter(self, logits):
+        # -> (filtered logits of the kept subset, their vocabulary indices or None for the full vocabulary)
+        if self.params is None or self.params["shape"] != tuple(logits.shape):
+            self._prepare(logits)
+        params = self.params
+
+        # top-k subset (sorted), the rest of the vocabulary is never touched again
+        if params["k_max"] < logits.shape[-1]:
+            values, indices = torch.topk(logits, params["k_max"], dim=-1)
+            values = values.float()
+        else:
+            values, indices = logits.float(), None
+
+        temperature = params["temperature"]
+        if not (isinstance(temperature, float) and temperature == 1.0):
+            values = values / temperature
+        elif values is logits:
+            values = values.clone()
+
+        if params["per_sample_k"] is not None:
+            values.masked_fill_(params["rank"] >= params["per_sample_k"], float("-inf"))
+
+        if params["top_p"] is not None:
+            if indices is None:
+                values, indices = torch.sort(values, dim=-1, descending=True)
+            probs = F.softmax(values, dim=-1)
+            # drop tokens once the mass before them exceeds top_p (the first token is always kept)
+            values.masked_fill_(probs.cumsum(dim=-1) - probs > params["top_p"], float("-inf"))
+        return values, indices
+
+    def multinomial(self, probs):
+        if isinstance(self.generator, (list, tuple)):
+            return torch.cat([torch.multinomial(probs[i:i + 1], 1, generator=g) for i, g in enumerate(self.generator)])
+        return torch.multinomial(probs, num_samples=1, generator=self.generator)
+
+    def probs(self, logits):
+        # dense (B, V) sampling distribution, zero outside the kept subset
+        values, indices = self.filter(logits)
+        probs = F.softmax(values, dim=-1)
+        if indices is None:
+            return probs
+        return torch.zeros(logits.shape, dtype=probs.dtype, device=probs.device).scatter_(-1, indices, probs)
+
+    def __call__(self, logits):
+        values, indices = self.filter(logits)
+        choice = self.multinomial(F.softmax(values, dim=-1))
+        if indices is None:
+            return choice
+        return indices.gather(-1, choice)
+
+
+def sample_logits(logits, temperature=1.0, top_k=None, top_p=None, generator=None):
+    return Sampler(temperature=temperature, top_k=top_k, top_p=top_p, generator=generator)(logits)
@@ -3,6 +3,7 @@ import math
 from einops import rearrange
 
 TRADITION = 1000
+SOLVERS = ("euler", "heun", "dpm++2m", "adaptive")
 
 def append_to_shape(t, x_shape):
     return t.reshape(t.shape[0], *((1,) * (len(x_shape) - 1)))
@@ -21,6 +22,50 @@ def sum_flat(tensor):
     """
     return tensor.sum(dim=list(range(1, len(tensor.shape))))
 
+
+class GuidedDenoiser:
+    """
+    Model calls of one sampling run with classifier-free guidance.
+    Models with prepare_context (MMDiT) get the step independent context of the
+    conditional and the doubled [uncond; cond] batch computed once; the unconditional
+    half is the learned null condition (or uc) with its own mask. Other models get
+    [uc; cond] with an all-valid mask for the uc half. Guidance is applied when the
+    host time of the step lies in cfg_interval (t_low, t_high), plain conditional
+    calls on the other steps.
+    """
+    def __init__(self, model, model_kwargs, cfg_scale=1.0, uc=None, cfg_interval=None):
+        self.model = model
+        self.cfg_scale = cfg_scale
+        self.cfg_interval = cfg_interval
+        self.cond_kwargs, self.cfg_kwargs = model_kwargs, None
+        encoder_hidden_states = model_kwargs.get("encoder_hidden_states")
+        if encoder_hidden_states is None:
+            return
+        mask, y = model_kwargs.get("mask"), model_kwargs.get("y")
+        # model may be a bound forward
+        owner = getattr(model, "__self__", model)
+        if hasattr(owner, "prepare_context"):
+            with torch.no_grad():
+                self.cond_kwargs = dict(prepared_context=owner.prepare_context(encoder_hidden_states, mask, y))
+                if cfg_scale != 1.0:
+                    self.cfg_kwargs = dict(prepared_context=owner.prepare_cfg_context(encoder_hidden_states, mask, y, uc=uc))
+        elif cfg_scale != 1.0 and uc is not None:
+            if mask is not None:
+                mask = torch.cat([torch.ones_like(mask), mask])
+            self.cfg_kwargs = dict(encoder_hidden_states=torch.cat([uc, encoder_hidden_states]), mask=mask)
+
+    def guided(self, t_host=None):
+        if self.cfg_kwargs is None:
+            return False
+        return self.cfg_interval is None or self.cfg_interval[0] <= t_host <= self.cfg_interval[1]
+
+    def __call__(self, x, t, t_host=None):
+        if not self.guided(t_host):
+            return self.model(x, t, **self.cond_kwargs)
+        out_uncond, out = self.model(torch.cat([x, x]), torch.cat([t, t]), **self.cfg_kwargs).chunk(2)
+        return out_uncond + self.cfg_scale * (out - out_uncond)
+
+
 class RectifiedFlow(torch.nn.Module):
     def __init__(self, num_timesteps=100, schedule="log_norm", parameterization='x0', shift=1.0, m=0, s=1, force_recon=False, device='cuda'):
         super().__init__()
@@ -167,8 +212,20 @@ class RectifiedFlow(torch.nn.Module):
         ori_hidden_states=None,
         cond_vary=False,
         device=None,
+        solver="euler",
+        num_steps=None,
+        schedule="uniform",
+        cfg_interval=None,
         **kwargs,
     ):
+        if solver != "euler" or num_steps is not None or schedule != "uniform":
+            return self.sample_ode(
+                model, shape, noise=noise, model_kwargs=model_kwargs, num_steps=num_steps, solver=solver, schedule=schedule,
+                unconditional_guidance_scale=unconditional_guidance_scale,
+                unconditional_conditioning=unconditional_conditioning, cfg_interval=cfg_interval, x_0=x_0,
+                encoder=encoder, diti=diti, dit=dit, ori_hidden_states=ori_hidden_states, cond_vary=cond_vary,
+                device=device,
+            )
         batch_size = shape[0]
         if device is None:
             device = next(model.parameters()).device
@@ -178,21 +235,26 @@ class RectifiedFlow(torch.nn.Module):
         else:
             img = noise
  
+        if cond_vary:
+            # depth of every step on the host, encoder outputs computed once, one condition per distinct depth
+            depths = diti.index(self.timestep_map.long().cpu() - 1).tolist()
+            cond_cache = encoder.cond_cache(x_0, ori_hidden_states)
+        # one denoiser (prepared context) per condition, host step times for cfg_interval
+        denoisers = {}
+        step_times = self.scheduled_t.tolist() if cfg_interval is not None else [None] * len(self.scheduled_t)
+
         #for i in indices:
         for i, step in enumerate(self.scheduled_t):
             t = torch.tensor([step] * batch_size, device=device)  # step：1~0
             with torch.no_grad():
                 if cond_vary:
-                    t_mapped = torch.tensor([self.timestep_map[i]]*batch_size, device=device).long()
-                    #print('IN t_mapped', t_mapped)
-                    k = diti.t_to_idx.to(device)[t_mapped-1]
-                    
-                    encoder_hidden_states, _, mask, _, _ = encoder(x=x_0, hidden_states=ori_hidden_states, d=k)
+                    k = depths[i]
+                    encoder_hidden_states, mask = cond_cache(k)
                     model_kwargs = dict(
                         encoder_hidden_states=encoder_hidden_states,
                         mask=mask
                     )
-                    if encoder_hidden_states.sum() == 0 and dit is not None:
+                    if dit is not None and cond_cache.is_empty(k):
                         print("No condition is given...")
                         model_kwargs = {
                             'y': torch.tensor([1000] * len(x_0)).to(x_0.device)
@@ -200,8 +262,15 @@ class RectifiedFlow(torch.nn.Module):
                         model_to_use = dit
                     else:
                         model_to_use = model
+                    key = k
                 else:
                     model_to_use = model
+                    key = None
+                if key not in denoisers:
+                    denoisers[key] = GuidedDenoiser(
+                        model_to_use, model_kwargs or {}, unconditional_guidance_scale,
+                        unconditional_conditioning, cfg_interval,
+                    )
  
                 img, pred_x0 = self.sample_one_step(
                     model_to_use,
@@ -209,8 +278,8 @@ class RectifiedFlow(torch.nn.Module):
                     t,
                     index=i,
                     model_kwargs=model_kwargs,
-                    cfg_scale=unconditional_guidance_scale,
-                    uc=unconditional_conditioning,
+                    denoiser=denoisers[key],
+                    t_host=step_times[i],
                     **kwargs,
                 )
 
@@ -225,18 +294,18 @@ class RectifiedFlow(torch.nn.Module):
         model_kwargs=None,
         cfg_scale=1.0,
         uc=None,
+        denoiser=None,
+        t_host=None,
         **kwargs,
     ):
         if model_kwargs is None:
             model_kwargs = {}
+        if denoiser is None:
+            denoiser = GuidedDenoiser(model, model_kwargs, cfg_scale, uc)
         b, *_, device = *x.shape, x.device
         a_t = torch.full((b, 1, 1, 1), self.scheduled_t[index], device=device)
         a_prev = torch.full((b, 1, 1, 1), self.scheduled_t_prev[index], device=device)
-        if uc is None or cfg_scale == 1.0:
-            out = model(x, t, **model_kwargs)
-        else:
-            out_uncond, out = model(torch.cat([x] * 2), torch.cat([t] * 2), torch.cat([uc, model_kwargs['encoder_hidden_states']]), mask = model_kwargs['mask']).chunk(2)
-            out = out_uncond + cfg_scale * (out - out_uncond)
+        out = denoiser(x, t, t_host)
             
         img, pred_x0 = self.base_step(
             x, out, a_t=a_t, a_prev=a_prev, **kwargs
@@ -258,8 +327,196 @@ class RectifiedFlow(torch.nn.Module):
             pred_x0 = v
             
         return x_prev, pred_x0
-        
-    
+
+    def velocity_x0(self, out, x, t):
+        # model output -> (velocity dx/dt, pred_x0) at host time t in (0, 1] for either parameterization
+        if self.parameterization == "velocity":
+            return out, x - t * out
+        elif self.parameterization == "x0":
+            return (x - out) / t, out
+        raise NotImplementedError()
+
+    def consistency_losses(self, student, target, teacher, x_start, num_scales=18, noise=None):
+        """
+        Consistency distillation (Song et al., 2023) on the flow ODE.
+        student / target / teacher: callables (x, t) -> model output with the condition bound.
+        x is put on the noising path at t_{n+1} of a uniform num_scales grid, the teacher
+        takes one euler step to t_n and the student consistency function at t_{n+1} is
+        regressed on the target (EMA) network at t_n. The consistency function is the
+        x0 prediction, with f(x, 0) = x.
+        """
+        b = x_start.shape[0]
+        n = torch.randint(0, num_scales, (b,), device=x_start.device)
+        t_cur, t_next = n.float() / num_scales, (n + 1).float() / num_scales
+        if noise is None:
+            noise = torch.randn_like(x_start)
+        x_next = self.q_sample(x_start, t_next, noise=noise)
+        t_cur_b, t_next_b = append_to_shape(t_cur, x_start.shape), append_to_shape(t_next, x_start.shape)
+
+        with torch.no_grad():
+            v, _ = self.velocity_x0(teacher(x_next, t_next), x_next, t_next_b)
+            x_cur = x_next + (t_cur_b - t_next_b) * v
+            _, target_x0 = self.velocity_x0(target(x_cur, t_cur), x_cur, t_cur_b)
+            target_x0 = torch.where(t_cur_b == 0, x_cur, target_x0)
+
+        _, pred_x0 = self.velocity_x0(student(x_next, t_next), x_next, t_next_b)
+        terms = {}
+        terms["loss"] = mean_flat((pred_x0 - target_x0) ** 2)
+        return terms
+
+    @torch.no_grad()
+    def consistency_sample(self, model, shape, noise=None, model_kwargs=None, num_steps=1, device=None):
+        """
+        Multistep consistency sampling: x0 prediction at t = 1, then re-noised to the next
+        time of a uniform num_steps grid and predicted again (num_steps model evaluations).
+        """
+        batch_size = shape[0]
+        if device is None:
+            device = next(model.parameters()).device
+        img = torch.randn(*shape, device=device) if noise is None else noise
+        denoiser = GuidedDenoiser(model, model_kwargs or {})
+        timesteps = self.get_timesteps(num_steps)[:-1]
+        for i, t in enumerate(timesteps):
+            _, pred_x0 = self.velocity_x0(denoiser(img, torch.full((batch_size,), t, device=device)), img, t)
+            if i + 1 < len(timesteps):
+                img = self.q_sample(pred_x0, torch.full((batch_size,), timesteps[i + 1], device=device))
+        self.nfe = len(timesteps)
+        return pred_x0
+
+    def get_timesteps(self, num_steps, schedule="uniform"):
+        # num_steps + 1 host times from 1 (noise) to 0 (data), spaced as in make_schedule
+        assert schedule in ("uniform", "shift"), "unknown decode schedule %s" % schedule
+        t = torch.linspace(1, 0, num_steps + 1, dtype=torch.float64)
+        if schedule == "shift":
+            t = self.shift * t / (1 + (self.shift - 1) * t)
+        return t.tolist()
+
+    @torch.no_grad()
+    def sample_ode(
+        self,
+        model,
+        shape,
+        noise=None,
+        model_kwargs=None,
+        num_steps=None,
+        solver="dpm++2m",
+        schedule="uniform",
+        unconditional_guidance_scale=1.0,
+        unconditional_conditioning=None,
+        cfg_interval=None,
+        x_0=None,
+        encoder=None,
+        diti=None,
+        dit=None,
+        ori_hidden_states=None,
+        cond_vary=False,
+        rtol=0.05,
+        atol=0.05,
+        device=None,
+        **kwargs,
+    ):
+        """
+        Integrates the flow ODE dx/dt = v from t=1 (noise) to t=0 with a few-step solver:
+        - euler: first order, one model evaluation per step (same as p_sample_loop)
+        - heun: second order, two evaluations per step (one on the last step)
+        - dpm++2m: DPM-Solver++(2M) on the data prediction, alpha_t = 1 - t, sigma_t = t;
+          second order multistep with one evaluation per step
+        - adaptive: embedded Heun/Euler pair with step size control (rtol, atol);
+          num_steps only sets the initial step size
+        The model output is converted to velocity / x0 for both parameterizations.
+        Guidance (unconditional_guidance_scale != 1) runs through GuidedDenoiser,
+        restricted to the times in cfg_interval when given.
+        The number of model evaluations of the last call is kept in self.nfe.
+        """
+        assert solver in SOLVERS, "unknown solver %s" % solver
+        if model_kwargs is None:
+            model_kwargs = {}
+        batch_size = shape[0]
+        if device is None:
+            device = next(model.parameters()).device
+        img = torch.randn(*shape, device=device) if noise is None else noise
+        num_steps = self.num_timesteps if num_steps is None else num_steps
+        if cond_vary:
+            cond_cache = encoder.cond_cache(x_0, ori_hidden_states)
+        self.nfe = 0
+        denoisers = {}
+
+        def denoise(x, t):
+            # model at host time t -> (velocity, pred_x0)
+            model_to_use, cond_kwargs, key = model, model_kwargs, None
+            if cond_vary:
+                # depth lookup as in p_sample_loop
+                k = diti.index(min(max(int(t * TRADITION) - 1, 0), TRADITION - 1))
+                if dit is not None and cond_cache.is_empty(k):
+                    model_to_use, cond_kwargs = dit, {'y': torch.tensor([1000] * len(x_0)).to(x_0.device)}
+                else:
+                    encoder_hidden_states, mask = cond_cache(k)
+                    cond_kwargs = dict(encoder_hidden_states=encoder_hidden_states, mask=mask)
+                key = k
+            if key not in denoisers:
+                denoisers[key] = GuidedDenoiser(
+                    model_to_use, cond_kwargs, unconditional_guidance_scale, unconditional_conditioning, cfg_interval,
+                )
+            self.nfe += 1
+            out = denoisers[key](x, torch.full((batch_size,), t, device=device), t)
+            return self.velocity_x0(out, x, t)
+
+        if solver == "adaptive":
+            return self.adaptive_solve(denoise, img, 1.0 / num_steps, rtol, atol)
+
+        timesteps = self.get_timesteps(num_steps, schedule)
+        x0_prev, h_prev = None, None
+        for t, t_prev in zip(timesteps[:-1], timesteps[1:]):
+            v, x0 = denoise(img, t)
+            if t_prev == 0:
+                # the last step of every solver lands on the x_0 prediction (an euler step to t = 0)
+                img = x0
+                break
+            if solver == "euler":
+                img = img + (t_prev - t) * v
+            elif solver == "heun":
+                x_e = img + (t_prev - t) * v
+                v_e, _ = denoise(x_e, t_prev)
+                img = img + (t_prev - t) * 0.5 * (v + v_e)
+            else:
+                h = self.log_snr(t_prev) - self.log_snr(t)
+                if x0_prev is None:
+                    d = x0
+                else:
+                    r = h_prev / h
+                    d = (1 + 0.5 / r) * x0 - (0.5 / r) * x0_prev
+                # sigma_prev / sigma * x - alpha_prev * (exp(-h) - 1) * d, written without exp(-h) so t = 1 is exact
+                img = (t_prev / t) * img + ((1 - t_prev) - (1 - t) * t_prev / t) * d
+                x0_prev, h_prev = x0, h
+        return img
+
+    def log_snr(self, t):
+        # lambda_t = log(alpha_t / sigma_t), alpha_t clamped at t = 1
+        return math.log(max(1.0 - t, 1e-4)) - math.log(t)
+
+    def adaptive_solve(self, denoise, img, step, rtol, atol, min_step=1e-3):
+        # Heun with an Euler error estimate; accepted when the scaled RMS error of every sample is <= 1
+        t, h = 1.0, -step
+        v = None
+        while t > 0:
+            h = max(h, -t)
+            t_next = t + h if t + h > 1e-6 else 0.0
+            if v is None:
+                v, x0 = denoise(img, t)
+            if t_next == 0:
+                return x0
+            x_e = img + h * v
+            v_e, _ = denoise(x_e, t_next)
+            x_h = img + h * 0.5 * (v + v_e)
+            scale = atol + rtol * torch.maximum(img.abs(), x_h.abs())
+            err = ((x_h - x_e) / scale).pow(2).flatten(1).mean(dim=1).sqrt().max().item()
+            if err <= 1.0 or -h <= min_step:
+                img, t, v = x_h, t_next, None
+            # second order pair: error ~ h^2
+            h = h * min(max(0.9 * err ** -0.5, 0.2), 5.0) if err > 0 else h * 5.0
+            h = min(h, -min_step)
+        return img
+
 
 if __name__ == '__main__':
     import ipdb
@@ -166,6 +166,7 @@ class GaussianDiffusion:
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
         self.betas = betas
+        self.log_betas = np.log(betas)
         assert len(betas.shape) == 1, "betas must be 1-D"
         assert (betas > 0).all() and (betas <= 1).all()
 
@@ -221,6 +222,33 @@ class GaussianDiffusion:
                 a[j][j+i] = a[j][j+i-1] + b[j][j+i-1] * self.posterior_mean_coef1[j+i]
                 b[j][j+i] = b[j][j+i-1] * self.posterior_mean_coef2[j+i]
 
+        # float copies of the tables above on the sampling device, filled by to()
+        self.device_tables = {}
+
+    def to(self, device):
+        """
+        Keep the coefficient tables on device, so that sampling indexes them
+        in place instead of uploading the numpy arrays at every step.
+        """
+        tables = {}
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray) and value.size > 0:
+                tables[name] = th.from_numpy(value).to(device=device, dtype=th.float32)
+        self.device_tables = tables
+        return self
+
+    def _extract(self, name, t, broadcast_shape):
+        table = self.device_tables.get(name)
+        if table is None or table.device != t.device:
+            table = getattr(self, name)
+        return _extract_into_tensor(table, t, broadcast_shape)
+
+    def _extract_2d(self, name, t1, t2, broadcast_shape):
+        table = self.device_tables.get(name)
+        if table is None or table.device != t1.device:
+            table = getattr(self, name)
+        return _extract_into_tensor_2d(table, t1, t2, broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -228,9 +256,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -246,8 +274,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -257,12 +285,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -276,8 +304,8 @@ class GaussianDiffusion:
     def q_posterior_mean_jump(self, x_start, x_t, t, target_t):
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor_2d(self.posterior_mean_jump_coef1, target_t+1, t, x_t.shape) * x_start
-            + _extract_into_tensor_2d(self.posterior_mean_jump_coef2, target_t+1, t, x_t.shape) * x_t
+            self._extract_2d("posterior_mean_jump_coef1", target_t+1, t, x_t.shape) * x_start
+            + self._extract_2d("posterior_mean_jump_coef2", target_t+1, t, x_t.shape) * x_t
         )
         return posterior_mean
 
@@ -326,8 +354,8 @@ class GaussianDiffusion:
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
             model_output, model_var_values = th.split(model_output, C, dim=1)
-            min_log = _extract_into_tensor(self.posterior_log_variance_clipped, t, x.shape)
-            max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+            min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+            max_log = self._extract("log_betas", t, x.shape)
             # The model_var_values is [-1, 1] for [min_var, max_var].
             frac = (model_var_values + 1) / 2
             model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -379,14 +407,14 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
@@ -408,7 +436,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(x, t, **model_kwargs)
@@ -570,20 +598,22 @@ class GaussianDiffusion:
 
             indices = tqdm(indices)
 
+        if cond_vary:
+            # encoder outputs computed once, one condition per distinct depth
+            cond_cache = encoder.cond_cache(x_0, ori_hidden_states)
+
         for i in indices:
             t = th.tensor([i] * shape[0], device=device)
             with th.no_grad():
                 if cond_vary:
-                    N = shape[0]
-                    t_mapped = th.tensor([self.timestep_map[i]]*N, device=device)
-                    k = diti.t_to_idx.to(device)[t_mapped]
-                    encoder_hidden_states, _, mask, _, _ = encoder(x=x_0, hidden_states=ori_hidden_states, d=k)
+                    k = diti.index(int(self.timestep_map[i]))
+                    encoder_hidden_states, mask = cond_cache(k)
                     model_kwargs = dict(
                         encoder_hidden_states=encoder_hidden_states,
                         mask=mask
                     )
-                    if (encoder_hidden_states.sum() == 0 and dit is not None) or \
-                        (remove_range is not None and k[0].item() in list(remove_range)):
+                    if (dit is not None and cond_cache.is_empty(k)) or \
+                        (remove_range is not None and k in list(remove_range)):
                         print("No condition is given...")
                         model_kwargs = {
                             'y': th.tensor([1000] * len(x_0)).to(x_0.device)
@@ -647,8 +677,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -694,10 +724,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = out["pred_xstart"] * th.sqrt(alpha_bar_next) + th.sqrt(1 - alpha_bar_next) * eps
@@ -988,7 +1018,7 @@ class GaussianDiffusion:
             if not weighting:
                 terms["mse"] = mean_flat((target - model_output) ** 2)
             else:
-                mse = _extract_into_tensor(self.weight, t, target.shape) * ((target - model_output) ** 2)
+                mse = self._extract("weight", t, target.shape) * ((target - model_output) ** 2)
                 terms["mse"] = mean_flat(mse)
             if "vb" in terms:
                 terms["loss"] = terms["mse"] + terms["vb"]
@@ -1073,20 +1103,24 @@ class GaussianDiffusion:
 
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
-    Extract values from a 1-D numpy array for a batch of indices.
-    :param arr: the 1-D numpy array.
+    Extract values from a 1-D numpy array (or device tensor) for a batch of indices.
+    :param arr: the 1-D numpy array or tensor.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if not isinstance(arr, th.Tensor):
+        arr = th.from_numpy(arr).to(device=timesteps.device)
+    res = arr[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res + th.zeros(broadcast_shape, device=timesteps.device)
 
 def _extract_into_tensor_2d(arr, t1, t2, broadcast_shape):
-    res = th.from_numpy(arr).to(device=t1.device)[t1,t2].float()
+    if not isinstance(arr, th.Tensor):
+        arr = th.from_numpy(arr).to(device=t1.device)
+    res = arr[t1,t2].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res + th.zeros(broadcast_shape, device=t1.device)
\ No newline at end of file
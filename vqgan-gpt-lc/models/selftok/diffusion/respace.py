@@ -102,11 +102,16 @@ class SpacedDiffusion(GaussianDiffusion):
     def condition_score(self, cond_fn, *args, **kwargs):
         return super().condition_score(self._wrap_model(cond_fn), *args, **kwargs)
 
+    def to(self, device):
+        super().to(device)
+        self.device_tables["timestep_map"] = th.tensor(self.timestep_map, device=device)
+        return self
+
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.original_num_steps
+            model, self.device_tables.get("timestep_map", self.timestep_map), self.original_num_steps
         )
 
     def _scale_timesteps(self, t):
@@ -122,7 +127,8 @@ class _WrappedModel:
         self.original_num_steps = original_num_steps
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        # no copy when the map is already a device tensor (SpacedDiffusion.to)
+        map_tensor = th.as_tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
         new_ts = map_tensor[ts]
         # if self.rescale_timesteps:
         #     new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
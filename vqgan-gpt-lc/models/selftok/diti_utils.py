@@ -1,8 +1,15 @@
 import torch
+import torch.nn as nn
 
 
-class DiTi:
+class DiTi(nn.Module):
+    """
+    Timestep -> encoder depth tables. t_to_idx / idx_to_max_t are non-persistent buffers
+    (they follow the parent module to the device, checkpoints are unchanged), with host
+    copies for the step loops; look depths up with index(t).
+    """
     def __init__(self, n_timesteps, K, stages, k_per_stage):
+        super().__init__()
         if k_per_stage:
             k_per_stage = k_per_stage.split(",")
             k_per_stage = [int(k) for k in k_per_stage]
@@ -16,33 +23,40 @@ class DiTi:
             stages = None
         self.stages = stages
         self.k_per_stage = k_per_stage
-
-        self.t_to_idx = torch.zeros(n_timesteps).long()
-        self.idx_to_max_t = torch.zeros(K).long()
         self.K = K
+
+        t = torch.arange(n_timesteps, dtype=torch.float64)
         if k_per_stage:
             assert stages is not None
-            current_stage = 0
-            sum_indices = 0
-            for t in range(n_timesteps):
-                if t == self.stages[current_stage]:
-                    sum_indices += self.k_per_stage[current_stage]
-                    current_stage += 1
-                current_steps = float(self.stages[current_stage])
-                current_steps = current_steps - self.stages[current_stage - 1] if current_stage > 0 else current_steps
-                current_k = float(self.k_per_stage[current_stage])
-                t_adj = t - self.stages[current_stage - 1] if current_stage > 0 else t
-                idx = int(float(t_adj) / current_steps * current_k + sum_indices)
-                self.t_to_idx[t] = idx
-                self.idx_to_max_t[idx] = t
+            stage_ends = torch.tensor(stages, dtype=torch.float64)
+            stage_starts = torch.cat([torch.zeros(1, dtype=torch.float64), stage_ends[:-1]])
+            k = torch.tensor(k_per_stage, dtype=torch.float64)
+            sum_indices = torch.cumsum(k, dim=0) - k
+            s = torch.searchsorted(stage_ends, t, right=True)
+            t_to_idx = ((t - stage_starts[s]) / (stage_ends[s] - stage_starts[s]) * k[s] + sum_indices[s]).long()
         else:
-            for t in range(n_timesteps):
-                idx = int(float(t) / (float(n_timesteps) / K))
-                self.t_to_idx[t] = idx
-                self.idx_to_max_t[idx] = t
+            t_to_idx = (t / (float(n_timesteps) / K)).long()
+        # last timestep of every depth (0 for depths without timesteps)
+        idx_to_max_t = torch.zeros(K, dtype=torch.long).scatter_reduce(0, t_to_idx, t.long(), reduce="amax")
+
+        self.register_buffer("t_to_idx", t_to_idx, persistent=False)
+        self.register_buffer("idx_to_max_t", idx_to_max_t, persistent=False)
+        self.t_to_idx_cpu = t_to_idx.clone()
+        self.idx_to_max_t_cpu = idx_to_max_t.clone()
+        self.t_to_idx_list = t_to_idx.tolist()
+
+    def index(self, t):
+        """Depth of timestep t: python int -> int, tensor -> long tensor on t's device."""
+        if not isinstance(t, torch.Tensor):
+            return self.t_to_idx_list[t]
+        if t.device == self.t_to_idx.device:
+            return self.t_to_idx[t.long()]
+        if t.device.type == "cpu":
+            return self.t_to_idx_cpu[t.long()]
+        return self.t_to_idx.to(t.device)[t.long()]
 
     def get_key_timesteps(self):
-        return [0] + (self.idx_to_max_t).tolist()
+        return [0] + (self.idx_to_max_t_cpu).tolist()
 
     def get_timestep_range(self, k):
         key_timesteps = self.get_key_timesteps()
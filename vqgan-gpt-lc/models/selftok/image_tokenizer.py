@@ -48,8 +48,10 @@ def ori_reconstruct(
     add_noise_mode=2,
     cond_vary=False,
     ddim=False,
+    diffusion=None,
 ):
-    diffusion = create_diffusion(str(num_steps))
+    if diffusion is None:
+        diffusion = create_diffusion(str(num_steps))
     N = x0.shape[0]
     device = x0.device
 
@@ -61,7 +63,7 @@ def ori_reconstruct(
             model_kwargs = {"y": y}
         else:
             t_mapped = torch.tensor([diffusion.timestep_map[t]] * N, device=device)
-            k = diti.t_to_idx.to(device)[t_mapped]
+            k = diti.index(t_mapped)
             encoder_hidden_states, ori_hidden_states, mask, _, _ = encoder(x0_e, d=k)
 
             # get noise
@@ -106,7 +108,7 @@ def ori_reconstruct(
     return {"x_t": x_t, "pred_x_0": pred_x_0}
 
 
-def reconstruct(
+def reconstruct_indices(
     num_steps,
     t,
     model,
@@ -117,8 +119,10 @@ def reconstruct(
     encoder: Encoder = None,
     cond_vary=False,
     hidden=None,
+    diffusion=None,
 ):
-    diffusion = create_diffusion(str(num_steps))
+    if diffusion is None:
+        diffusion = create_diffusion(str(num_steps))
     N = indices.shape[0]
     device = indices.device
     print(cond_vary)
@@ -127,7 +131,7 @@ def reconstruct(
             model_kwargs = {"y": y}
         else:
             t_mapped = torch.tensor([diffusion.timestep_map[t]] * N, device=device)
-            k = diti.t_to_idx.to(device)[t_mapped]
+            k = diti.index(t_mapped)
 
             if hidden is None:
                 encoder_hidden_states, ori_hidden_states, mask = encoder.encode_indices(indices, d=k)
@@ -166,8 +170,9 @@ def requires_grad(model, flag=True):
         p.requires_grad = flag
 
 
-def reconstruct(num_steps, t, model, noise=None, x0=None, x0_e=None, y=None, diti=None, encoder=None, add_noise_mode=2, cond_vary=False, ddim=False, dit=None, remove_range=None):
-    diffusion = create_diffusion(str(num_steps))
+def reconstruct(num_steps, t, model, noise=None, x0=None, x0_e=None, y=None, diti=None, encoder=None, add_noise_mode=2, cond_vary=False, ddim=False, dit=None, remove_range=None, diffusion=None):
+    if diffusion is None:
+        diffusion = create_diffusion(str(num_steps))
     N = x0.shape[0]
     device = x0.device
     with torch.no_grad():
@@ -178,7 +183,7 @@ def reconstruct(num_steps, t, model, noise=None, x0=None, x0_e=None, y=None, dit
             model_kwargs = {'y': y}
         else:
             t_mapped = torch.tensor([diffusion.timestep_map[t]]*N, device=device)
-            k = diti.t_to_idx.to(device)[t_mapped]
+            k = diti.index(t_mapped)
             encoder_hidden_states, ori_hidden_states, mask, _, _ = encoder(x0_e, d=k)
             # get noise
             if add_noise_mode==2:
@@ -283,6 +288,12 @@ class ImageTokenizer(nn.Module):
         enable_enc_variable_size=False,    # to enable variable image size for encoder; max size=MAX_LATENT_SIZE after downsampling by vae
         xavier_init=False,
         smart_react=False,
+        decode_steps=100,
+        decode_solver="euler",
+        decode_schedule="uniform",
+        cm_num_scales=18,
+        cm_ema_decay=0.95,
+        cm_decode_steps=2,
         **kwargs,
     ):
         super().__init__()
@@ -291,6 +302,14 @@ class ImageTokenizer(nn.Module):
         self.train_encoder_only = train_encoder_only
         self.pdae = pdae
         self.w_cm = w_cm
+        # sampling steps / ODE solver (RectifiedFlow only) used by rec and decode
+        self.decode_steps = decode_steps
+        self.decode_solver = decode_solver
+        self.decode_schedule = decode_schedule
+        # consistency distillation (w_cm != 0): discretization of the teacher ODE, target EMA, student decode steps
+        self.cm_num_scales = cm_num_scales
+        self.cm_ema_decay = cm_ema_decay
+        self.cm_decode_steps = cm_decode_steps
         # 253-272
         # Create model:
         predict_xstart = False if init_with_pretrained else True
@@ -389,6 +408,18 @@ class ImageTokenizer(nn.Module):
             hf_logger.info(f"model loading status: {self.model.load_state_dict(state_dict['model'])}")
             hf_logger.info(f"encoder loading status: {self.encoder.load_state_dict(state_dict['encoder'])}")
 
+        # few-step student decoder distilled from self.model, initialized from it, and its EMA target
+        self.student = None
+        if self.w_cm != 0.0:
+            assert self.model_name == 'MMDiT_XL', "consistency distillation is implemented for the rectified flow decoder"
+            self.student = deepcopy(self.model)
+            self.student.train_filter, self.student.freeze_filter = None, []
+            self.student.freeze()
+            self.cm_target = deepcopy(self.student)
+            requires_grad(self.cm_target, False)
+            self.cm_target.eval()
+        self.cm_step_hook = False
+
         hf_logger.info(f"ScDiT Parameters: {sum(p.numel() for p in self.model.parameters()):,}")
         hf_logger.info(f"Encoder Parameters: {sum(p.numel() for p in self.encoder.parameters()):,}")
 
@@ -397,6 +428,9 @@ class ImageTokenizer(nn.Module):
         w_prev = np.array([float(t+1.)/self.T for t in range(self.T)])
         self.w_prev = w_prev / w_prev.sum()
 
+        # reconstruction samplers, see get_sampler
+        self.samplers = {}
+
         # objective weight
     
     def load_pretrain_teacher(self, teacher_path):
@@ -411,14 +445,61 @@ class ImageTokenizer(nn.Module):
         else:
             self.model.load_state_dict(state_dict, strict=False)
 
+    def get_sampler(self, num_steps, noise_schedule="linear", timestep_respacing=None, device=None):
+        """
+        Spaced diffusion used by rec/decode, built once per (num_steps, schedule, respacing)
+        and kept with its coefficient tables on device.
+        """
+        if timestep_respacing is None:
+            timestep_respacing = str(num_steps)
+        key = (num_steps, noise_schedule, timestep_respacing, None if device is None else str(device))
+        if key not in self.samplers:
+            diffusion = create_diffusion(timestep_respacing, noise_schedule=noise_schedule)
+            self.samplers[key] = diffusion if device is None else diffusion.to(device)
+        return self.samplers[key]
+
+    @torch.no_grad()
+    def update_cm_target(self):
+        for (_, target), (_, param) in zip(self.cm_target.named_parameters(), self.student.named_parameters()):
+            target.mul_(self.cm_ema_decay).add_(param.detach(), alpha=1 - self.cm_ema_decay)
+
+    def register_cm_step_hook(self, optimizer):
+        # target EMA updated once per optimizer step, independent of gradient accumulation and eval forwards;
+        # optimizers without step hooks (deepspeed): set cm_step_hook = True and call update_cm_target() after each step
+        self.cm_step_hook = True
+        return optimizer.register_step_post_hook(lambda *args: self.update_cm_target())
+
+    def consistency_loss(self, x, encoder_hidden_states, attn_mask):
+        # without a step hook the target EMA is updated by training forwards, lagging the student by one step
+        if not self.cm_step_hook and self.student.training and torch.is_grad_enabled():
+            self.update_cm_target()
+        # the three networks see the same condition, with the same null-condition drops
+        drop_ids = torch.zeros(x.shape[0], dtype=torch.bool, device=x.device)
+        if self.student.training:
+            drop_ids = torch.rand(x.shape[0], device=x.device) < self.student.class_dropout_prob
+        encoder_hidden_states = encoder_hidden_states.detach()
+
+        def bind(model):
+            prepared = model.prepare_context(encoder_hidden_states, attn_mask, drop_ids=drop_ids)
+            return lambda x_t, t: model(x_t, t, prepared_context=prepared)
+
+        with torch.no_grad():
+            teacher, target = bind(self.model), bind(self.cm_target)
+        loss_dict = self.diffusion.consistency_losses(bind(self.student), target, teacher, x, num_scales=self.cm_num_scales)
+        return loss_dict["loss"].mean()
+
     def set_train(self):
         self.model.train()
         self.encoder.train()
+        if self.student is not None:
+            self.student.train()
         # self.ema.eval()
 
     def set_eval(self):
         self.model.eval()
         self.encoder.eval()
+        if self.student is not None:
+            self.student.eval()
         # self.ema.eval()
 
     def get_log(self, log_dict):
@@ -437,11 +518,11 @@ class ImageTokenizer(nn.Module):
         if self.model_name == 'MMDiT_XL':
             t = self.diffusion.sample_t(x.shape[0]).cuda()
             T = torch.floor(t * 1000).int().clamp(0, 999)
-            k_batch = self.diti.t_to_idx.to(device)[T]
+            k_batch = self.diti.index(T)
         else:
             t = torch.randint(0, self.diffusion.num_timesteps, (x.shape[0],), device=device)
-            k_batch = self.diti.t_to_idx.to(device)[t]
-        k_batch = self.diti.t_to_idx.to(device)[torch.zeros_like(t).long()+999] if full_tokens else k_batch
+            k_batch = self.diti.index(t)
+        k_batch = self.diti.index(torch.zeros_like(t).long()+999) if full_tokens else k_batch
         if not self.encoder.training:
             with torch.no_grad():
                 encoder_hidden_states, ori_hidden_states, attn_mask, quan_loss, log_dict = self.encoder(x=x, d=k_batch)
@@ -484,7 +565,8 @@ class ImageTokenizer(nn.Module):
         dm_loss = loss_dict["loss"].mean()
 
         if self.w_cm != 0.0:
-            raise NotImplementedError()
+            cm_loss = self.consistency_loss(x, encoder_hidden_states, attn_mask)
+            x0_p_dit = None
         else:
             cm_loss = torch.tensor(0.0).to(device)
             x0_p_dit = None
@@ -505,21 +587,58 @@ class ImageTokenizer(nn.Module):
         }
         return loss, log_dict
         
-    def rec(self, x_0):
+    def full_depth(self, n, device):
+        return torch.full((n,), self.diti.index(-1), dtype=torch.long, device=device)
+
+    def sample_flow(self, encoder_hidden_states, mask, noise, num_steps=None, solver=None, cfg_scale=1.0, cfg_interval=None,
+                    use_student=False):
+        # RectifiedFlow decode of fixed encoder conditions; cfg against the learned null condition.
+        # use_student: few-step consistency decode with the distilled student (cm_decode_steps by default)
+        if use_student:
+            assert self.student is not None, "no consistency student, train with w_cm != 0"
+            return self.diffusion.consistency_sample(
+                self.student,
+                noise.shape,
+                noise,
+                model_kwargs=dict(encoder_hidden_states=encoder_hidden_states, mask=mask),
+                num_steps=self.cm_decode_steps if num_steps is None else num_steps,
+                device=noise.device,
+            )
+        return self.diffusion.sample_ode(
+            self.model.forward,
+            noise.shape,
+            noise,
+            model_kwargs=dict(encoder_hidden_states=encoder_hidden_states, mask=mask),
+            num_steps=self.decode_steps if num_steps is None else num_steps,
+            solver=self.decode_solver if solver is None else solver,
+            schedule=self.decode_schedule,
+            unconditional_guidance_scale=cfg_scale,
+            cfg_interval=cfg_interval,
+            device=noise.device,
+        )
+
+    def rec(self, x_0, num_steps=None, solver=None, use_student=False):
         noise = torch.randn_like(x_0, device=x_0.device)
         with torch.no_grad():
-            recon = ori_reconstruct(
-                100,
-                99,
-                self.model,
-                noise,
-                x_0,
-                x_0,
-                diti=self.diti,
-                encoder=self.encoder,
-                add_noise_mode=0,
-                cond_vary=False,
-            )["pred_x_0"]
+            if self.model_name == 'MMDiT_XL':
+                encoder_hidden_states, _, mask, _, _ = self.encoder(x_0, d=self.full_depth(x_0.shape[0], x_0.device))
+                recon = self.sample_flow(encoder_hidden_states, mask, noise, num_steps, solver, use_student=use_student)
+            else:
+                assert solver in (None, "euler"), "solver %s needs the rectified flow model (MMDiT_XL)" % solver
+                num_steps = self.decode_steps if num_steps is None else num_steps
+                recon = ori_reconstruct(
+                    num_steps,
+                    num_steps - 1,
+                    self.model,
+                    noise,
+                    x_0,
+                    x_0,
+                    diti=self.diti,
+                    encoder=self.encoder,
+                    add_noise_mode=0,
+                    cond_vary=False,
+                    diffusion=self.get_sampler(num_steps, device=x_0.device),
+                )["pred_x_0"]
             img_recon = self.vae.decode(recon / 0.18215).sample
             norm_ip(img_recon, -1, 1)
 
@@ -536,24 +655,33 @@ class ImageTokenizer(nn.Module):
             else:
                 # x0 = x.squeeze(dim=1)
                 x0 = x
-            _, indices, encoder_hidden_states = self.encoder(x0, d=None)
+            encoder_hidden_states, indices = self.encoder(x0, d=None)
 
         return encoder_hidden_states, indices
 
-    def decode(self, indices, shape, hidden=None):
+    def decode(self, indices, shape, hidden=None, num_steps=None, solver=None, cfg_scale=1.0, cfg_interval=None, use_student=False):
         noise = torch.randn(shape, device=indices.device)
         with torch.no_grad():
-            recon = reconstruct(
-                100,
-                99,
-                self.model,
-                noise,
-                indices,
-                diti=self.diti,
-                encoder=self.encoder,
-                cond_vary=self.cond_vary,
-                hidden=hidden,
-            )["pred_x_0"]
+            if self.model_name == 'MMDiT_XL':
+                encoder_hidden_states, _, mask = self.encoder.encode_indices(
+                    indices, hidden_states=hidden, d=self.full_depth(indices.shape[0], indices.device)
+                )
+                recon = self.sample_flow(encoder_hidden_states, mask, noise, num_steps, solver, cfg_scale, cfg_interval, use_student)
+            else:
+                assert solver in (None, "euler"), "solver %s needs the rectified flow model (MMDiT_XL)" % solver
+                num_steps = self.decode_steps if num_steps is None else num_steps
+                recon = reconstruct_indices(
+                    num_steps,
+                    num_steps - 1,
+                    self.model,
+                    noise,
+                    indices,
+                    diti=self.diti,
+                    encoder=self.encoder,
+                    cond_vary=getattr(self, "cond_vary", False),
+                    hidden=hidden,
+                    diffusion=self.get_sampler(num_steps, device=indices.device),
+                )["pred_x_0"]
             img_recon = self.vae.decode(recon / 0.18215).sample
             norm_ip(img_recon, -1, 1)
 
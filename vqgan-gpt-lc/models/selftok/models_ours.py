@@ -6,7 +6,7 @@ from .sd3.mmdit import PatchEmbed
 from mimogpt.models.selftok.models import DiT, DiTBlock, get_2d_sincos_pos_embed, modulate, TimestepEmbedder, FinalLayer
 import torch.nn.functional as F
 from mimogpt.tokenizer.selftok import LFQ
-from .quantizer import construct_quantizer
+from .quantizer import construct_quantizer, GroupedVectorQuantizer
 from .modules import DiTCrossAttnBlock, ViTBlock, QFormer, DualBlock, ConcatBlock, DiTDualBlock
 from einops import rearrange
 # import xformers.ops
@@ -33,7 +33,8 @@ class Encoder(nn.Module):
         quantize_kmeans_init=True, decay=0.99, dead_code_threshold=0.0, quantizer_temp=10.0,
         use_cosine_sim=True, pre_norm=False, post_norm=True, lfq=False,
         k_embed=False, encoder_out_dim=None, ema_update=True, gradient_checkpointing=False, 
-        pos_embed_max_size=None, smart_react=False, **kwargs
+        pos_embed_max_size=None, smart_react=False, grouped_quantizer=False, groups_per_chunk=None,
+        telemetry_interval=1, reservoir_size=1024, code_block_size=None, **kwargs
     ):
         super().__init__()
         self.K = K
@@ -106,7 +107,10 @@ class Encoder(nn.Module):
                     commitment_weight = self.w_commit,   # the weight on the commitment loss
                     dead_code_threshold = dead_code_threshold,
                     use_ema = ema_update,
-                    smart_re_K=smart_re_K
+                    smart_re_K=smart_re_K,
+                    telemetry_interval=telemetry_interval,
+                    reservoir_size=reservoir_size,
+                    code_block_size=code_block_size,
                 )
             else:
                 self.quantizer = LFQ(
@@ -122,7 +126,21 @@ class Encoder(nn.Module):
         else:
             n_e_list = [self.n_e]*self.K if not n_e_cfg else n_e_cfg
             self.n_e_list = n_e_list
-            if not lfq:
+            if not lfq and grouped_quantizer:
+                assert not ema_update, "grouped_quantizer stacks VectorQuantizer_L2norm codebooks, set ema_update=False"
+                self.quantizer = GroupedVectorQuantizer(
+                    K=self.K,
+                    n_e_list=n_e_list,
+                    latent_dim=encoder_out_dim,
+                    output_dim=encoder_hidden_size,
+                    e_dim=code_dim,
+                    diversity_weight=self.w_diversity,
+                    commitment_weight=self.w_commit,
+                    dead_code_threshold=dead_code_threshold,
+                    groups_per_chunk=groups_per_chunk,
+                    code_block_size=code_block_size,
+                )
+            elif not lfq:
                 self.quantizer = nn.ModuleList([
                     construct_quantizer(
                         latent_dim =encoder_out_dim,
@@ -133,7 +151,10 @@ class Encoder(nn.Module):
                         diversity_weight = self.w_diversity,
                         commitment_weight = self.w_commit,   # the weight on the commitment loss
                         dead_code_threshold = dead_code_threshold,
-                        use_ema = ema_update
+                        use_ema = ema_update,
+                        telemetry_interval=telemetry_interval,
+                        reservoir_size=reservoir_size,
+                        code_block_size=code_block_size,
                     ) for k in range(self.K)]
                 )
             else:
@@ -257,6 +278,16 @@ class Encoder(nn.Module):
                 commitment_loss = log_dict["commitment_loss"]
                 diversity_entropy = log_dict["diversity_entropy"]
                 perplexity = log_dict["perplexity"]
+            elif isinstance(self.quantizer, GroupedVectorQuantizer):
+                # the grouped output already holds the codebook vectors, no re-embedding from indices
+                outs_q, indices, loss, log_dict = self.quantizer(to_quantizer_features)
+                all_indicies = [indices]
+                perplexity_list, deterministic_list = log_dict['perplexity_list'], log_dict['deterministic_list']
+                num_active_codes = log_dict['num_active_codes']
+                num_reactivate = log_dict["num_reactivate"]
+                commitment_loss = log_dict["commitment_loss"]
+                diversity_entropy = log_dict["diversity_entropy"]
+                perplexity = log_dict["perplexity"]
             else:
                 token_num = int(outs.shape[1] / self.K)
                 outs_q, loss, perplexity, num_active_codes, num_reactivate, all_indicies = [], 0.0, 0.0, 0.0, 0.0, []
@@ -331,6 +362,62 @@ class Encoder(nn.Module):
         B, N, P = outs_q.shape[0], outs_q.shape[1], x.shape[1]
         enc_mask = torch.arange(self.K).repeat_interleave(P)[None, ...].expand(B,N).to(d.device)
         return (enc_mask <= d.unsqueeze(1))
+
+    def mask_outs(self, x, outs_q, d):
+        """
+        encoder_hidden_states and attention mask for depths d: the quantized outputs
+        of the first d[i] + 1 depths of every sample, the rest zeroed.
+        x: patch embedded input, outs_q: (N, K * P, C) quantized outputs
+        """
+        enc_mask = self.get_encoder_mask(x, outs_q, d)
+        mask_v = enc_mask[..., None].expand_as(outs_q)
+        encoder_hidden_states = outs_q * mask_v
+        if self.keep_mask is not None:
+            keep_mask = self.keep_mask.to(x.device)
+            encoder_hidden_states = encoder_hidden_states * keep_mask[...,None][None,...]
+        return encoder_hidden_states, enc_mask
+
+    def get_output_from_indices(self, indices):
+        # (N, K * P) code indices -> (N, K * P, C) quantized outputs, as computed by forward
+        B = indices.shape[0]
+        if self.share_codebook or isinstance(self.quantizer, GroupedVectorQuantizer):
+            outs_q = self.quantizer.get_output_from_indices(indices if not self.share_codebook else indices.view(-1, 1))
+            outs_q = outs_q.view(B, indices.shape[1], -1)
+        else:
+            outs_q = []
+            for cur_quantizer, cur_indices in zip(self.quantizer, indices.chunk(self.K, dim=1)):
+                cur_outs_q = cur_quantizer.get_output_from_indices(cur_indices.reshape(-1, 1))
+                outs_q.append(cur_outs_q.view(B, -1, cur_outs_q.shape[-1]))
+            outs_q = torch.cat(outs_q, 1)
+        if self.k_embed is not None:
+            outs_q = outs_q + self.k_embed(self.k_embed_indices.expand(B, -1))
+        if self.post_norm:
+            outs_q = self.final_layer_norm3(outs_q)
+        return outs_q
+
+    def encode_indices(self, indices, hidden_states=None, d=None):
+        """
+        forward from code indices (N, K * P) instead of images: returns
+        (encoder_hidden_states, outs_q, attn_mask) for depths d, reusing hidden_states
+        (the quantized outputs of these indices) when given.
+        """
+        outs_q = self.get_output_from_indices(indices) if hidden_states is None else hidden_states
+        # mask_outs only needs the number of tokens per depth from the embedded input
+        tokens = outs_q[:, :outs_q.shape[1] // self.K]
+        encoder_hidden_states, attn_mask = self.mask_outs(tokens, outs_q, d)
+        return encoder_hidden_states, outs_q, attn_mask
+
+    def cond_cache(self, x=None, hidden_states=None):
+        return EncoderCondCache(self, x, hidden_states)
+
+    def embed(self, x):
+        if self.pos_embed_max_size is not None:
+            hw = x.shape[-2:]
+            x = self.x_embedder(x)
+            x = x + self.cropped_pos_embed(hw)
+        else:
+            x = self.x_embedder(x) + self.pos_embed
+        return x
     
     def calc_entropy(self, p):
         ap = p.mean(dim=0)
@@ -343,8 +430,13 @@ class Encoder(nn.Module):
         return entropy_to_min
     
     def get_perplexity_list(self, indices, chunks=50):
-        probs = F.one_hot(indices, num_classes=self.n_e).float().mean(dim=0)
-        chunk_probs = torch.stack([t.mean(dim=0) for t in probs.tensor_split(chunks, dim=0)],dim=0).float()
+        # code frequencies per chunk of token positions, counted without the (B, L, n_e) one-hot
+        B, L = indices.shape
+        positions = torch.arange(L, device=indices.device).tensor_split(chunks)
+        chunk_ids = torch.cat([torch.full_like(t, i) for i, t in enumerate(positions)])
+        chunk_sizes = torch.tensor([len(t) for t in positions], device=indices.device, dtype=torch.float)
+        counts = torch.bincount((chunk_ids * self.n_e + indices).flatten(), minlength=len(positions) * self.n_e)
+        chunk_probs = counts.view(len(positions), self.n_e).float() / (B * chunk_sizes[:, None])
         if not hasattr(self, 'tracker_per_k'):
             self.tracker_per_k = torch.zeros_like(chunk_probs)
             self.tracker_per_k += 1.0 / self.n_e
@@ -382,12 +474,7 @@ class Encoder(nn.Module):
         x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
         d: N, the depth for each sample
         """
-        if self.pos_embed_max_size is not None:
-            hw = x.shape[-2:]
-            x = self.x_embedder(x)
-            x = x + self.cropped_pos_embed(hw)
-        else:
-            x = self.x_embedder(x) + self.pos_embed
+        x = self.embed(x)
         if hidden_states is None:
             outs = self.get_encoder_outs(x)
             if self.pre_norm:
@@ -406,6 +493,15 @@ class Encoder(nn.Module):
                 commitment_loss = log_dict["commitment_loss"]
                 diversity_entropy = log_dict["diversity_entropy"]
                 perplexity = log_dict["perplexity"]
+            elif isinstance(self.quantizer, GroupedVectorQuantizer):
+                outs_q, indices, loss, log_dict = self.quantizer(to_quantizer_features)
+                all_indicies = [indices]
+                perplexity_list, deterministic_list = log_dict['perplexity_list'], log_dict['deterministic_list']
+                num_active_codes = log_dict['num_active_codes']
+                num_reactivate = log_dict["num_reactivate"]
+                commitment_loss = log_dict["commitment_loss"]
+                diversity_entropy = log_dict["diversity_entropy"]
+                perplexity = log_dict["perplexity"]
             else:
                 token_num = int(outs.shape[1] / self.K)
                 outs_q, loss, perplexity, num_active_codes, num_reactivate, all_indicies = [], 0.0, 0.0, 0.0, 0.0, []
@@ -462,26 +558,53 @@ class Encoder(nn.Module):
         # mask_nograd = mask_nograd[..., None].expand_as(outs)
         # mask_grad = mask_grad[..., None].expand_as(outs)
         # encoder_hidden_states = outs * mask_grad + outs.detach() * mask_nograd
-        enc_mask = self.get_encoder_mask(x, outs_q, d)
-        attn_mask = enc_mask
-        mask_v = enc_mask[..., None].expand_as(outs_q)
-
         # encoder_hidden_states = self.final_layer_norm(outs_q * mask)
-        encoder_hidden_states = outs_q * mask_v
-        
+        encoder_hidden_states, attn_mask = self.mask_outs(x, outs_q, d)
+
         # final_attn_mask = torch.ones(attn_mask.shape, dtype=attn_mask.dtype, device=attn_mask.device)
         # for idx in range(attn_mask.shape[0]):
         #     if idx in zero_cond_idx:
         #         final_attn_mask[idx,...] = zero_mask
         #     else:
         #         final_attn_mask[idx,...] = attn_mask[idx,...]
-        
-        if self.keep_mask is not None:
-            keep_mask = self.keep_mask.to(x.device)
-            encoder_hidden_states = encoder_hidden_states * keep_mask[...,None][None,...]
-            # final_attn_mask = (final_attn_mask * keep_mask[None, ...]).bool()
         return encoder_hidden_states, outs_q, attn_mask, loss, log_dict
-    
+
+
+class EncoderCondCache:
+    """
+    Encoder conditions for samplers that vary the depth with the timestep (cond_vary).
+    The patch embedding and the quantized outputs are computed once; the condition
+    of a depth is a prefix mask of them (Encoder.mask_outs), kept for the steps
+    that share the depth.
+    """
+    def __init__(self, encoder, x=None, hidden_states=None):
+        self.encoder = encoder
+        self.x = x
+        self.outs_q = hidden_states
+        self.tokens = None
+        self.conds = {}
+        self.empty = {}
+
+    @torch.no_grad()
+    def __call__(self, k):
+        # k: python int, the depth shared by the whole batch
+        if k not in self.conds:
+            d = torch.full((self.x.shape[0],), k, dtype=torch.long, device=self.x.device)
+            if self.outs_q is None:
+                encoder_hidden_states, self.outs_q, mask, _, _ = self.encoder(x=self.x, d=d)
+                self.conds[k] = (encoder_hidden_states, mask)
+            else:
+                if self.tokens is None:
+                    self.tokens = self.encoder.embed(self.x)
+                self.conds[k] = self.encoder.mask_outs(self.tokens, self.outs_q, d)
+        return self.conds[k]
+
+    def is_empty(self, k):
+        # no condition at depth k (all masked out); one host sync per depth
+        if k not in self.empty:
+            self.empty[k] = bool(self(k)[0].sum() == 0)
+        return self.empty[k]
+
 
 class DiTiEncoder(Encoder):
     def __init__(
@@ -23,6 +23,107 @@ def calc_entropy(input_tensor, min_ref=None):
     entropy_to_min = entropy_to_min.mean()
     return entropy_to_max, entropy_to_min
 
+class ChunkedCodeAssignment(torch.autograd.Function):
+    """
+    Nearest code, H(E(p)) and E(H(p)) of p = softmax(scale * d) (see calc_entropy) without
+    materializing the (N, n_e) distances: the codebook is processed in blocks of block_size
+    codes with an online log-sum-exp, so the peak memory is O(N * block_size).
+    z: (G, N, D), embedding: (G, n_e, D) for G independent codebooks, valid: (G, n_e) bool or None.
+    d is the squared distance, or the dot product for similarity=True (EMAQuantizer).
+    Only H(E(p)) (entropy_to_max, the diversity term) is differentiable; the backward
+    recomputes the blocks.
+    """
+    @staticmethod
+    def blocks(z, embedding, valid, scale, block_size, similarity):
+        z_sq = torch.sum(z**2, dim=-1, keepdim=True)
+        for start in range(0, embedding.shape[1], block_size):
+            e = embedding[:, start:start + block_size]
+            if similarity:
+                d = torch.bmm(z, e.transpose(1, 2))
+            else:
+                d = z_sq + torch.sum(e**2, dim=-1)[:, None, :] - 2 * torch.bmm(z, e.transpose(1, 2))
+            s = scale * d
+            if valid is not None:
+                mask = valid[:, None, start:start + block_size]
+                d, s = d.masked_fill(~mask, float("inf")), s.masked_fill(~mask, float("-inf"))
+            yield start, e, d, s
+
+    @staticmethod
+    def forward(ctx, z, embedding, valid, scale, block_size, similarity):
+        ctx.dtypes = (z.dtype, embedding.dtype)
+        z, embedding = z.float(), embedding.float()
+        G, N, _ = z.shape
+        neg = torch.finfo(z.dtype).min
+        m = z.new_full((G, N), neg)
+        l, t = z.new_zeros(G, N), z.new_zeros(G, N)
+        best_d, best_i = z.new_full((G, N), float("inf")), torch.zeros(G, N, dtype=torch.long, device=z.device)
+        for start, _, d, s in ChunkedCodeAssignment.blocks(z, embedding, valid, scale, block_size, similarity):
+            block_d, block_i = d.min(dim=-1)
+            better = block_d < best_d
+            best_d, best_i = torch.where(better, block_d, best_d), torch.where(better, block_i + start, best_i)
+            m_new = torch.maximum(m, s.amax(dim=-1))
+            w = torch.exp(s - m_new[..., None])
+            rescale = torch.exp(m - m_new)
+            l = l * rescale + w.sum(dim=-1)
+            t = t * rescale + torch.where(w > 0, w * s, torch.zeros_like(w)).sum(dim=-1)
+            m = m_new
+        lse = m + torch.log(l)
+        # E(H(p)): H(p_i) = lse_i - sum_j p_ij s_ij
+        entropy_to_min = (lse - t / l).mean(dim=-1)
+        # H(E(p)) from the batch-averaged probabilities, one more pass over the blocks
+        ap = torch.cat([
+            torch.exp(s - lse[..., None]).mean(dim=1)
+            for _, _, _, s in ChunkedCodeAssignment.blocks(z, embedding, valid, scale, block_size, similarity)
+        ], dim=-1)
+        entropy_to_max = -torch.xlogy(ap, ap).sum(dim=-1)
+
+        ctx.save_for_backward(z, embedding, lse, ap)
+        ctx.valid, ctx.scale, ctx.block_size, ctx.similarity = valid, scale, block_size, similarity
+        ctx.mark_non_differentiable(best_i, entropy_to_min)
+        return best_i, entropy_to_max, entropy_to_min
+
+    @staticmethod
+    def backward(ctx, grad_indices, grad_entropy, grad_entropy_to_min):
+        z, embedding, lse, ap = ctx.saved_tensors
+        valid, scale, block_size, similarity = ctx.valid, ctx.scale, ctx.block_size, ctx.similarity
+        N = z.shape[1]
+        # dH/dp_ij = g_j, softmax backward: dL/ds_ij = p_ij * (g_j - sum_k p_ik g_k)
+        g = -grad_entropy[:, None] * (torch.log(ap.clamp(min=1e-30)) + 1) / N
+        if valid is not None:
+            g = g * valid
+        r = z.new_zeros(lse.shape)
+        for start, _, _, s in ChunkedCodeAssignment.blocks(z, embedding, valid, scale, block_size, similarity):
+            r = r + torch.bmm(torch.exp(s - lse[..., None]), g[:, start:start + s.shape[-1], None])[..., 0]
+        grad_z, grad_embedding = torch.zeros_like(z), []
+        for start, e, _, s in ChunkedCodeAssignment.blocks(z, embedding, valid, scale, block_size, similarity):
+            grad_s = scale * torch.exp(s - lse[..., None]) * (g[:, None, start:start + s.shape[-1]] - r[..., None])
+            if similarity:
+                grad_z += torch.bmm(grad_s, e)
+                grad_embedding.append(torch.bmm(grad_s.transpose(1, 2), z))
+            else:
+                # the |z|^2 term vanishes: sum_j dL/ds_ij = 0
+                grad_z -= 2 * torch.bmm(grad_s, e)
+                grad_embedding.append(2 * (e * grad_s.sum(dim=1)[..., None] - torch.bmm(grad_s.transpose(1, 2), z)))
+        grad_embedding = torch.cat(grad_embedding, dim=1)
+        return grad_z.to(ctx.dtypes[0]), grad_embedding.to(ctx.dtypes[1]), None, None, None, None
+
+
+def chunked_code_assignment(z, embedding, scale=10.0, block_size=4096, valid=None, similarity=False):
+    """
+    Streaming replacement of (distances, calc_entropy(scale * d), argmin(d)).
+    z: (N, D) with embedding (n_e, D), or (G, N, D) with (G, n_e, D).
+    Returns the code indices and (entropy_to_max, entropy_to_min).
+    """
+    grouped = z.dim() == 3
+    if not grouped:
+        z, embedding = z[None], embedding[None]
+        valid = None if valid is None else valid[None]
+    indices, entropy_to_max, entropy_to_min = ChunkedCodeAssignment.apply(z, embedding, valid, scale, block_size, similarity)
+    if not grouped:
+        indices, entropy_to_max, entropy_to_min = indices[0], entropy_to_max[0], entropy_to_min[0]
+    return indices, entropy_to_max, entropy_to_min
+
+
 def ema_inplace(old, new, decay):
     old.mul_(decay).add_(new * (1 - decay))
 
@@ -30,7 +131,8 @@ def ema_inplace(old, new, decay):
 def construct_quantizer(
         latent_dim, code_dim, output_dim, codebook_size,
         use_ema, diversity_weight, commitment_weight,
-        dead_code_threshold=0.0, ema_decay=0.99, smart_re_K=0):
+        dead_code_threshold=0.0, ema_decay=0.99, smart_re_K=0, telemetry_interval=1, reservoir_size=1024,
+        code_block_size=None):
     if use_ema:
         constructor = VectorQuantize_EMA
         args = dict(
@@ -69,11 +171,78 @@ def construct_quantizer(
             dead_code_threshold=dead_code_threshold,
             commitment_weight=commitment_weight,
             diversity_weight=diversity_weight,
+            telemetry_interval=telemetry_interval,
+            reservoir_size=reservoir_size,
+            code_block_size=code_block_size,
         )
     return constructor(**args)
 
 
-class VectorQuantizer_L2norm(nn.Module):
+class QuantizerTelemetry:
+    """
+    Deferred statistics for the single-codebook quantizers (telemetry_interval > 1).
+    Code assignment counts and logged losses are summed on device and all-reduced in
+    one collective every telemetry_interval forwards, with one host copy. Dead codes
+    are replaced at the same time from a per-rank reservoir of reservoir_size encoder
+    outputs (uniform over the interval), gathered only when some code is dead.
+    Between reductions log_dict repeats the last reduced values.
+    """
+    LOG_KEYS = ('num_active_codes', 'num_reactivate', 'perplexity', 'commitment_loss', 'deterministic_entropy', 'diversity_entropy')
+
+    def init_telemetry(self, telemetry_interval=1, reservoir_size=1024):
+        self.telemetry_interval = telemetry_interval
+        self.reservoir_size = reservoir_size
+        self.telemetry_steps = 0
+        self.telemetry_sums = None
+        self.reservoir = None
+        self.reservoir_seen = 0
+        self.last_log_dict = {key: 0.0 for key in self.LOG_KEYS}
+
+    def observe(self, samples):
+        # reservoir sampling without host syncs: rejected samples are written to the extra last row
+        samples = samples.detach().float()
+        n, R = samples.shape[0], self.reservoir_size
+        if self.reservoir is None or self.reservoir.device != samples.device:
+            self.reservoir = samples.new_zeros(R + 1, samples.shape[-1])
+        pos = torch.arange(self.reservoir_seen, self.reservoir_seen + n, device=samples.device)
+        keep = torch.rand(n, device=samples.device) * (pos + 1) < R
+        slot = torch.where(pos < R, pos, torch.randint(0, R, (n,), device=samples.device))
+        slot = torch.where(keep, slot, torch.full_like(slot, R))
+        self.reservoir.index_copy_(0, slot, samples)
+        self.reservoir_seen += n
+
+    def telemetry_log_dict(self, indices, samples, commit_loss, deterministic_entropy, diversity_entropy):
+        self.observe(samples)
+        counts = torch.bincount(indices.flatten(), minlength=self.n_e).float()
+        values = torch.cat([
+            counts, counts.new_tensor([indices.numel()]),
+            torch.stack([t.detach().float() for t in (commit_loss, deterministic_entropy, diversity_entropy)]),
+        ])
+        self.telemetry_sums = values if self.telemetry_sums is None else self.telemetry_sums + values
+        self.telemetry_steps += 1
+        if self.telemetry_steps < self.telemetry_interval:
+            return self.last_log_dict
+
+        sums, steps = self.telemetry_sums, self.telemetry_steps
+        self.telemetry_sums, self.telemetry_steps = None, 0
+        dist.all_reduce(sums)
+        counts, total_codes = sums[:self.n_e], sums[self.n_e]
+        losses = sums[self.n_e + 1:] / (steps * dist.get_world_size())
+        self.update_cluster_size(counts, total_codes, steps)
+        probs = counts / total_codes
+        perplexity = torch.exp(-torch.sum(probs * torch.log(probs + 1e-10)))
+        expired_codes = self.dead_codes()
+        values = torch.cat([
+            torch.stack([self.active_codes().float(), expired_codes.sum().float(), perplexity]), losses,
+        ]).tolist()
+        if values[1] > 0:
+            self.replace(self.reservoir[:min(self.reservoir_seen, self.reservoir_size)], replace_mask=expired_codes)
+        self.reservoir_seen = 0
+        self.last_log_dict = dict(zip(self.LOG_KEYS, values))
+        return self.last_log_dict
+
+
+class VectorQuantizer_L2norm(nn.Module, QuantizerTelemetry):
     """
     Improved version over VectorQuantizer, can be used as a drop-in replacement. Mostly
     avoids costly matrix multiplications and allows for post-hoc remapping of indices.
@@ -97,11 +266,15 @@ class VectorQuantizer_L2norm(nn.Module):
         sane_index_shape=True,
         legacy=True,
         preserve_gradient=True,
+        telemetry_interval=1,
+        reservoir_size=1024,
+        code_block_size=None,
     ):
         super().__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.beta = beta
+        self.code_block_size = code_block_size
         self.legacy = legacy
         self.w_commit = commitment_weight
         self.w_diversity = diversity_weight
@@ -115,6 +288,7 @@ class VectorQuantizer_L2norm(nn.Module):
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
         self.register_buffer("cluster_size", torch.ones(self.n_e) * dead_code_threshold * 2.0)      # avg cluster size for each code among n_e codes
         self.reset_cluster_size = dead_code_threshold * 1.2
+        self.init_telemetry(telemetry_interval, reservoir_size)
         self.remap = remap
         if self.remap is not None:
             self.register_buffer("used", torch.tensor(np.load(self.remap)))
@@ -161,24 +335,29 @@ class VectorQuantizer_L2norm(nn.Module):
         z_flattened_ori = z.view(-1, self.e_dim)
         # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
         z_flattened = self.norm(z_flattened_ori)
-        num_reactivate = self.expire_codes(z_flattened_ori, None)
+        deferred = self.telemetry_interval > 1
+        num_reactivate = 0 if deferred else self.expire_codes(z_flattened_ori, None)
         embedding_norm = self.norm(self.embedding.weight)
-        d = (
-            torch.sum(z_flattened**2, dim=1, keepdim=True)
-            + torch.sum(embedding_norm**2, dim=1)
-            - 2 * torch.einsum("bd,dn->bn", z_flattened, rearrange(embedding_norm, "n d -> d n"))
-        )
-        # d = einsum('n d, c d -> n c', z_flattened, embedding_norm)
+        if self.code_block_size:
+            min_encoding_indices, entropy_to_max, entropy_to_min = chunked_code_assignment(
+                z_flattened, embedding_norm, scale=10.0, block_size=self.code_block_size)
+        else:
+            d = (
+                torch.sum(z_flattened**2, dim=1, keepdim=True)
+                + torch.sum(embedding_norm**2, dim=1)
+                - 2 * torch.einsum("bd,dn->bn", z_flattened, rearrange(embedding_norm, "n d -> d n"))
+            )
+            # d = einsum('n d, c d -> n c', z_flattened, embedding_norm)
 
-        scaled_distances = d * 10.0
-        entropy_to_max, entropy_to_min = calc_entropy(
-            scaled_distances.flatten(end_dim=-2)
-        )
+            scaled_distances = d * 10.0
+            entropy_to_max, entropy_to_min = calc_entropy(
+                scaled_distances.flatten(end_dim=-2)
+            )
+            min_encoding_indices = torch.argmin(d, dim=1)
         # diversity_loss = entropy_to_min - entropy_to_max
         diversity_loss = -entropy_to_max
         diversity_entropy = entropy_to_max.detach()
         deterministic_entropy = entropy_to_min.detach()
-        min_encoding_indices = torch.argmin(d, dim=1)
         # min_encoding_indices, onehot = gumbel_sample(d, dim=-1, temperature=1.0, training=self.training)
         z_q = self.embedding(min_encoding_indices).view(z.shape)
         z_q, z = self.norm(z_q), self.norm(z)
@@ -198,10 +377,14 @@ class VectorQuantizer_L2norm(nn.Module):
             min_encoding_indices = min_encoding_indices.reshape(z.shape[0], -1)  # add batch axis
             min_encoding_indices = self.remap_to_used(min_encoding_indices)
             min_encoding_indices = min_encoding_indices.reshape(-1, 1)  # flatten
+        if deferred:
+            log_dict = self.telemetry_log_dict(
+                min_encoding_indices, z_flattened_ori, commit_loss, deterministic_entropy, diversity_entropy)
+            return z_q, min_encoding_indices, loss, log_dict
 
         # calc cluster size
         total_codes = len(z_flattened) * float(dist.get_world_size())
-        onehot_assignments = F.one_hot(min_encoding_indices.flatten(), num_classes=self.n_e).float().sum(dim=0)
+        onehot_assignments = torch.bincount(min_encoding_indices.flatten(), minlength=self.n_e).float()
         dist.all_reduce(onehot_assignments)
         # print(f"total assignments: {onehot_assignments.sum().item()}, total codes: {total_codes}.")
         ema_inplace(self.cluster_size.data, onehot_assignments * self.n_e / total_codes, 0.99)
@@ -221,6 +404,16 @@ class VectorQuantizer_L2norm(nn.Module):
         
         # return z_q, loss, (perplexity, self.cluster_size, min_encoding_indices, diversity_entropy, deterministic_entropy, probs, total_codes)
         return z_q, min_encoding_indices, loss, log_dict
+
+    def update_cluster_size(self, counts, total_codes, steps):
+        # one EMA update standing for the steps of the telemetry interval
+        ema_inplace(self.cluster_size.data, counts * self.n_e / total_codes, 0.99 ** steps)
+
+    def dead_codes(self):
+        return self.cluster_size < self.dead_code_threshold
+
+    def active_codes(self):
+        return (self.cluster_size > 0.2).sum()
     
     def expire_codes(self, batch_samples, matched_indices):
         # first check if already no dead code
@@ -259,6 +452,203 @@ class VectorQuantizer_L2norm(nn.Module):
         # self.cluster_size.data[assigned_mask] = self.reset_cluster_size
         return replace_mask.sum().item()
 
+class GroupedVectorQuantizer(nn.Module):
+    """
+    K independent VectorQuantizer_L2norm codebooks (one per encoder depth) evaluated together:
+    the codebooks are stacked into one [K, n_e, e_dim] tensor and the K groups are quantized with
+    batched matmuls, one code assignment all_reduce and one host sync for the logged statistics.
+    Input z: (B, K * P, latent_dim), group k owns tokens [k * P, (k + 1) * P).
+    Groups with a smaller codebook (n_e_list) are padded and their extra codes are never selected.
+    groups_per_chunk bounds the [groups, B * P, n_e] distance matrix kept alive at once; with
+    gradients the chunks go through chunked_code_assignment (recomputed in backward) so the
+    bound also holds in training. code_block_size additionally streams the codebook axis.
+    """
+    def __init__(
+        self,
+        K,
+        n_e_list,
+        e_dim,
+        output_dim,
+        commitment_weight=1.0,
+        diversity_weight=1.0,
+        dead_code_threshold=0.05,
+        beta=0.25,
+        latent_dim=None,
+        legacy=True,
+        preserve_gradient=True,
+        groups_per_chunk=None,
+        code_block_size=None,
+    ):
+        super().__init__()
+        assert len(n_e_list) == K
+        self.K = K
+        self.n_e = max(n_e_list)
+        self.e_dim = e_dim
+        self.output_dim = output_dim
+        self.beta = beta
+        self.legacy = legacy
+        self.w_commit = commitment_weight
+        self.w_diversity = diversity_weight
+        self.preserve_gradient = preserve_gradient
+        self.dead_code_threshold = dead_code_threshold
+        self.groups_per_chunk = groups_per_chunk or K
+        self.code_block_size = code_block_size
+
+        self.norm = lambda x: F.normalize(x, dim=-1)
+        # per-group linear layers as stacked (K, out, in) weights, xavier init like the encoder's nn.Linear
+        if latent_dim != e_dim:
+            self.project_in_weight = nn.Parameter(torch.stack([nn.init.xavier_uniform_(torch.empty(e_dim, latent_dim)) for _ in range(K)]))
+            self.project_in_bias = nn.Parameter(torch.zeros(K, e_dim))
+        else:
+            self.project_in_weight = self.project_in_bias = None
+        if output_dim != e_dim:
+            self.project_out_weight = nn.Parameter(torch.stack([nn.init.xavier_uniform_(torch.empty(output_dim, e_dim)) for _ in range(K)]))
+            self.project_out_bias = nn.Parameter(torch.zeros(K, output_dim))
+        else:
+            self.project_out_weight = self.project_out_bias = None
+        embedding = torch.zeros(K, self.n_e, e_dim)
+        for k, n_e in enumerate(n_e_list):
+            embedding[k].uniform_(-1.0 / n_e, 1.0 / n_e)
+        self.embedding = nn.Parameter(embedding)
+        self.register_buffer("cluster_size", torch.ones(K, self.n_e) * dead_code_threshold * 2.0)
+        self.reset_cluster_size = dead_code_threshold * 1.2
+        valid = torch.arange(self.n_e)[None, :] < torch.tensor(n_e_list)[:, None]
+        self.register_buffer("valid_codes", valid, persistent=False)
+        self.register_buffer("codebook_sizes", torch.tensor(n_e_list, dtype=torch.float), persistent=False)
+        self.padded = not bool(valid.all())
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of a ModuleList of VectorQuantizer_L2norm: stack the per-group tensors
+        if prefix + "0.embedding.weight" in state_dict:
+            names = [("embedding", "embedding.weight"), ("cluster_size", "cluster_size"),
+                     ("project_in_weight", "project_in.weight"), ("project_in_bias", "project_in.bias"),
+                     ("project_out_weight", "project_out.weight"), ("project_out_bias", "project_out.bias")]
+            for name, old_name in names:
+                keys = [prefix + "%d.%s" % (k, old_name) for k in range(self.K)]
+                if keys[0] not in state_dict:
+                    continue
+                values = [state_dict.pop(key) for key in keys]
+                size = max(v.shape[0] for v in values) if name in ("embedding", "cluster_size") else None
+                if size is not None:
+                    values = [F.pad(v, (0, 0) * (v.dim() - 1) + (0, size - v.shape[0])) for v in values]
+                state_dict[prefix + name] = torch.stack(values)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, z, weight, bias):
+        # z: (K, M, in) -> (K, M, out)
+        if weight is None:
+            return z
+        return torch.baddbmm(bias[:, None, :].to(z.dtype), z, weight.transpose(1, 2).to(z.dtype))
+
+    def to_groups(self, x):
+        # (B, K * P, C) -> (K, B * P, C)
+        B, N, C = x.shape
+        return x.view(B, self.K, N // self.K, C).transpose(0, 1).reshape(self.K, -1, C)
+
+    def from_groups(self, x, B):
+        # (K, B * P, C) -> (B, K * P, C)
+        C = x.shape[-1]
+        return x.view(self.K, B, -1, C).transpose(0, 1).reshape(B, -1, C)
+
+    def assign(self, z_flattened, embedding_norm, valid):
+        # one chunk of groups: (G, M, D), (G, n_e, D) -> indices (G, M), entropies (G,), (G,)
+        if self.code_block_size or (torch.is_grad_enabled() and self.groups_per_chunk < self.K):
+            # the dense softmax of every chunk would stay saved for the diversity-loss backward
+            return chunked_code_assignment(z_flattened, embedding_norm, scale=10.0, block_size=self.code_block_size or self.n_e,
+                                           valid=valid if self.padded else None)
+        d = (
+            torch.sum(z_flattened**2, dim=-1, keepdim=True)
+            + torch.sum(embedding_norm**2, dim=-1)[:, None, :]
+            - 2 * torch.bmm(z_flattened, embedding_norm.transpose(1, 2))
+        )
+        scaled_distances = d * 10.0
+        if self.padded:
+            scaled_distances = scaled_distances.masked_fill(~valid[:, None, :], float("-inf"))
+            d = d.masked_fill(~valid[:, None, :], float("inf"))
+        # calc_entropy for every group of the chunk
+        p = scaled_distances.softmax(dim=-1)
+        ap = p.mean(dim=1)
+        entropy_to_max = -torch.xlogy(ap, ap).sum(dim=-1)
+        entropy_to_min = -torch.xlogy(p, p).sum(dim=-1).mean(dim=-1)
+        return torch.argmin(d, dim=-1), entropy_to_max, entropy_to_min
+
+    def forward(self, z):
+        B = z.shape[0]
+        z = self.project(self.to_groups(z), self.project_in_weight, self.project_in_bias)
+        z_flattened = self.norm(z)
+        num_reactivate = self.expire_codes(z.detach())
+        embedding_norm = self.norm(self.embedding)
+
+        indices, entropy_to_max, entropy_to_min = [], [], []
+        for start in range(0, self.K, self.groups_per_chunk):
+            end = start + self.groups_per_chunk
+            out = self.assign(z_flattened[start:end], embedding_norm[start:end], self.valid_codes[start:end])
+            indices.append(out[0])
+            entropy_to_max.append(out[1])
+            entropy_to_min.append(out[2])
+        min_encoding_indices = torch.cat(indices)
+        entropy_to_max, entropy_to_min = torch.cat(entropy_to_max), torch.cat(entropy_to_min)
+        diversity_loss = -entropy_to_max
+
+        z_q = self.embedding.gather(1, min_encoding_indices[..., None].expand(-1, -1, self.e_dim))
+        z_q, z = self.norm(z_q), z_flattened
+        if not self.legacy:
+            commit_loss = self.beta * torch.mean((z_q.detach() - z) ** 2, dim=(1, 2)) + torch.mean((z_q - z.detach()) ** 2, dim=(1, 2))
+        else:
+            commit_loss = torch.mean((z_q.detach() - z) ** 2, dim=(1, 2)) + self.beta * torch.mean((z_q - z.detach()) ** 2, dim=(1, 2))
+        loss = (self.w_commit * commit_loss + self.w_diversity * diversity_loss).mean()
+
+        if self.preserve_gradient:
+            z_q = z + (z_q - z).detach()
+        z_q = self.project(z_q, self.project_out_weight, self.project_out_bias)
+
+        # code assignments of all groups in one all_reduce
+        total_codes = min_encoding_indices.shape[1] * float(dist.get_world_size())
+        offsets = torch.arange(self.K, device=z.device)[:, None] * self.n_e
+        onehot_assignments = torch.bincount((min_encoding_indices + offsets).flatten(), minlength=self.K * self.n_e)
+        onehot_assignments = onehot_assignments.view(self.K, self.n_e).float()
+        dist.all_reduce(onehot_assignments)
+        ema_inplace(self.cluster_size.data, onehot_assignments * self.codebook_sizes[:, None] / total_codes, 0.99)
+        probs = onehot_assignments / total_codes
+        perplexity = torch.exp(-torch.sum(probs * torch.log(probs + 1e-10), dim=-1))
+        num_active_codes = ((self.cluster_size > 0.2) & self.valid_codes).sum(dim=-1)
+
+        # a single device-to-host copy for all the logged values
+        stats = torch.stack([t.detach().float() for t in (
+            num_active_codes, num_reactivate, perplexity, commit_loss, entropy_to_min, entropy_to_max,
+        )]).tolist()
+        keys = ['num_active_codes', 'num_reactivate', 'perplexity', 'commitment_loss', 'deterministic_entropy', 'diversity_entropy']
+        log_dict = {key: sum(values) / self.K for key, values in zip(keys, stats)}
+        log_dict['perplexity_list'] = stats[2]
+        log_dict['deterministic_list'] = stats[4]
+
+        indices = min_encoding_indices.view(self.K, B, -1).transpose(0, 1).reshape(B, -1)
+        return self.from_groups(z_q, B), indices, loss, log_dict
+
+    def get_output_from_indices(self, indices):
+        # indices: (B, K * P) -> (B, K * P, output_dim)
+        B = indices.shape[0]
+        indices = indices.view(B, self.K, -1).transpose(0, 1).reshape(self.K, -1)
+        z_q = self.norm(self.embedding.gather(1, indices[..., None].expand(-1, -1, self.e_dim)))
+        z_q = self.project(z_q, self.project_out_weight, self.project_out_bias)
+        return self.from_groups(z_q, B)
+
+    def expire_codes(self, batch_samples):
+        # batch_samples: (K, M, D); dead codes of every group are replaced from one all_gather
+        expired_codes = (self.cluster_size < self.dead_code_threshold) & self.valid_codes
+        num_expired = expired_codes.sum(dim=-1).float()
+        if not torch.any(expired_codes):
+            return num_expired
+        all_samples = [torch.empty_like(batch_samples) for _ in range(dist.get_world_size())]
+        dist.all_gather(all_samples, batch_samples)
+        all_samples = torch.cat(all_samples, dim=1)
+        # the i-th dead code of a group takes the i-th gathered sample of that group (cycled)
+        sample_index = (expired_codes.long().cumsum(dim=-1) - 1).clamp(min=0) % all_samples.shape[1]
+        samples = all_samples.gather(1, sample_index[..., None].expand(-1, -1, self.e_dim))
+        self.embedding.data.copy_(torch.where(expired_codes[..., None], samples.to(self.embedding.dtype), self.embedding.data))
+        self.cluster_size.data.masked_fill_(expired_codes, self.reset_cluster_size)
+        return num_expired
+
 def l2norm(t):
     return F.normalize(t, p=2, dim=-1)
 
@@ -273,7 +663,7 @@ def batched_embedding(indices, embeds):
     return embeds.gather(2, indices)
 
 
-class EMAQuantizer(nn.Module):
+class EMAQuantizer(nn.Module, QuantizerTelemetry):
     """
     Improved version over VectorQuantizer, can be used as a drop-in replacement. Mostly
     avoids costly matrix multiplications and allows for post-hoc remapping of indices.
@@ -288,11 +678,15 @@ class EMAQuantizer(nn.Module):
         dead_code_threshold=0.05,
         decay=0.99,
         latent_dim=None,
+        telemetry_interval=1,
+        reservoir_size=1024,
+        code_block_size=None,
     ):
         super().__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.decay = decay
+        self.code_block_size = code_block_size
         self.w_commit = commitment_weight
         self.w_diversity = diversity_weight
         self.dead_code_threshold = dead_code_threshold
@@ -309,6 +703,7 @@ class EMAQuantizer(nn.Module):
         self.total_codes = 0
         self.initted = False
         self.ratio = 0.0
+        self.init_telemetry(telemetry_interval, reservoir_size)
 
     def init_quantizer(self, x):
         if not self.initted:
@@ -326,23 +721,33 @@ class EMAQuantizer(nn.Module):
 
         # 2. quantize
         embed = self.embed.detach()
-        d = einsum('n d, c d -> n c', x, embed)
-        embed_ind = torch.argmin(d, dim=1)
-        embed_onehot = F.one_hot(embed_ind, num_classes=self.n_e).float()
-        # z_q = embed.index_select(dim=0, index=embed_ind)
-        # z_q2 = einsum('n c, c d -> n d', embed_onehot, embed)
-        # z_q_cpu = embed.cpu().index_select(dim=0, index=embed_ind.cpu())
-        # z_q_cpu2 = einsum('n c, c d -> n d', embed_onehot.cpu(), embed.cpu())
-        if self.training:
-            z_q = einsum('n c, c d -> n d', embed_onehot, embed)
-        else:
+        if self.code_block_size:
+            # no (N, n_e) tensors: streamed assignment, counts and sums by index
+            embed_ind, entropy_to_max, entropy_to_min = chunked_code_assignment(
+                x, embed, scale=10.0, block_size=self.code_block_size, similarity=True)
             z_q = embed.index_select(dim=0, index=embed_ind)
+            bins = torch.bincount(embed_ind, minlength=self.n_e).float()
+            embed_sum = torch.zeros_like(embed, dtype=torch.float).index_add_(0, embed_ind, x.detach().float())
+        else:
+            d = einsum('n d, c d -> n c', x, embed)
+            embed_ind = torch.argmin(d, dim=1)
+            embed_onehot = F.one_hot(embed_ind, num_classes=self.n_e).float()
+            # z_q = embed.index_select(dim=0, index=embed_ind)
+            # z_q2 = einsum('n c, c d -> n d', embed_onehot, embed)
+            # z_q_cpu = embed.cpu().index_select(dim=0, index=embed_ind.cpu())
+            # z_q_cpu2 = einsum('n c, c d -> n d', embed_onehot.cpu(), embed.cpu())
+            if self.training:
+                z_q = einsum('n c, c d -> n d', embed_onehot, embed)
+            else:
+                z_q = embed.index_select(dim=0, index=embed_ind)
+            bins = embed_onehot.sum(dim=0)
+            embed_sum = einsum('n d, n c -> c d', x, embed_onehot)
         # 3. update codebook with ema
-        bins = embed_onehot.sum(dim=0)
-        dist.all_reduce(bins)
+        # counts and sums of the codebook update in one all_reduce
+        reduced = torch.cat([bins[:, None], embed_sum], dim=1)
+        dist.all_reduce(reduced)
+        bins, embed_sum = reduced[:, 0], reduced[:, 1:]
         ema_inplace(self.cluster_size.data, bins, self.decay)
-        embed_sum = einsum('n d, n c -> c d', x, embed_onehot).contiguous()
-        dist.all_reduce(embed_sum)
         ema_inplace(self.embed_avg.data, embed_sum, self.decay)
         cluster_size = laplace_smoothing(
             self.cluster_size, self.n_e,
@@ -351,10 +756,11 @@ class EMAQuantizer(nn.Module):
         self.embed.data.copy_(embed_normalized)
 
         # 3. diversity
-        scaled_distances = d * 10.0
-        entropy_to_max, entropy_to_min = calc_entropy(
-            scaled_distances.flatten(end_dim=-2)
-        )
+        if not self.code_block_size:
+            scaled_distances = d * 10.0
+            entropy_to_max, entropy_to_min = calc_entropy(
+                scaled_distances.flatten(end_dim=-2)
+            )
         # diversity_loss = entropy_to_min - entropy_to_max
         diversity_loss = -entropy_to_max
         diversity_entropy = entropy_to_max.detach()
@@ -370,6 +776,9 @@ class EMAQuantizer(nn.Module):
         z_q = self.project_out(z_q)
 
         # 6. perplexity & active codes
+        if self.telemetry_interval > 1:
+            log_dict = self.telemetry_log_dict(embed_ind, x, commit_loss, deterministic_entropy, diversity_entropy)
+            return z_q, embed_ind, loss, log_dict
         num_reactivate = self.expire_codes(x, None)
         probs = bins / self.total_codes
         perplexity = torch.exp(-torch.sum(probs * torch.log(probs + 1e-10)))
@@ -386,6 +795,16 @@ class EMAQuantizer(nn.Module):
         
         # return z_q, loss, (perplexity, self.cluster_size, min_encoding_indices, diversity_entropy, deterministic_entropy, probs, total_codes)
         return z_q, embed_ind, loss, log_dict
+
+    def update_cluster_size(self, counts, total_codes, steps):
+        # cluster_size already follows the all-reduced counts every step
+        pass
+
+    def dead_codes(self):
+        return self.cluster_size < self.dead_code_threshold * self.ratio
+
+    def active_codes(self):
+        return (self.cluster_size / self.ratio > 0.2).sum()
     
     def expire_codes(self, batch_samples, matched_indices):
         # first check if already no dead code
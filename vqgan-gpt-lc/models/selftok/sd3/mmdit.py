@@ -500,7 +500,7 @@ class JointBlock(nn.Module):
         if self.use_checkpoint:
             return torch.utils.checkpoint.checkpoint(self._forward, context, x, c, mask, use_reentrant=False)
         else:
-            return _forward(context, x, c, mask)
+            return self._forward(context, x, c, mask)
 
 
 class FinalLayer(nn.Module):
@@ -676,6 +676,9 @@ class MMDiT(nn.Module):
         if uncond_y_file is not None:
             self.uncond_y = torch.load(uncond_y_file, map_location='cpu').to(device)
             self.uncond_y.requires_grad = False
+        # recently built joint attention masks: (key, source mask, attention mask)
+        self.mask_cache = []
+        self.mask_cache_size = 4
 
     def freeze(self):
         freezed_param_names = []
@@ -785,73 +788,127 @@ class MMDiT(nn.Module):
         x = self.final_layer(x, c_mod)  # (N, T, patch_size ** 2 * out_channels)
         return x
 
-    def drop_cond(self, context, y, mask):
-        if self.class_dropout_prob <= 0.0 or (not self.training):
-            return context, mask, y
-        # with torch.no_grad():
-        drop_ids = torch.rand(
-            context.shape[0], device=context.device
-        ) < self.class_dropout_prob
+    def drop_cond(self, context, y, mask, drop_ids=None):
+        if drop_ids is None:
+            if self.class_dropout_prob <= 0.0 or (not self.training):
+                return context, mask, y
+            # with torch.no_grad():
+            drop_ids = torch.rand(
+                context.shape[0], device=context.device
+            ) < self.class_dropout_prob
         seq_len = self.uncond_c.size(1)
-        
-        drop_mask = torch.zeros(context.size(), dtype=torch.int, device=context.device)
-        uncond_c = torch.zeros(context.size(), dtype=context.dtype, device=context.device)
-        uncond_c[drop_ids, :seq_len, :] = self.uncond_c.to(context.dtype).to(context.device)
-        drop_mask[drop_ids, :seq_len, :] = 1
-        context = (1-drop_mask) * context + drop_mask * uncond_c 
-        # print('before',torch.sum(mask[drop_ids, :],dim=1),mask[drop_ids, 152:155], mask.dtype)
+
+        # dropped samples get the uncond context on the first seq_len tokens, the rest is masked out;
+        # selected with broadcast torch.where instead of full-size blend masks
+        uncond_pos = torch.arange(context.shape[1], device=context.device) < seq_len
+        uncond_c = torch.zeros((1,) + tuple(context.shape[1:]), dtype=context.dtype, device=context.device)
+        uncond_c[:, :seq_len] = self.uncond_c.to(context.dtype).to(context.device)
+        context = torch.where(drop_ids[:, None, None] & uncond_pos[None, :, None], uncond_c, context)
         if mask is not None:
-            drop_mask = torch.zeros(mask.size(), dtype=torch.int, device=mask.device)
-            uncond_mask = torch.zeros(mask.size(), dtype=mask.dtype, device=mask.device)
-            drop_mask[drop_ids, :] = 1
-            uncond_mask[drop_ids, :seq_len] = 1
-            uncond_mask[drop_ids, seq_len:] = 0
-            mask = (1-drop_mask) * mask + drop_mask * uncond_mask
-        # print('after',torch.sum(mask[drop_ids, :],dim=1),mask[drop_ids, 152:155], mask.dtype)
+            mask = torch.where(drop_ids[:, None], uncond_pos[None, :].to(mask.dtype), mask)
         if y is not None:
-            drop_mask = torch.zeros(y.size(), dtype=torch.int, device=y.device)
-            uncond_y = torch.zeros(y.size(), dtype=y.dtype, device=y.device)
-            uncond_y[drop_ids, :] = self.uncond_y.to(y.dtype).to(y.device)
-            drop_mask[drop_ids, :] = 1
-            y = (1-drop_mask) * y + drop_mask * uncond_y
-            # print(y.size(), uncond_y.size(), self.uncond_y.size())
-            # y[drop_ids, :] = self.uncond_y.to(y.dtype).to(y.device)
+            y = torch.where(drop_ids[:, None], self.uncond_y.to(y.dtype).to(y.device).view(1, -1), y)
         return context, mask, y
 
-    def forward(self, x, t, y=None, encoder_hidden_states=None, x_mask=None, mask=None,**kwargs):
+    def joint_mask(self, mask, x_mask, context_len, x_len, batch_size, device):
         """
-        Forward pass of DiT.
-        x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
-        t: (N,) tensor of diffusion timesteps
-        y: (N,) tensor of class labels
+        Key-padding mask of the joint [register; context; x] sequence in broadcast form
+        (B, 1, 1, L) bool, True = attend. None when every token is valid so attention
+        runs unmasked. Masks of recently seen (unmodified) mask tensors are reused,
+        e.g. over the steps of a sampling loop.
         """
-        hw = x.shape[-2:]
-        t = torch.floor(t * 1000).int().clamp(0, 999)
-        x = self.x_embedder(x) + self.cropped_pos_embed(hw)
-        c = self.t_embedder(t, dtype=x.dtype)  # (N, D)
+        if mask is None and x_mask is None:
+            return None
+        key = tuple((m.data_ptr(), m._version, tuple(m.shape)) if m is not None else None for m in (mask, x_mask)) + (context_len, x_len)
+        for entry_key, _, attn_mask in self.mask_cache:
+            if entry_key == key:
+                return attn_mask
 
+        if mask is None:
+            mask = torch.ones((batch_size, context_len - self.register_length), dtype=torch.bool, device=device)
+        if x_mask is None:
+            x_mask = torch.ones((batch_size, x_len), dtype=torch.bool, device=device)
+        parts = [mask.bool(), x_mask.bool()]
+        if self.register_length > 0:
+            parts.insert(0, torch.ones((batch_size, self.register_length), dtype=torch.bool, device=device))
+        attn_mask = torch.cat(parts, dim=1)
+        # the all-valid check synchronizes, only done for inference where the mask is reused
+        if not self.training and bool(attn_mask.all()):
+            attn_mask = None
+        else:
+            attn_mask = attn_mask[:, None, None, :]
+
+        # keep the source masks referenced so their storage (the cache key) cannot be reused
+        self.mask_cache.append((key, (mask, x_mask), attn_mask))
+        self.mask_cache = self.mask_cache[-self.mask_cache_size:]
+        return attn_mask
+
+    def prepare_context(self, encoder_hidden_states, mask=None, y=None, dtype=None, drop_ids=None):
+        """
+        Timestep independent part of forward: pooled and embedded y, embedded context
+        and its mask, returned as (context, mask, y). Samplers compute it once per run
+        and pass it as prepared_context. drop_ids fixes which samples get the null
+        condition (default: random class dropout in training).
+        """
         if self.sd3_cond_pooling == 'last':
             k_batch = mask.sum(dim=-1) - 1
-            y = encoder_hidden_states[torch.arange(x.shape[0]), k_batch, :]
+            y = encoder_hidden_states[torch.arange(encoder_hidden_states.shape[0]), k_batch, :]
         elif self.sd3_cond_pooling == 'mean':
             y = encoder_hidden_states.sum(dim=1) / mask.sum(dim=-1).unsqueeze(1)
 
         if y is not None:
             # y = self.y_embedder(y,self.training, dtype=x.dtype)  # (N, D)
             y = self.y_embedder(y)
-        context = self.context_embedder(encoder_hidden_states).to(x.dtype) + self.context_pos_embed
-        context, mask, y = self.drop_cond(context, y, mask)
+        context = self.context_embedder(encoder_hidden_states)
+        if dtype is not None:
+            context = context.to(dtype)
+        context = context + self.context_pos_embed
+        return self.drop_cond(context, y, mask, drop_ids=drop_ids)
+
+    def prepare_cfg_context(self, encoder_hidden_states, mask=None, y=None, uc=None):
+        """
+        prepare_context of a doubled [uncond; cond] batch for classifier-free guidance.
+        The unconditional half is the learned null condition (drop_cond) with its own
+        mask, or uc (encoder space, all tokens valid) when given; an unpooled y is
+        replaced by the null uncond_y in both cases.
+        """
+        batch_size, device = encoder_hidden_states.shape[0], encoder_hidden_states.device
+        if mask is None:
+            mask = torch.ones(encoder_hidden_states.shape[:2], dtype=torch.bool, device=device)
+        cond = self.prepare_context(encoder_hidden_states, mask, y)
+        if uc is None:
+            drop_ids = torch.ones(batch_size, dtype=torch.bool, device=device)
+            uncond = self.drop_cond(cond[0], cond[2], cond[1], drop_ids=drop_ids)
+        else:
+            uc_context, uc_mask, uc_y = self.prepare_context(
+                uc, torch.ones(uc.shape[:2], dtype=mask.dtype, device=device), y,
+                drop_ids=torch.zeros(batch_size, dtype=torch.bool, device=device))
+            if self.sd3_cond_pooling is None and uc_y is not None:
+                uc_y = self.uncond_y.to(uc_y.dtype).to(uc_y.device).view(1, -1).expand_as(uc_y)
+            uncond = (uc_context, uc_mask, uc_y)
+        return tuple(None if c is None else torch.cat([u, c]) for u, c in zip(uncond, cond))
+
+    def forward(self, x, t, y=None, encoder_hidden_states=None, x_mask=None, mask=None, prepared_context=None, **kwargs):
+        """
+        Forward pass of DiT.
+        x: (N, C, H, W) tensor of spatial inputs (images or latent representations of images)
+        t: (N,) tensor of diffusion timesteps
+        y: (N,) tensor of class labels
+        prepared_context: (context, mask, y) from prepare_context, replaces encoder_hidden_states / mask / y
+        """
+        hw = x.shape[-2:]
+        t = torch.floor(t * 1000).int().clamp(0, 999)
+        x = self.x_embedder(x) + self.cropped_pos_embed(hw)
+        c = self.t_embedder(t, dtype=x.dtype)  # (N, D)
+
+        if prepared_context is None:
+            prepared_context = self.prepare_context(encoder_hidden_states, mask, y, dtype=x.dtype)
+        context, mask, y = prepared_context
 
         if y is not None:
             c = c + y  # (N, D)
 
-        if x_mask is None:
-            x_mask = torch.ones((x.shape[0], x.shape[1])).cuda()
-        if mask is None:
-            mask = torch.ones((context.shape[0], context.shape[1])).cuda()
-
-        mask = torch.cat((mask, x_mask), dim=1).bool()
-        mask = mask.unsqueeze(1).unsqueeze(2).repeat(1,1,context.shape[1]+x.shape[1],1)
+        mask = self.joint_mask(mask, x_mask, context.shape[1] + self.register_length, x.shape[1], x.shape[0], x.device)
 
         x = self.forward_core_with_concat(x, c, context, mask=mask)
         x = self.unpatchify(x, hw=hw)  # (N, out_channels, H, W)
@@ -20,6 +20,8 @@ def attention(q, k, v, heads, mask=None):
     b, _, dim_head = q.shape
     dim_head //= heads
     q, k, v = map(lambda t: t.view(b, -1, heads, dim_head).transpose(1, 2), (q, k, v))
+    # mask: None or bool, broadcastable to (b, heads, Lq, Lk), e.g. a (b, 1, 1, Lk) key-padding mask
+    seq_q, seq_k = q.shape[2], k.shape[2]
     if DEVICE_TYPE == "gpu":
         out = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, is_causal=False)
         return out.transpose(1, 2).reshape(b, -1, heads * dim_head)
@@ -34,7 +36,7 @@ def attention(q, k, v, heads, mask=None):
             heads,
             pse=None,
             padding_mask=None,
-            atten_mask=mask.logical_not(),
+            atten_mask=None if mask is None else mask.expand(b, 1, seq_q, seq_k).logical_not(),
             scale=dim_head**-0.5,
             input_layout="BSH",
             pre_tockens=65536,
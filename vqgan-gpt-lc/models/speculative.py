@@ -0,0 +1,124 @@
+import time
+import torch
+import torch.nn.functional as F
+from models.sampler import Sampler
+
+
+class SpeculativeStats:
+    """Acceptance / cost counters accumulated over speculative sampling calls."""
+    def __init__(self):
+        self.proposed = 0
+        self.accepted = 0
+        self.target_calls = 0
+        self.draft_calls = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def update(self, other):
+        for k, v in vars(other).items():
+            setattr(self, k, getattr(self, k) + v)
+
+    def summary(self):
+        return {
+            "acceptance_rate": self.accepted / max(self.proposed, 1),
+            "tokens_per_target_call": self.tokens / max(self.target_calls, 1),
+            "draft_calls": self.draft_calls,
+            "target_calls": self.target_calls,
+            "ms_per_token": 1000.0 * self.seconds / max(self.tokens, 1),
+        }
+
+
+def _vision_logits(transformer, hidden, n_vision_words):
+    return F.linear(hidden, transformer.get_output_head().weight[:n_vision_words])
+
+
+@torch.no_grad()
+def speculative_sample(target, draft, x, c, steps, n_vision_words, k=4, temperature=1.0, top_k=100, top_p=None, generator=None):
+    """
+    Speculative sampling of image tokens (Leviathan et al. / Chen et al.).
+    target and draft are token transformers with forward_inference K/V caches
+    sharing the vocabulary. Each round the draft proposes k tokens, the target
+    scores them in one forward and every proposal is accepted with probability
+    min(1, p/q); the first rejection is resampled from max(p - q, 0). p and q
+    are the temperature/top-k/top-p filtered distributions, so the output
+    follows the target sampling distribution exactly (scalar sampling
+    parameters only).
+    The batch advances by the smallest accepted length of the round; the
+    caches are rolled back by restarting the next forward at that position.
+    Returns the generated tokens (B, prefix + steps) and a SpeculativeStats.
+    """
+    stats = SpeculativeStats()
+    if c.is_cuda:
+        torch.cuda.synchronize(c.device)
+    start_time = time.time()
+    sampler = Sampler(temperature=temperature, top_k=top_k, top_p=top_p, generator=generator)
+    prompt = c if x is None else torch.cat((c, x), dim=1)
+    bsz, prompt_len = prompt.shape
+    total_len = prompt_len + steps
+    out = torch.empty(bsz, total_len, dtype=prompt.dtype, device=prompt.device)
+    out[:, :prompt_len] = prompt
+
+    target.setup_caches(bsz, total_len)
+    draft.setup_caches(bsz, total_len)
+    # prefill both models; the last prompt token is fed again by the first verify/draft step
+    if prompt_len > 1:
+        target.forward_inference(prompt[:, :-1], 0)
+        draft.forward_inference(prompt[:, :-1], 0)
+    length = prompt_len
+    draft_pos = prompt_len - 1
+
+    while length < total_len:
+        num_draft = min(k, total_len - length)
+
+        # draft proposals
+        q, proposals = [], []
+        for i in range(num_draft):
+            hidden, _ = draft.forward_inference(out[:, draft_pos:length + i], draft_pos, return_hidden=True)
+            draft_pos = length + i
+            q_i = sampler.probs(_vision_logits(draft, hidden[:, -1], n_vision_words))
+            d_i = sampler.multinomial(q_i)
+            out[:, length + i] = d_i[:, 0]
+            q.append(q_i)
+            proposals.append(d_i)
+        stats.draft_calls += num_draft
+        q = torch.stack(q, dim=1)
+        proposals = torch.cat(proposals, dim=1)
+
+        # one target forward over [last token, proposals]
+        hidden, _ = target.forward_inference(out[:, length - 1:length + num_draft], length - 1, return_hidden=True)
+        stats.target_calls += 1
+        logits = _vision_logits(target, hidden, n_vision_words)
+        p = sampler.probs(logits.reshape(bsz * (num_draft + 1), -1)).view(bsz, num_draft + 1, -1)
+
+        p_d = p[:, :num_draft].gather(-1, proposals.unsqueeze(-1))[..., 0]
+        q_d = q.gather(-1, proposals.unsqueeze(-1))[..., 0]
+        u = torch.rand(p_d.shape, device=p_d.device, generator=generator)
+        accept = u * q_d <= p_d
+        accepted = accept.long().cumprod(dim=-1).sum(dim=-1)
+        n, num_accepted = torch.stack([accepted.min(), accepted.sum()]).tolist()
+        stats.proposed += bsz * num_draft
+        stats.accepted += num_accepted
+
+        if n < num_draft:
+            # rows that accepted position n keep their proposal, the others resample from the residual
+            residual = (p[:, n] - q[:, n]).clamp(min=0)
+            residual_mass = residual.sum(dim=-1, keepdim=True)
+            residual = torch.where(residual_mass > 0, residual / residual_mass.clamp(min=1e-20), p[:, n])
+            resampled = sampler.multinomial(residual)[:, 0]
+            out[:, length + n] = torch.where(accept[:, n], proposals[:, n], resampled)
+            length += n + 1
+        elif length + num_draft < total_len:
+            # everything accepted: one extra token from the target distribution
+            out[:, length + num_draft] = sampler.multinomial(p[:, num_draft])[:, 0]
+            length += num_draft + 1
+        else:
+            length += num_draft
+        draft_pos = min(draft_pos, length - 1)
+
+    target.clear_caches()
+    draft.clear_caches()
+    stats.tokens = bsz * steps
+    if c.is_cuda:
+        torch.cuda.synchronize(c.device)
+    stats.seconds = time.time() - start_time
+    return out[:, c.shape[1]:], stats
@@ -22,4 +22,5 @@ CUDA_VISIBLE_DEVICES=0 torchrun --nproc_per_node 1 --master_port=14297 training_
     --output_dir "train_logs_gpt/gpt_lc_100K" \
     --deepspeed \
     --deepspeed_config "config/deepspeed_gpt_zero2_small.json" \
+    --loss_chunk_size 8192 \
     --gpt_type "small"
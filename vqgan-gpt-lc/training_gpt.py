@@ -8,7 +8,8 @@ import torch.nn.functional as F
 import util.lr_sched as lr_sched
 from torchvision import utils as vutils
 from models.models_gpt import VQGANTransformer
-#from models.maskgit import VQGANBidTransformer
+from models.llama import RMSNorm
+from models.maskgit import VQGANBidTransformer
 #from util.utils import load_data, plot_images
 import util.misc as misc
 import torch.backends.cudnn as cudnn
@@ -188,7 +189,7 @@ def configure_optimizers(model, args):
         return optimizer
     decay, no_decay = set(), set()
     whitelist_weight_modules = (nn.Linear, )
-    blacklist_weight_modules = (nn.LayerNorm, nn.Embedding)
+    blacklist_weight_modules = (nn.LayerNorm, nn.Embedding, RMSNorm)
 
     for mn, m in model.transformer.named_modules():
         #print(m)
@@ -295,6 +296,12 @@ if __name__ == '__main__':
     parser.add_argument("--dataset", type=str, default="imagenet", help="")
     parser.add_argument("--gpt_type", type=str, default="small", help="")
     parser.add_argument("--label_smooth", default=0, type=int)
+    parser.add_argument("--null_class", default=0, type=int, help="Add a null class token for classifier-free guidance")
+    parser.add_argument("--class_dropout_prob", default=0.1, type=float, help="Probability of replacing the class token by the null token (--null_class 1)")
+    parser.add_argument("--pack_block_size", default=0, type=int, help="Pack token sequences into blocks of this many tokens (0 disables packing)")
+    parser.add_argument("--pack_resolutions", type=str, default="128,256,512", help="Image resolutions mixed in packed training, --image_size should be the largest")
+    parser.add_argument("--maskgit_steps", default=12, type=int, help="Parallel decoding steps when sampling with --gpt_type maskgit")
+    parser.add_argument("--loss_chunk_size", default=0, type=int, help="Positions per chunk of the chunked cross-entropy (0: full logits)")
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
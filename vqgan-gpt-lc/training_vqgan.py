@@ -21,6 +21,7 @@ from engine_training_vqgan import train_one_epoch
 import util.misc as misc
 
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
+from util.data_monitor import DatasetTimer, timed
 
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -77,9 +78,12 @@ def preprocess_vqgan(x):
   return x
 
 class CustomLatentDataset(Dataset):
+    timing_stages = ["load"]
+
     def __init__(self, features_dir, preload_data=False):
         self.features_dir = features_dir
         self.preload_data = preload_data
+        self.timer = None
         self.features_files = sorted(os.listdir(features_dir))
         
         if preload_data:
@@ -95,18 +99,24 @@ class CustomLatentDataset(Dataset):
         return len(self.features_files)
 
     def __getitem__(self, idx):
+        if self.timer is not None:
+            self.timer.count()
         if self.preload_data:
             feature = torch.from_numpy(self.features[idx])
             return feature
         else:
             feature_file = self.features_files[idx]
-            features = np.load(os.path.join(self.features_dir, feature_file))
+            with timed(self.timer, "load"):
+                features = np.load(os.path.join(self.features_dir, feature_file))
             return torch.from_numpy(features)
 
 
 class ImageNetDataset(Dataset):
+    timing_stages = ["open", "decode", "clip", "augment"]
+
     def __init__(self, data_root, image_size, max_words=30, n_class=1000, partition="train", device="cpu"):
 
+        self.timer = None
         self.max_words = max_words
         self.device = device
         self.image_size = image_size
@@ -148,14 +158,21 @@ class ImageNetDataset(Dataset):
     def __getitem__(self, index):
 
         image_ids = self.image_ids[index]
-        image = Image.open(os.path.join(self.data_root, image_ids))
-        clip_image = self.clip_preprocessing(image)
-        if not image.mode == "RGB":
-            image = image.convert("RGB")
-        image = np.array(image).astype(np.uint8)
-        image = self.preprocessor(image=image)["image"]
-        image = (image / 127.5 - 1.0).astype(np.float32)
-        image = image.transpose(2, 0, 1)
+        if self.timer is not None:
+            self.timer.count()
+        with timed(self.timer, "open"):
+            image = Image.open(os.path.join(self.data_root, image_ids))
+        with timed(self.timer, "decode"):
+            image.load()
+        with timed(self.timer, "clip"):
+            clip_image = self.clip_preprocessing(image)
+        with timed(self.timer, "augment"):
+            if not image.mode == "RGB":
+                image = image.convert("RGB")
+            image = np.array(image).astype(np.uint8)
+            image = self.preprocessor(image=image)["image"]
+            image = (image / 127.5 - 1.0).astype(np.float32)
+            image = image.transpose(2, 0, 1)
         label = self.class_labels[index]
 
         return [image_ids, image, clip_image, label]
@@ -163,8 +180,11 @@ class ImageNetDataset(Dataset):
 
 
 class FFHQDataset(Dataset):
+    timing_stages = ["open", "decode", "clip", "augment"]
+
     def __init__(self, data_root, image_size, max_words=30, n_class=1000, partition="train", device="cpu"):
 
+        self.timer = None
         self.max_words = max_words
         self.device = device
         self.image_size = image_size
@@ -198,14 +218,21 @@ class FFHQDataset(Dataset):
 
         image_ids = self.image_ids[index]
         ###
-        image = Image.open(os.path.join(self.data_root, image_ids))
-        clip_image = self.clip_preprocessing(image)
-        if not image.mode == "RGB":
-            image = image.convert("RGB")
-        image = np.array(image).astype(np.uint8)
-        image = self.preprocessor(image=image)["image"]
-        image = (image / 127.5 - 1.0).astype(np.float32)
-        image = image.transpose(2, 0, 1)
+        if self.timer is not None:
+            self.timer.count()
+        with timed(self.timer, "open"):
+            image = Image.open(os.path.join(self.data_root, image_ids))
+        with timed(self.timer, "decode"):
+            image.load()
+        with timed(self.timer, "clip"):
+            clip_image = self.clip_preprocessing(image)
+        with timed(self.timer, "augment"):
+            if not image.mode == "RGB":
+                image = image.convert("RGB")
+            image = np.array(image).astype(np.uint8)
+            image = self.preprocessor(image=image)["image"]
+            image = (image / 127.5 - 1.0).astype(np.float32)
+            image = image.transpose(2, 0, 1)
 
         return [image_ids, image, clip_image, 0]
 
@@ -291,6 +318,19 @@ def get_args_parser():
 
     parser.add_argument("--dataset", type=str, default="imagenet", help="")
 
+    ###Mixed precision
+    parser.add_argument("--amp_dtype", type=str, default="none", choices=["none", "bf16", "fp16"], help="Autocast dtype for the conv stacks")
+    parser.add_argument("--amp_exclude", type=str, default="", help="Comma separated modules kept in fp32: encoder,quant_conv,post_quant_conv,decoder,discriminator")
+    parser.add_argument("--channels_last", type=int, default=0, help="Use channels_last memory format for the conv stacks")
+    parser.add_argument("--compile", type=str, default="none", choices=["none", "default", "reduce-overhead", "max-autotune"], help="torch.compile mode for encode/decode/discriminator")
+
+    ###Profiling
+    parser.add_argument("--profile", type=int, default=0, help="Per-stage CUDA event timers and peak memory")
+    parser.add_argument("--profile_freq", type=int, default=100, help="Log the stage profile every N iterations")
+    parser.add_argument("--profile_trace_steps", type=str, default="", help="torch.profiler trace windows, e.g. 100-110,5000-5010")
+    parser.add_argument("--data_monitor", type=int, default=0, help="Log data loader stall, queue depth and per-stage dataset timing")
+    parser.add_argument("--data_monitor_freq", type=int, default=100, help="Log the data loader stats every N iterations")
+
     return parser
 
 
@@ -348,6 +388,9 @@ def main(args):
     else:
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
+    if args.data_monitor:
+        dataset_train.timer = DatasetTimer(dataset_train.timing_stages, args.num_workers)
+
     if global_rank == 0 and args.log_dir is not None:
         os.makedirs(args.log_dir, exist_ok=True)
         log_writer = SummaryWriter(log_dir=args.log_dir)
@@ -397,6 +440,10 @@ def main(args):
 
     model = VQModel(args=args, **config.model.params)
     model.to(device)
+    if args.channels_last:
+        model.to_channels_last()
+    if args.compile != "none":
+        model.enable_compile(args.compile)
     model_without_ddp = model
     
 
@@ -0,0 +1,104 @@
+import torch
+
+
+COMPILE_MODES = ["none", "default", "reduce-overhead", "max-autotune"]
+
+
+def _map_tensors(fn, obj):
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(fn, o) for o in obj)
+    return obj
+
+
+class CompiledFunction:
+    """
+    torch.compile wrapper that falls back to eager execution for good
+    when compilation or the compiled call fails.
+    Graph breaks are handled by dynamo itself (the function is split).
+    Only errors raised by the forward call are caught: a failure while compiling
+    or running the backward graph surfaces in loss.backward() and is not
+    recovered from (run with --compile none in that case).
+    """
+    def __init__(self, fn, mode="default", name=None):
+        self.fn = fn
+        self.name = name if name is not None else fn.__name__
+        self.compiled = torch.compile(fn, mode=mode, dynamic=False)
+        self.failed = False
+
+    def __call__(self, *args, **kwargs):
+        if not self.failed:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                print("****torch.compile failed for %s, falling back to eager: %s****" % (self.name, e))
+                self.failed = True
+        return self.fn(*args, **kwargs)
+
+
+class CUDAGraphFunction:
+    """
+    Static-shape CUDA graph capture of a no-grad function.
+    One graph is captured per (tensor shapes/dtypes, non-tensor args); the tensor
+    inputs are copied into static buffers and the graph is replayed.
+    Calls with grad enabled, with CPU tensors, or after a failed capture run eagerly.
+    select_outputs(out) picks the part of the output returned to callers (unused
+    tensors replaced by None); only those tensors are cloned out of the graph pool
+    on every replay.
+    """
+    def __init__(self, fn, name=None, warmup_iters=3, select_outputs=None):
+        self.fn = fn
+        self.select_outputs = select_outputs
+        self.name = name if name is not None else getattr(fn, "name", getattr(fn, "__name__", "fn"))
+        self.warmup_iters = warmup_iters
+        self.graphs = {}
+        self.failed = False
+
+    def _key(self, args):
+        return tuple((tuple(a.shape), a.dtype, a.device) if isinstance(a, torch.Tensor) else a for a in args)
+
+    def _capture(self, args):
+        static_args = [a.clone() if isinstance(a, torch.Tensor) else a for a in args]
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.fn(*static_args)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self.fn(*static_args)
+        return graph, static_args, static_out
+
+    def __call__(self, *args):
+        tensors = [a for a in args if isinstance(a, torch.Tensor)]
+        if self.failed or torch.is_grad_enabled() or len(tensors) == 0 or not all(a.is_cuda for a in tensors):
+            return self.fn(*args)
+        key = self._key(args)
+        if key not in self.graphs:
+            try:
+                self.graphs[key] = self._capture(args)
+            except Exception as e:
+                print("****CUDA graph capture failed for %s, falling back to eager: %s****" % (self.name, e))
+                self.failed = True
+                torch.cuda.synchronize()
+                return self.fn(*args)
+        graph, static_args, static_out = self.graphs[key]
+        for s, a in zip(static_args, args):
+            if isinstance(s, torch.Tensor):
+                s.copy_(a)
+        graph.replay()
+        # outputs live in the graph pool and are overwritten by the next replay
+        if self.select_outputs is not None:
+            static_out = self.select_outputs(static_out)
+        return _map_tensors(lambda t: t.clone(), static_out)
+
+
+def build_compiled_function(fn, mode="none", cuda_graph=False, name=None, select_outputs=None):
+    # mode "reduce-overhead" already captures CUDA graphs inside torch.compile
+    if mode != "none":
+        fn = CompiledFunction(fn, mode=mode, name=name)
+    if cuda_graph and mode != "reduce-overhead":
+        fn = CUDAGraphFunction(fn, name=name, select_outputs=select_outputs)
+    return fn
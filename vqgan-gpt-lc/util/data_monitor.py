@@ -0,0 +1,138 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import get_worker_info
+
+import util.misc as misc
+
+
+class DatasetTimer:
+    """
+    Worker-side stage timers for Dataset.__getitem__.
+    Every DataLoader worker accumulates into its own row of a shared-memory
+    tensor (seconds per stage + sample count), which the main process reads.
+    """
+    def __init__(self, stages, num_workers):
+        self.stages = list(stages)
+        self.stats = torch.zeros(max(num_workers, 1), len(self.stages) + 1, dtype=torch.float64).share_memory_()
+
+    def _row(self):
+        info = get_worker_info()
+        return 0 if info is None else info.id
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        yield
+        self.stats[self._row(), self.stages.index(stage)] += time.perf_counter() - start
+
+    def count(self):
+        self.stats[self._row(), -1] += 1
+
+    def snapshot(self):
+        return self.stats.sum(dim=0).clone()
+
+
+def timed(timer, stage):
+    if timer is None:
+        return nullcontext()
+    return timer.time(stage)
+
+
+class LoaderMonitor:
+    """
+    Wraps a DataLoader and measures, per rank, how long the training loop
+    waits for the next batch (stall), how many batches are ready in the
+    loader queue, and the per-stage cost reported by the dataset timer.
+    Every log_freq batches the stats of all ranks are gathered and written
+    to the SummaryWriter of rank 0.
+    """
+    def __init__(self, data_loader, log_writer=None, log_freq=100, sample_freq=10, start_iter=0):
+        self.data_loader = data_loader
+        self.log_writer = log_writer
+        self.log_freq = log_freq
+        self.sample_freq = sample_freq
+        self.start_iter = start_iter
+        self.timer = getattr(data_loader.dataset, "timer", None)
+        self.reset()
+
+    def reset(self):
+        self.wait_time = 0.0
+        self.window_start = time.perf_counter()
+        self.queue_depth = []
+        self.outstanding = []
+        self.num_batches = 0
+        self.last_snapshot = self.timer.snapshot() if self.timer is not None else None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _sample_queue(self, iterator):
+        data_queue = getattr(iterator, "_data_queue", None)
+        if data_queue is not None:
+            try:
+                self.queue_depth.append(data_queue.qsize())
+            except NotImplementedError:
+                pass
+        outstanding = getattr(iterator, "_tasks_outstanding", None)
+        if outstanding is not None:
+            self.outstanding.append(outstanding)
+
+    def __iter__(self):
+        iterator = iter(self.data_loader)
+        self.reset()
+        for i in range(len(self.data_loader)):
+            if i % self.sample_freq == 0:
+                self._sample_queue(iterator)
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.perf_counter() - start
+            self.num_batches += 1
+            yield batch
+            if self.num_batches == self.log_freq:
+                self.log(self.start_iter + i)
+                self.reset()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.window_start
+        stats = {
+            "stall_pct": 100.0 * self.wait_time / max(elapsed, 1e-8),
+            "wait_ms": 1000.0 * self.wait_time / max(self.num_batches, 1),
+            "batches_per_s": self.num_batches / max(elapsed, 1e-8),
+            "queue_depth": sum(self.queue_depth) / max(len(self.queue_depth), 1),
+            "tasks_outstanding": sum(self.outstanding) / max(len(self.outstanding), 1),
+        }
+        if self.timer is not None:
+            delta = self.timer.snapshot() - self.last_snapshot
+            samples = max(delta[-1].item(), 1)
+            for j, stage in enumerate(self.timer.stages):
+                stats["%s_ms" % stage] = 1000.0 * delta[j].item() / samples
+            stats["samples_per_s"] = delta[-1].item() / max(elapsed, 1e-8)
+        return stats
+
+    def log(self, step):
+        stats = self.stats()
+        names = sorted(stats.keys())
+        local = torch.tensor([stats[k] for k in names], dtype=torch.float64)
+        if misc.is_dist_avail_and_initialized():
+            local = local.cuda()
+            gathered = [torch.zeros_like(local) for _ in range(misc.get_world_size())]
+            dist.all_gather(gathered, local)
+            gathered = torch.stack(gathered).cpu()
+        else:
+            gathered = local.unsqueeze(0)
+        if self.log_writer is None:
+            return
+        for j, name in enumerate(names):
+            for rank in range(gathered.shape[0]):
+                self.log_writer.add_scalar("Data/%s/rank%d" % (name, rank), gathered[rank, j].item(), step)
+        stall = gathered[:, names.index("stall_pct")]
+        self.log_writer.add_scalar("Data/stall_pct_max", stall.max().item(), step)
+        self.log_writer.add_scalar("Data/stall_pct_mean", stall.mean().item(), step)
+        print("Data loader: stall %.1f%% (max %.1f%% on rank %d), queue depth %.1f" % (
+            stats["stall_pct"], stall.max().item(), stall.argmax().item(), stats["queue_depth"]))
@@ -20,6 +20,8 @@ import torch
 import torch.distributed as dist
 from torch import inf
 
+from util.profiler import max_memory_allocated
+
 
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
@@ -153,7 +155,7 @@ class MetricLogger(object):
                         i, len(iterable), eta=eta_string,
                         meters=str(self),
                         time=str(iter_time), data=str(data_time),
-                        memory=torch.cuda.max_memory_allocated() / MB))
+                        memory=max_memory_allocated() / MB))
                 else:
                     print(log_msg.format(
                         i, len(iterable), eta=eta_string,
@@ -0,0 +1,74 @@
+import torch
+
+IGNORE_INDEX = -100
+
+
+def build_document(prefix, image_tokens, input_tokens=None):
+    # one training document: prefix (resolution / class token) followed by the image tokens.
+    # returns (inputs, targets) shifted by one; only the image tokens are predicted.
+    # input_tokens: corrupted image tokens fed as inputs (pkeep), the targets stay image_tokens
+    tokens = torch.cat((prefix, image_tokens if input_tokens is None else input_tokens))
+    targets = torch.cat((torch.full((prefix.shape[0] - 1,), IGNORE_INDEX, dtype=tokens.dtype, device=tokens.device), image_tokens))
+    return tokens[:-1], targets
+
+
+def plan_packing(lengths, block_size):
+    """
+    First-fit decreasing assignment of documents to rows of block_size tokens.
+    Returns (row, start) per document and the number of rows.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    used = []
+    placement = [None] * len(lengths)
+    for i in order:
+        assert lengths[i] <= block_size, "document of %d tokens does not fit in a block of %d" % (lengths[i], block_size)
+        for row in range(len(used)):
+            if used[row] + lengths[i] <= block_size:
+                placement[i] = (row, used[row])
+                used[row] += lengths[i]
+                break
+        else:
+            placement[i] = (len(used), 0)
+            used.append(lengths[i])
+    return placement, len(used)
+
+
+def pack_documents(documents, block_size, pad_token=0):
+    """
+    Packs (inputs, targets) documents into (rows, block_size) tensors:
+    input_ids, targets (IGNORE_INDEX on padding), position_ids (restarting at 0
+    for every document) and doc_ids (segment index within the row, -1 on padding).
+    The layout is planned on the host and the tokens are moved with one scatter.
+    """
+    lengths = [inputs.shape[0] for inputs, _ in documents]
+    placement, num_rows = plan_packing(lengths, block_size)
+    device = documents[0][0].device
+
+    flat_index, position_ids, doc_ids = [], torch.zeros(num_rows, block_size, dtype=torch.long), torch.full((num_rows, block_size), -1, dtype=torch.long)
+    segments = [0] * num_rows
+    for (row, start), length in zip(placement, lengths):
+        flat_index.append(torch.arange(row * block_size + start, row * block_size + start + length))
+        position_ids[row, start:start + length] = torch.arange(length)
+        doc_ids[row, start:start + length] = segments[row]
+        segments[row] += 1
+    flat_index = torch.cat(flat_index).to(device, non_blocking=True)
+
+    input_ids = torch.full((num_rows * block_size,), pad_token, dtype=torch.long, device=device)
+    targets = torch.full((num_rows * block_size,), IGNORE_INDEX, dtype=torch.long, device=device)
+    input_ids.index_copy_(0, flat_index, torch.cat([inputs for inputs, _ in documents]))
+    targets.index_copy_(0, flat_index, torch.cat([t for _, t in documents]))
+    return {
+        "input_ids": input_ids.view(num_rows, block_size),
+        "targets": targets.view(num_rows, block_size),
+        "position_ids": position_ids.to(device, non_blocking=True),
+        "doc_ids": doc_ids.to(device, non_blocking=True),
+    }
+
+
+def document_causal_mask(doc_ids):
+    # (B, T) segment ids -> (B, 1, T, T) bool, True where attention is allowed:
+    # same document and not in the future (padding attends to padding, so no row is empty)
+    seq_len = doc_ids.shape[1]
+    same = doc_ids.unsqueeze(-1) == doc_ids.unsqueeze(-2)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=doc_ids.device).tril()
+    return (same & causal).unsqueeze(1)
@@ -0,0 +1,164 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+try:
+    import mlflow
+except ImportError:
+    mlflow = None
+
+# process-wide allocator peak before the last per-stage reset
+_peak_before_reset = 0
+
+
+def max_memory_allocated():
+    # torch.cuda.max_memory_allocated() of the whole run, unaffected by the StepProfiler stage resets
+    return max(_peak_before_reset, torch.cuda.max_memory_allocated())
+
+
+def reset_stage_peak():
+    global _peak_before_reset
+    _peak_before_reset = max(_peak_before_reset, torch.cuda.max_memory_allocated())
+    torch.cuda.reset_peak_memory_stats()
+
+
+def parse_step_ranges(ranges):
+    # "100-110,5000-5010" -> [(100, 110), (5000, 5010)]
+    windows = []
+    for item in ranges.split(","):
+        if item.strip() == "":
+            continue
+        start, end = item.split("-")
+        windows.append((int(start), int(end)))
+    return windows
+
+
+class StepProfiler:
+    """
+    Low-overhead per-stage profiler for the training step.
+    Stages are timed with CUDA events that are only resolved when they have
+    completed (or at log time), so no extra synchronization is added per step.
+    Per-stage peak memory comes from the allocator statistics (host side only); the
+    run-wide peak survives the per-stage resets through max_memory_allocated().
+    Optional torch.profiler trace windows are opened for the given step ranges.
+    """
+    def __init__(self, enabled=True, log_freq=100, trace_steps="", trace_dir=None, track_memory=True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self.log_freq = log_freq
+        self.track_memory = track_memory
+        self.trace_windows = parse_step_ranges(trace_steps)
+        self.trace_dir = trace_dir
+        self.trace = None
+        self.step = 0
+        self.last_step_end = None
+
+        self.pending = []  # (name, start_event, end_event)
+        self.event_pool = []
+        self.stack = []  # [name, running peak] of the open stages
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.time_ms = defaultdict(float)
+        self.count = defaultdict(int)
+        self.peak_mem = defaultdict(float)
+        self.host_ms = defaultdict(float)
+
+    def _event(self):
+        if len(self.event_pool) > 0:
+            return self.event_pool.pop()
+        return torch.cuda.Event(enable_timing=True)
+
+    def _resolve(self, wait=False):
+        if wait and len(self.pending) > 0:
+            self.pending[-1][2].synchronize()
+        remaining = []
+        for name, start, end in self.pending:
+            if end.query():
+                self.time_ms[name] += start.elapsed_time(end)
+                self.count[name] += 1
+                self.event_pool.extend([start, end])
+            else:
+                remaining.append((name, start, end))
+        self.pending = remaining
+
+    @contextmanager
+    def _stage(self, name):
+        if self.track_memory:
+            if len(self.stack) > 0:
+                self.stack[-1][1] = max(self.stack[-1][1], torch.cuda.max_memory_allocated())
+            reset_stage_peak()
+        self.stack.append([name, 0])
+        start, end = self._event(), self._event()
+        start.record()
+        with torch.profiler.record_function(name) if self.trace is not None else nullcontext():
+            yield
+        end.record()
+        self.pending.append((name, start, end))
+        _, peak = self.stack.pop()
+        if self.track_memory:
+            peak = max(peak, torch.cuda.max_memory_allocated())
+            self.peak_mem[name] = max(self.peak_mem[name], peak)
+            if len(self.stack) > 0:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name)
+
+    def record_host(self, name, seconds):
+        if self.enabled:
+            self.host_ms[name] += seconds * 1000.0
+
+    def start_step(self, step):
+        self.step = step
+        if not self.enabled:
+            return
+        # time spent outside the step (waiting for the data loader)
+        if self.last_step_end is not None:
+            self.record_host("data", time.time() - self.last_step_end)
+        for start, end in self.trace_windows:
+            if step == start and self.trace is None:
+                print("****Profiler: tracing steps %d-%d to %s****" % (start, end, self.trace_dir))
+                self.trace = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA],
+                    profile_memory=self.track_memory,
+                    on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                )
+                self.trace.__enter__()
+
+    def end_step(self, log_writer=None):
+        if not self.enabled:
+            return
+        if self.trace is not None:
+            self.trace.step()
+            if any(self.step == end for _, end in self.trace_windows):
+                self.trace.__exit__(None, None, None)
+                self.trace = None
+        self._resolve()
+        if (self.step + 1) % self.log_freq == 0:
+            self.log(log_writer)
+        self.last_step_end = time.time()
+
+    def summary(self):
+        self._resolve(wait=True)
+        stats = {}
+        for name, total in self.time_ms.items():
+            stats["%s_ms" % name] = total / max(self.count[name], 1)
+        for name, total in self.host_ms.items():
+            stats["%s_host_ms" % name] = total / self.log_freq
+        for name, peak in self.peak_mem.items():
+            stats["%s_peak_mem_gb" % name] = peak / 1024 ** 3
+        return stats
+
+    def log(self, log_writer=None):
+        stats = self.summary()
+        self.reset_stats()
+        if log_writer is not None:
+            for k, v in stats.items():
+                log_writer.add_scalar("Profile/%s" % k, v, self.step)
+        if mlflow is not None and mlflow.active_run() is not None:
+            mlflow.log_metrics({"profile_" + k: v for k, v in stats.items()}, step=self.step)
+        return stats